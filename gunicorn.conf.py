@@ -0,0 +1,45 @@
+"""
+Runs the app with several uvicorn workers, to use more than one core per container:
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is imported once in the master process (`preload_app`), so the pipelines, prompts and tokenizer are
+built once and shared copy-on-write by the workers, then every worker creates its own OpenAI client and Redis
+connections after the fork (see `config.setup_worker`).
+
+Each worker has its own scheduler, so up to WEB_CONCURRENCY * LLM_MAX_IN_FLIGHT LLM calls run at a time. The LLM
+cache and the conversation states are only shared by the workers with the Redis backends: they are the default
+when REDIS_URL is set. The metrics of /metrics are per worker.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() != "false"
+# long transcripts take minutes to anonymize
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+# requests are logged by the app, see `log_requests`
+accesslog = None
+
+if os.getenv("REDIS_URL"):
+    os.environ.setdefault("LLM_CACHE_BACKEND", "memory+redis")
+    os.environ.setdefault("CONVERSATION_STATE_BACKEND", "redis")
+
+
+def when_ready(server):
+    if workers > 1 and not os.getenv("REDIS_URL"):
+        server.log.warning("REDIS_URL is not set, the LLM cache and conversation states are not shared by the workers")
+    if preload_app:
+        # before the workers are forked, so they share the tokenizer
+        from pseudoanonymize.config import warm_up
+
+        warm_up()
+
+
+def post_worker_init(worker):
+    if preload_app:
+        from pseudoanonymize.config import setup_worker
+
+        setup_worker()
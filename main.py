@@ -1,63 +1,302 @@
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple
 
 from ashley_protos.care.ashley.contracts.common.v1 import *
 from ashley_protos.care.ashley.contracts.internal.v1 import *
 from fastapi import FastAPI, HTTPException, Request, Response
-
-from pseudoanonymize.ashley_protos_utils import extract_conv_from_event_log, update_message_contents
-from pseudoanonymize.config import deanonymizer, get_pipeline
+from fastapi.responses import StreamingResponse
+
+from pseudoanonymize import common, metrics, transport
+from pseudoanonymize.ashley_protos_utils import (
+    EventLogIndex,
+    MessageIndex,
+    extract_messages,
+    session_indices,
+    set_message_contents,
+)
+from pseudoanonymize.config import (
+    deanonymizer,
+    get_pipeline,
+    get_scheduler,
+    single_flight,
+    state_store,
+    stream_window,
+    warm_up,
+    warm_up_mode,
+)
 from pseudoanonymize.exceptions import MaxRetriesExceededException
+from pseudoanonymize.logging_config import request_id
 from pseudoanonymize.models import (
+    AnonymizeBatchRequest,
+    AnonymizeBatchResponse,
+    AnonymizeChunkEvent,
     AnonymizeRequest,
     AnonymizeResponse,
+    AnonymizeStreamEnd,
     DeanonymizeRequest,
     DeanonymizeResponse,
     PseudoanonymizeResponse,
 )
-from pseudoanonymize.utils import chunk_by_line, flatten_replacement_dict
+from pseudoanonymize.registry import EntityRegistry
+from pseudoanonymize.singleflight import SingleFlight, request_key
+from pseudoanonymize.state import ConversationState
+from pseudoanonymize.utils import flatten_replacement_dict, iter_chunks_by_line
+
+PIPELINE_OPTION = "GPT-4o"
+
+logger = logging.getLogger("pseudoanonymize.app")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # "blocking" loads the tokenizer before the app reports ready, "background" right after, see config.warm_up
+    warm_up_task = None
+    if warm_up_mode == "blocking":
+        await asyncio.to_thread(warm_up, PIPELINE_OPTION)
+    elif warm_up_mode == "background":
+        warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up, PIPELINE_OPTION))
+    yield
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    """
+    Tag the logs of the request with its id, taken from the `X-Request-Id` header or generated, and log the
+    request once the response starts (streamed responses are still being sent).
+    """
+    token = request_id.set(request.headers.get("X-Request-Id") or uuid.uuid4().hex)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+        duration = time.perf_counter() - start
+        response.headers["X-Request-Id"] = request_id.get()
+        # the route template rather than the URL, so unknown paths don't create new series
+        route = request.scope.get("route")
+        metrics.request_duration.observe(
+            duration,
+            endpoint=route.path if route is not None else "unmatched",
+            option=PIPELINE_OPTION,
+            status=str(response.status_code),
+        )
+        logger.info(
+            "%s %s %d",
+            request.method,
+            request.url.path,
+            response.status_code,
+            extra={
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 1),
+            },
+        )
+        return response
+    finally:
+        request_id.reset(token)
+
+
+anonymization_pieline = get_pipeline(PIPELINE_OPTION)
+# All chunked endpoints share one scheduler so that one long transcript cannot starve the other requests.
+scheduler = get_scheduler()
+# Concurrent identical requests, e.g. a client retrying or calling both conversation routes, share one anonymization.
+request_flights = SingleFlight("request", enabled=single_flight)
+
 
-app = FastAPI()
+def _collect_scheduler_metrics():
+    stats = scheduler.metrics()
+    yield "pii_scheduler_queue_depth", "gauge", "Chunks waiting for an LLM slot", stats["queue_depth"]
+    yield "pii_scheduler_in_flight", "gauge", "Chunks being anonymized", stats["in_flight"]
+    yield "pii_scheduler_active_requests", "gauge", "Requests with chunks in the scheduler", stats["active_requests"]
+    yield "pii_scheduler_jobs_completed_total", "counter", "Chunks anonymized", stats["jobs_completed"]
+    yield "pii_scheduler_jobs_failed_total", "counter", "Chunks that failed", stats["jobs_failed"]
+    yield "pii_scheduler_wait_seconds_total", "counter", "Time chunks waited for a slot", stats["wait_seconds_sum"]
 
-anonymization_pieline = get_pipeline("GPT-4o")
+
+metrics.registry.add_collector(_collect_scheduler_metrics)
+
+
+async def anonymize_event_log_incrementally(events: EventLog, conversation_id: str) -> Tuple[EventLog, bool]:
+    """
+    Anonymize only the messages of the event log that weren't anonymized by a previous call for the conversation,
+    with the placeholders of the previous calls. Messages are identified by the position of their event and
+    anonymized again if their content changed. Messages of degraded chunks are not stored, so the next call
+    retries them.
+    """
+    async with state_store.lock(conversation_id):
+        state = await state_store.get(conversation_id) or ConversationState()
+        registry = EntityRegistry.from_dict(state.registry)
+        messages = extract_messages(events)
+        anonymized = {key: state.anonymized(key, content) for key, content in messages}
+        # the new messages are patched in place by the index, like those of an event log
+        new_messages = [
+            SimpleNamespace(key=key, content=content) for key, content in messages if anonymized[key] is None
+        ]
+        index = MessageIndex(new_messages)
+
+        degraded_keys = set()
+        if len(index):
+            # usually the last turn only, small enough for the small input pipeline if one is configured
+            pipeline, chunks = anonymization_pieline.plan(index.conversation, 4000, scheduler.max_fanout_per_request)
+            outputs = await scheduler.map(lambda chunk: pipeline.predict_chunk(chunk, registry, 3), chunks)
+            for (first, end), output in zip(index.spans(chunks), outputs):
+                index.patch((first, end), output["anonymized_text"])
+                if output["degraded"]:
+                    degraded_keys.update(message.key for message in index.messages[first:end])
+            index.apply_messages()
+        anonymized.update((message.key, message.content) for message in new_messages)
+
+        state.update((key, content, anonymized[key]) for key, content in messages if key not in degraded_keys)
+        state.registry = registry.to_dict()
+        await state_store.set(conversation_id, state)
+    return set_message_contents(events, anonymized), bool(degraded_keys)
+
+
+async def _anonymize_event_log(request_body: bytes, conversation_id: Optional[str]) -> Tuple[bytes, bool]:
+    """The anonymized EventLog protobuf of the request and whether a chunk is degraded."""
+    events = EventLog.FromString(request_body)
+    if conversation_id:
+        anonymized_event_log, degraded = await anonymize_event_log_incrementally(events, conversation_id)
+        return bytes(anonymized_event_log.SerializeToString()), degraded
+
+    # the messages are patched in place, the request's event log isn't used after
+    index = EventLogIndex(events)
+    registry = EntityRegistry()
+    pipeline, chunks = anonymization_pieline.plan(index.conversation, 4000, scheduler.max_fanout_per_request)
+    outputs = await scheduler.map(lambda conv_chunk: pipeline.predict_chunk(conv_chunk, registry, 3), chunks)
+    for span, output in zip(index.spans(chunks), outputs):
+        index.patch(span, output["anonymized_text"])
+    anonymized_event_log = index.apply()
+    return bytes(anonymized_event_log.SerializeToString()), any(output["degraded"] for output in outputs)
 
 
 @app.post("/anonymize_event_log")
 async def anonymize_event_log(request: Request):
     """
     Takes a request containing an EventLog protobuf and returns an anonymized EventLog protobuf.
+
+    If a conversation id is given, as the `conversation_id` query parameter or the `X-Conversation-Id` header,
+    only the messages not anonymized by the previous calls for the conversation are sent to the LLM.
     """
     try:
         request_body = await request.body()
-        events = EventLog.FromString(request_body)
-        conv = extract_conv_from_event_log(events)
-        # print(conv)
-
-        final_anonymized_conversation = ""
-        for conv_chunk in chunk_by_line(conv, 4000):
-            # anonymized_conversation, replacement_dict = anonymization_pieline.predict({"text": conv_chunk})
-            output = anonymization_pieline.retry_prediction({"text": conv_chunk}, 3)
-            anonymized_conversation = output["anonymized_text"]
-            replacement_dict = output["replacement_dict"]
-            print(replacement_dict)
-            final_anonymized_conversation += anonymized_conversation + "\n"
-
-        assert len(conv.split("\n")) == len(
-            final_anonymized_conversation.split("\n")
-        )  # The number of lines before and after anonymization should be the same
-        anonymized_event_log = update_message_contents(events, final_anonymized_conversation)
-        return Response(content=anonymized_event_log.SerializeToString(), media_type="application/protobuf")
+        conversation_id = request.query_params.get("conversation_id") or request.headers.get("X-Conversation-Id")
+        key = request_key(f"anonymize_event_log:{conversation_id or ''}", PIPELINE_OPTION, request_body)
+        content, degraded = await request_flights.do(key, lambda: _anonymize_event_log(request_body, conversation_id))
+        return Response(
+            content=content,
+            media_type="application/protobuf",
+            headers={"X-Anonymization-Degraded": str(degraded).lower()},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def stream_anonymized_chunks(
+    chunks: Iterable[str],
+    retries: int,
+    request_id: Optional[str] = None,
+    check_line_count: bool = False,
+    first_lines: Optional[Iterator[int]] = None,
+) -> AsyncIterator[str]:
+    """
+    Anonymize the chunks under the scheduler and yield one NDJSON line per chunk, in chunk order, followed by an
+    `AnonymizeStreamEnd` line. Errors can't change the status code once the stream has started, so they are
+    reported in the last line.
+
+    The first line of each chunk is given by `first_lines` if set, e.g. the spans of a `MessageIndex`, otherwise
+    it is counted from the lines of the previous chunks.
+    """
+
+    registry = EntityRegistry()
+
+    async def anonymize_stream_chunk(chunk: str):
+        return chunk, await anonymization_pieline.predict_chunk(chunk, registry, retries)
+
+    sent_replacements = {}
+    first_line = 0
+    index = 0
+    degraded = False
+    error = None
+    predictions = scheduler.imap(anonymize_stream_chunk, chunks, window=stream_window)
+    try:
+        async for chunk, prediction in predictions:
+            anonymized_text = prediction["anonymized_text"]
+            if check_line_count and chunk.count("\n") != anonymized_text.count("\n"):
+                # The number of lines before and after anonymization should be the same
+                raise ValueError(f"Chunk {index} has a different number of lines after anonymization")
+            if first_lines is not None:
+                first_line = next(first_lines)
+            delta = {
+                key: value for key, value in prediction["replacement_dict"].items() if key not in sent_replacements
+            }
+            sent_replacements.update(delta)
+            event = AnonymizeChunkEvent(
+                id=request_id,
+                index=index,
+                first_line=first_line,
+                anonymized_text=anonymized_text,
+                replacement_dict_delta=delta,
+                degraded=prediction["degraded"],
+            )
+            yield event.model_dump_json(by_alias=True) + "\n"
+            degraded = degraded or prediction["degraded"]
+            first_line += chunk.count("\n") + 1
+            index += 1
+    except Exception as e:
+        error = str(e)
+    finally:
+        await predictions.aclose()
+    end = AnonymizeStreamEnd(id=request_id, chunks=index, degraded=degraded, error=error)
+    yield end.model_dump_json(by_alias=True) + "\n"
+
+
+@app.post("/anonymize_event_log/stream")
+async def anonymize_event_log_stream(request: Request):
+    """
+    Streaming variant of /anonymize_event_log for long transcripts. Returns NDJSON: one `AnonymizeChunkEvent` per
+    chunk of message lines as soon as it is anonymized, then an `AnonymizeStreamEnd`. The lines of a chunk are the
+    non-empty messages of the event log, in order, starting at `firstLine`. A message too long for one chunk is
+    split across chunks, each of them starting at the line of the message.
+    """
+    request_body = await request.body()
+    index = EventLogIndex(EventLog.FromString(request_body))
+    chunks, span_chunks = itertools.tee(iter_chunks_by_line(index.conversation, 4000))
+    first_lines = (first for first, _ in index.iter_spans(span_chunks))
+    return StreamingResponse(
+        stream_anonymized_chunks(chunks, retries=3, check_line_count=True, first_lines=first_lines),
+        media_type="application/x-ndjson",
+    )
+
+
+def _text_request_key(endpoint: str, request: AnonymizeRequest) -> str:
+    # the id of the request, if any, doesn't change the anonymization
+    return request_key(endpoint, PIPELINE_OPTION, f"{request.retries}:{request.text}".encode("utf-8"))
+
+
 @app.post("/anonymize", response_model=AnonymizeResponse)
 async def anonymize(request: AnonymizeRequest):
     try:
         # prediction = anonymizer.retry_prediction({"text": request.text}, request.retries)
-        prediction = anonymization_pieline.predict({"text": request.text})
+        prediction = await request_flights.do(
+            _text_request_key("anonymize", request), lambda: anonymization_pieline.predict({"text": request.text})
+        )
         flattened_dict = flatten_replacement_dict(prediction["replacement_dict"])
-        return AnonymizeResponse(anonymized_text=prediction["anon_text"], replacement_dict=flattened_dict)
+        return AnonymizeResponse(
+            anonymized_text=prediction["anonymized_text"],
+            replacement_dict=flattened_dict,
+            degraded=prediction["degraded"],
+        )
     except MaxRetriesExceededException as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -65,37 +304,50 @@ async def anonymize(request: AnonymizeRequest):
 @app.post("/anonymize_v2", response_model=AnonymizeResponse)
 async def anonymize_v2(request: AnonymizeRequest):
     try:
-        text_chunks = chunk_by_line(request.text, 2000)
-        print(len(text_chunks))
-        anonymized_text_list = []
-        replacement_dict = {}
-
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for chunk in text_chunks:
-                future = executor.submit(anonymization_pieline.retry_prediction, {"text": chunk}, request.retries)
-                futures.append(future)
-
-            for future in futures:
-                try:
-                    prediction = future.result()
-                except MaxRetriesExceededException as e:
-                    raise HTTPException(status_code=500, detail=str(e))
-
-                anonymized_text_list.append(prediction["anonymized_text"])
-                replacement_dict.update(prediction["replacement_dict"])
-
-        anonymized_text = "\n".join(anonymized_text_list)
-        return AnonymizeResponse(anonymized_text=anonymized_text, replacement_dict=replacement_dict)
+        # chunks run concurrently and share a registry, so placeholders are consistent across the transcript
+        prediction = await request_flights.do(
+            _text_request_key("anonymize_v2", request),
+            lambda: anonymization_pieline.predict_chunked(request.text, retries=request.retries, scheduler=scheduler),
+        )
+        return AnonymizeResponse(**prediction)
     except MaxRetriesExceededException as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/anonymize_batch", response_model=AnonymizeBatchResponse)
+async def anonymize_batch(request: AnonymizeBatchRequest):
+    """
+    Anonymize many texts at once, e.g. archived sessions. Identical lines are anonymized once and small texts share
+    LLM calls, see `PiplelineAnon.predict_batch`.
+    """
+    try:
+        predictions = await anonymization_pieline.predict_batch(
+            request.texts, retries=request.retries, scheduler=scheduler
+        )
+        return AnonymizeBatchResponse(results=[AnonymizeResponse(**prediction) for prediction in predictions])
+    except MaxRetriesExceededException as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/anonymize_v2/stream")
+async def anonymize_v2_stream(request: AnonymizeRequest):
+    """
+    Streaming variant of /anonymize_v2. Returns NDJSON: one `AnonymizeChunkEvent` per chunk as soon as it is
+    anonymized, then an `AnonymizeStreamEnd`. Joining the `anonymizedText` of the events with newlines gives the
+    anonymized text, and merging the `replacementDictDelta` gives the replacement dict.
+    """
+    return StreamingResponse(
+        stream_anonymized_chunks(iter_chunks_by_line(request.text, 2000), request.retries, request_id=request.id),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.post("/deanonymize", response_model=DeanonymizeResponse)
 async def deanonymize(request: DeanonymizeRequest):
     try:
-        prediction = deanonymizer.retry_prediction(
-            {"text": request.text, "replacement_dict": request.replacement_dict}, request.retries
+        prediction = await deanonymizer.retry_prediction(
+            {"text": request.text, "replacement_dict": request.replacement_dict, "conversation_id": request.id},
+            request.retries,
         )
         return DeanonymizeResponse(deanonymized_text=prediction["deanonymized_text"])
     except MaxRetriesExceededException as e:
@@ -105,90 +357,95 @@ async def deanonymize(request: DeanonymizeRequest):
 @app.post("/pseudoanonymize", response_model=PseudoanonymizeResponse)
 async def pseudoanonymize(request: AnonymizeRequest):
     try:
-        anonymized_prediction = anonymization_pieline.retry_prediction({"text": request.text}, request.retries)
+        anonymized_prediction = await anonymization_pieline.retry_prediction({"text": request.text}, request.retries)
         anonymized_text = anonymized_prediction["anonymized_text"]
         replacement_dict = flatten_replacement_dict(anonymized_prediction["replacement_dict"])
 
-        deanon_prediction = deanonymizer.retry_prediction(
-            {"text": anonymized_text, "replacement_dict": replacement_dict}, request.retries
+        deanon_prediction = await deanonymizer.retry_prediction(
+            {"text": anonymized_text, "replacement_dict": replacement_dict, "conversation_id": request.id},
+            request.retries,
         )
         return PseudoanonymizeResponse(
             anonymized_text=anonymized_text,
             replacement_dict=replacement_dict,
             deanonymized_text=deanon_prediction["deanonymized_text"],
+            degraded=anonymized_prediction["degraded"],
         )
     except MaxRetriesExceededException as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _anonymize_ash_conversation(request_body: bytes) -> Tuple[bytes, bool]:
+    """The anonymized ReadConversationForUserResponse protobuf of the request and whether a chunk is degraded."""
+    conv = ReadConversationForUserResponse.FromString(request_body)
+    registry = EntityRegistry()
+    # (session index, span of the chunk, pipeline, chunk) of every chunk of the conversation
+    jobs = []
+    indices = session_indices(conv)
+    for index in indices:
+        if not len(index):
+            continue
+        pipeline, chunks = anonymization_pieline.plan(index.conversation, 4000, scheduler.max_fanout_per_request)
+        jobs += [(index, span, pipeline, chunk) for span, chunk in zip(index.spans(chunks), chunks)]
+
+    outputs = await scheduler.map(lambda job: job[2].predict_chunk(job[3], registry, 3), jobs)
+    for (index, span, _, _), output in zip(jobs, outputs):
+        index.patch(span, output["anonymized_text"])
+    # the messages are patched in place, the request's conversation isn't used after
+    for index in indices:
+        index.apply_messages()
+    return bytes(conv.SerializeToString()), any(output["degraded"] for output in outputs)
+
+
 @app.post("/anonymize_ash_conversation")
 async def anonymize_ash_conversation(request: Request):
-    def gather_text(entries, max_length, sep_seq):
-        """
-        Gather text from user and therapist messages within the given length limit.
-
-        Args:
-            entries (list): List of conversation entries.
-            max_length (int): Maximum length of the gathered text.
-            sep_seq (str): Separator sequence used between messages.
-
-        Returns:
-            tuple: A tuple containing gathered text, indices, and types.
-        """
-        gathered_text = ""
-        indices = []
-        types = []
-
-        for j in range(len(entries)):
-            user_msg = entries[j].user_message.content
-            ther_msg = entries[j].therapist_message.content
-
-            if user_msg and len(gathered_text) + len(user_msg) <= max_length:
-                gathered_text += user_msg + sep_seq
-                indices.append(j)
-                types.append("user")
-
-            if ther_msg and len(gathered_text) + len(ther_msg) <= max_length:
-                gathered_text += ther_msg + sep_seq
-                indices.append(j)
-                types.append("therapist")
-
-        return gathered_text, indices, types
-
-    def update_entries_with_anonymized_text(entries, indices, types, anon_messages):
-        """
-        Update the conversation entries with the anonymized text.
-
-        Args:
-            entries (list): List of conversation entries.
-            indices (list): Indices of the entries to be updated.
-            types (list): Types of the messages (user or therapist).
-            anon_messages (list): Anonymized messages.
-        """
-        for j_idx, msg_type in zip(indices, types):
-            if msg_type == "user":
-                entries[j_idx].user_message.content = anon_messages.pop(0)
-            else:
-                entries[j_idx].therapist_message.content = anon_messages.pop(0)
+    """
+    Takes a ReadConversationForUserResponse protobuf and returns it with every message of every session anonymized.
 
-    request_body = await request.body()
-    conv = ReadConversationForUserResponse.FromString(request_body)
-    new_sessions = deepcopy(conv.sessions)
+    Each session is chunked by message with the token-aware planner, and the chunks of all the sessions run
+    concurrently under the shared scheduler, with one registry so that placeholders are consistent across sessions.
+    Identical requests in flight, on this route or on /read_conversation_for_user, are anonymized once.
+    """
+    try:
+        request_body = await request.body()
+        key = request_key("anonymize_ash_conversation", PIPELINE_OPTION, request_body)
+        content, degraded = await request_flights.do(key, lambda: _anonymize_ash_conversation(request_body))
+        return Response(
+            content=content,
+            media_type="application/protobuf",
+            headers={"X-Anonymization-Degraded": str(degraded).lower()},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Request and stage latency histograms, token, cache, retry and chunk counters in the Prometheus format."""
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/scheduler_metrics")
+async def scheduler_metrics():
+    return scheduler.metrics()
+
+
+@app.get("/cache_metrics")
+async def cache_metrics():
+    return common.llm_cache.metrics() if common.llm_cache else {"backend": None}
 
-    max_length = 2000
-    sep_seq = "-\n-"
 
-    for i in range(len(new_sessions)):
-        entries = new_sessions[i].entries
-        gathered_text, indices, types = gather_text(entries, max_length, sep_seq)
+@app.get("/http_metrics")
+async def http_metrics():
+    return transport.pool_metrics()
 
-        if gathered_text:
-            anon_messages, _ = anonymization_pieline.predict(dict(text=gathered_text.strip()))
-            anon_messages.split(sep_seq)
-            update_entries_with_anonymized_text(entries, indices, types, anon_messages)
 
-    conv.sessions[:] = new_sessions
-    return Response(content=conv.SerializeToString(), media_type="application/protobuf")
+@app.get("/chunk_size_metrics")
+async def chunk_size_metrics():
+    shaper = anonymization_pieline.shaper
+    if shaper is None or shaper.controller is None:
+        return {"pinned_chunk_tokens": shaper.pinned_chunk_tokens if shaper else None, "controller": None}
+    return {"pinned_chunk_tokens": shaper.pinned_chunk_tokens, "controller": shaper.controller.metrics()}
 
 
 # TODO: change endpoint called from the kotlin side to /anonymize_ash_conversation. This is just a temporary solution.
@@ -171,14 +171,14 @@ class Anonymizer(BaseProcessor):
         self.model = "gpt-4o"
         self.temperature = 0.1
 
-    def _identify_and_anonymize_pii(self, text: str) -> str:
-        return make_chat_completion(
+    async def _identify_and_anonymize_pii(self, text: str) -> str:
+        return await make_chat_completion(
             self.client, self.model, system_prompt=self.system_prompt, user_msg=text, context_length=self.context_length
         )
 
-    def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
+    async def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
         text = input_["text"]
-        combined_output = self._identify_and_anonymize_pii(text)
+        combined_output = await self._identify_and_anonymize_pii(text)
 
         parts = combined_output.split("2. Replacement Dictionary:")
         if len(parts) < 2:
@@ -1,48 +1,76 @@
+from typing import Dict, List, Tuple
+
 from ashley_protos.care.ashley.contracts.common.v1 import *
 from ashley_protos.care.ashley.contracts.internal.v1 import *
 
+from pseudoanonymize import metrics
+from pseudoanonymize.message_index import MessageIndex
+
 
 def extract_conv_from_event_log(event_log: EventLog) -> str:
     """obtain the conversation as a string from the event log"""
-    conv = ""
-    for event in event_log.events:
-        if hasattr(event, "therapist_message_completed"):
-            if event.therapist_message_completed.message.content:
-                content = event.therapist_message_completed.message.content
-                content = content.replace("\n", " ")
-                conv += content + "\n"
-        if hasattr(event, "user_message_completed"):
-            if event.user_message_completed.message.content:
-                content = event.user_message_completed.message.content
-                content = content.replace("\n", " ")
-                conv += content + "\n"
+    return "".join(content + "\n" for _, content in extract_messages(event_log))
+
+
+MESSAGE_ROLES = ("therapist", "user")
 
-    return conv
 
+def message_key(event_index: int, role: str) -> str:
+    return f"{event_index}:{role}"
 
-def copy_event_log(events: EventLog) -> EventLog:
-    # a simple deepcopy causes unexpected behavior, like data loss when returning the new object
-    return EventLog().FromString(events.SerializeToString())
+
+@metrics.timed("protobuf_extract")
+def extract_messages(event_log: EventLog) -> List[Tuple[str, str]]:
+    """
+    The non-empty messages of the event log as (key, content), in the order of `extract_conv_from_event_log`.
+    The key identifies the message by the position of its event, see `message_key`.
+    """
+    messages = []
+    for i, event in enumerate(event_log.events):
+        for role in MESSAGE_ROLES:
+            completed = getattr(event, f"{role}_message_completed", None)
+            if completed is not None and completed.message.content:
+                messages.append((message_key(i, role), completed.message.content.replace("\n", " ")))
+    return messages
 
 
-def update_message_contents(events: EventLog, anonymized_conversation: str) -> EventLog:
+@metrics.timed("protobuf_update")
+def set_message_contents(event_log: EventLog, contents: Dict[str, str]) -> EventLog:
     """
-    update the message contents in the new event log with the anonymized text
+    Replace the content of the messages of the event log in place, given by key (see `extract_messages`).
     """
-    new_event = copy_event_log(events)
-
-    anonymized_text_turns = anonymized_conversation.split(
-        "\n"
-    )  # was formatted with newlines per turn, so split on newlines to get each turn.
-
-    j = 0
-    for i, event in enumerate(events.events):
-        if hasattr(event, "therapist_message_completed"):
-            if event.therapist_message_completed.message.content:
-                new_event.events[i].therapist_message_completed.message.content = anonymized_text_turns[j]
-                j += 1
-        if hasattr(event, "user_message_completed"):
-            if event.user_message_completed.message.content:
-                new_event.events[i].user_message_completed.message.content = anonymized_text_turns[j]
-                j += 1
-    return new_event
+    for key, content in contents.items():
+        event_index, role = key.split(":")
+        getattr(event_log.events[int(event_index)], f"{role}_message_completed").message.content = content
+    return event_log
+
+
+class EventLogIndex(MessageIndex):
+    """The index of the therapist and user messages of an event log, in the order of `extract_messages`."""
+
+    def __init__(self, event_log: EventLog):
+        self.event_log = event_log
+        super().__init__(
+            getattr(event, f"{role}_message_completed").message
+            for event in event_log.events
+            for role in MESSAGE_ROLES
+            if getattr(event, f"{role}_message_completed", None) is not None
+        )
+
+    def apply(self) -> EventLog:
+        """Set the content of the patched messages in the event log, in place, and return it."""
+        self.apply_messages()
+        return self.event_log
+
+
+def session_indices(conversation: ReadConversationForUserResponse) -> List[MessageIndex]:
+    """The index of the messages of each session of the conversation, the user message of an entry first."""
+    return [
+        MessageIndex(
+            message
+            for entry in session.entries
+            for message in (entry.user_message, entry.therapist_message)
+            if message is not None
+        )
+        for session in conversation.sessions
+    ]
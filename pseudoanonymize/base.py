@@ -1,67 +1,124 @@
+import asyncio
 import logging
-import os
+import time
 from abc import ABC, abstractmethod
+from dataclasses import asdict
 from typing import Any, Dict, Optional
 
-from faker import Faker
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from pseudoanonymize.exceptions import MaxRetriesExceededException, UnparsableLLMOutputException
+from pseudoanonymize import metrics
+from pseudoanonymize.common import bypass_llm_cache
+from pseudoanonymize.exceptions import (
+    DeadlineExceededException,
+    MaxRetriesExceededException,
+    UnparsableLLMOutputException,
+)
+from pseudoanonymize.replacement import get_replacement_matcher
+from pseudoanonymize.retry import AttemptRecord, RetryPolicy
 from pseudoanonymize.utils import flatten_replacement_dict
 
-fake = Faker()
-
 
 class BaseProcessor(ABC):
-    def __init__(self, client: OpenAI):
+    retry_policy: RetryPolicy = RetryPolicy()
+
+    def __init__(self, client: AsyncOpenAI):
         self.client = client
-        self.logger = self._setup_logger()
 
     @abstractmethod
-    def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
+    async def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
         pass
 
-    def retry_prediction(self, input_: Dict[str, Any], max_retries: int = 5) -> Optional[Dict[str, Any]]:
-        retries = 0
-        while retries < max_retries:
+    async def retry_prediction(
+        self, input_: Dict[str, Any], max_retries: Optional[int] = None, policy: Optional[RetryPolicy] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Run `predict`, retrying failures according to the retry policy (see RetryPolicy).
+        The prediction is returned with an "attempts" list recording the outcome of every attempt.
+
+        args:
+            input_: the input of `predict`
+            max_retries: the maximum number of attempts, overrides the policy's max_retries
+            policy: the retry policy, defaults to the processor's retry_policy
+        """
+        policy = policy or self.retry_policy
+        max_retries = max_retries if max_retries is not None else policy.max_retries
+        deadline = time.monotonic() + policy.deadline if policy.deadline is not None else None
+        attempts = []
+        bypass_cache = False
+
+        for attempt in range(1, max_retries + 1):
+            use_escalation = policy.escalate_to is not None and attempt > policy.escalate_after
+            processor = policy.escalate_to if use_escalation else self
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                break
+
+            record = AttemptRecord(attempt, processor.__class__.__name__, "success", 0.0, bypass_cache)
+            attempts.append(record)
+            if attempt > 1:
+                metrics.retries.inc(processor=self.__class__.__name__)
+            bypass_token = bypass_llm_cache.set(bypass_cache)
+            start = time.perf_counter()
             try:
-                prediction = self.predict(input_)
-                return prediction
+                prediction = await asyncio.wait_for(processor.predict(input_), timeout)
             except UnparsableLLMOutputException as e:
-                retries += 1
-                if retries >= max_retries:
-                    self.logger.error(f"Failed to process item after {max_retries} attempts")
-                    raise MaxRetriesExceededException(f"Failed to process item after {max_retries} attempts")
-
-    def _setup_logger(self) -> logging.Logger:
-        logger = logging.getLogger(self.__class__.__name__)
-        logger.setLevel(logging.DEBUG)
-        log_dir = "logs"
-        os.makedirs(log_dir, exist_ok=True)
-        handler = logging.FileHandler(os.path.join(log_dir, f"{self.__class__.__name__}.log"))
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return logger
+                record.outcome, record.error = "unparsable", str(e)
+                # the cached response is the one that failed to parse, make the next attempt sample a new one
+                bypass_cache = True
+            except policy.retryable_errors as e:
+                record.outcome, record.error = "api_error", str(e)
+            except asyncio.TimeoutError:
+                record.outcome = "deadline_exceeded"
+            else:
+                record.duration_seconds = time.perf_counter() - start
+                metrics.attempts.inc(processor=record.processor, outcome=record.outcome)
+                prediction["attempts"] = [asdict(a) for a in attempts]
+                return prediction
+            finally:
+                bypass_llm_cache.reset(bypass_token)
+
+            record.duration_seconds = time.perf_counter() - start
+            metrics.attempts.inc(processor=record.processor, outcome=record.outcome)
+            if record.outcome == "deadline_exceeded":
+                break
+            if record.outcome == "api_error" and attempt < max_retries:
+                delay = policy.backoff(attempt)
+                if deadline is not None:
+                    delay = min(delay, max(0.0, deadline - time.monotonic()))
+                await asyncio.sleep(delay)
+
+        self.logger.error(
+            "Failed to process item after %d attempts",
+            len(attempts),
+            # the errors can quote the model output, only the outcomes are logged
+            extra={"outcomes": [a.outcome for a in attempts], "processor": self.__class__.__name__},
+        )
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceededException(f"Deadline of {policy.deadline}s exceeded after {len(attempts)} attempts")
+        raise MaxRetriesExceededException(f"Failed to process item after {max_retries} attempts")
+
+    @property
+    def logger(self) -> logging.Logger:
+        # handlers are set up once per process, see logging_config.setup_logging
+        return logging.getLogger(f"pseudoanonymize.{self.__class__.__name__}")
 
     def _log_error(self, error_message: str, invalid_model_output: str) -> None:
         """
         Log an error message in case where the model fails to produce a valid output.
+        The model output contains the conversation, it is only logged when PII redaction is off.
         """
-        self.logger.error(f"Error: {error_message}\Model Output: {invalid_model_output}")
+        self.logger.error(error_message, extra={"model_output": invalid_model_output})
 
+    @metrics.timed("replacement")
     def _parse_replacements(self, text: str, replacement_dict: Dict[Any, str]) -> str:
         """
         Using the replacement_dict, replace each key present in the dict with the corresponding value.
         """
         flat_dict = flatten_replacement_dict(replacement_dict)
-        # Sort keys by length in descending order to replace longer strings first.
-        # This avoids edge cases where a shorter key that is a subset of a longer key is replaced first, potentially interfering with subsequent replacements.
-        sorted_keys = sorted(flat_dict.keys(), key=len, reverse=True)
-        for key in sorted_keys:
-            text = text.replace(key, str(flat_dict[key]))
-        return text
+        # Replacement is leftmost-longest in a single pass, so a shorter key that is a subset of a longer key
+        # never interferes with it, and placeholders inserted for one key are never replaced by another.
+        return get_replacement_matcher(flat_dict).replace(text)
 
     def _extract_and_parse_replacement_dict(self, combined_output: str) -> Dict[str, str]:
         replacement_dict_str = combined_output.strip()
@@ -0,0 +1,364 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def prompt_fingerprint(
+    model: str, system_prompt: str, user_msg: str, temperature: float, context_length: int, json_format: bool
+) -> str:
+    """
+    Key of an LLM call in the cache: a hash of the call parameters, so raw prompts are never stored as keys.
+    """
+    digest = hashlib.sha256()
+    for part in (model, system_prompt, user_msg, repr(temperature), repr(context_length), repr(json_format)):
+        encoded = part.encode("utf-8")
+        # length-prefix every part so that different splits of the same bytes can't collide
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class LLMCache(ABC):
+    """
+    Interface of the LLM response caches. Backends implement `_get`, `_set` and `_delete`,
+    the hit/miss counters are kept here and evictions are counted by the backends.
+    """
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._get(key)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value: str) -> None:
+        await self._set(key, value)
+
+    async def delete(self, key: str) -> None:
+        await self._delete(key)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"backend": self.__class__.__name__, **asdict(self.stats)}
+
+    def reconnect(self) -> None:
+        """Drop the connections inherited from the parent process, in a forked worker. Most backends have none."""
+
+    @abstractmethod
+    async def _get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def _set(self, key: str, value: str) -> None:
+        pass
+
+    @abstractmethod
+    async def _delete(self, key: str) -> None:
+        pass
+
+
+class InMemoryLRUCache(LLMCache):
+    """
+    An in-process cache that evicts the least recently used entry once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Optional[float], str]]" = OrderedDict()
+
+    async def _get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._entries[key]
+            self.stats.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def _set(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def _delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**super().metrics(), "entries": len(self._entries)}
+
+
+class DiskCache(LLMCache):
+    """
+    A cache storing one file per entry in `directory`. Entries older than `ttl` seconds are dropped, and the
+    least recently used entries are evicted once the files take more than `max_bytes`.
+
+    The files are read and written in worker threads: the index of the entries is guarded by a lock, and an entry
+    is written to a temporary file moved into place, so a concurrent read or a crash never sees a partial entry.
+    """
+
+    # prefix of the files being written, ignored and removed when the cache is opened
+    TMP_PREFIX = ".tmp-"
+
+    def __init__(self, directory: str = "cache/llm", max_bytes: int = 100 * 1024 * 1024, ttl: Optional[float] = None):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # index of the entries on disk, from least to most recently used, with their size
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith(self.TMP_PREFIX):
+                # left by a write interrupted by a crash
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+        self._size = sum(self._index.values())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _read(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            if self.ttl is not None and os.path.getmtime(path) + self.ttl < time.time():
+                with self._lock:
+                    self._remove_locked(key)
+                    self.stats.evictions += 1
+                return None
+            with open(path, encoding="utf-8") as file:
+                value = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+        return value
+
+    def _write(self, key: str, value: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=self.TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(value)
+            size = os.path.getsize(tmp_path)
+            with self._lock:
+                os.replace(tmp_path, self._path(key))
+                self._size += size - self._index.pop(key, 0)
+                self._index[key] = size
+                while self._size > self.max_bytes and len(self._index) > 1:
+                    self._remove_locked(next(iter(self._index)))
+                    self.stats.evictions += 1
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _remove(self, key: str) -> None:
+        with self._lock:
+            self._remove_locked(key)
+
+    def _remove_locked(self, key: str) -> None:
+        self._size -= self._index.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def _get(self, key: str) -> Optional[str]:
+        if key not in self._index:
+            return None
+        return await asyncio.to_thread(self._read, key)
+
+    async def _set(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self._write, key, value)
+
+    async def _delete(self, key: str) -> None:
+        await asyncio.to_thread(self._remove, key)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**super().metrics(), "entries": len(self._index), "bytes": self._size}
+
+
+class InMemoryRedis:
+    """
+    A local stand-in for the subset of the `redis.asyncio.Redis` client used by the service,
+    for tests and local development without a Redis server.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Optional[float], bytes]] = {}
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def get(self, name: str) -> Optional[bytes]:
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._data[name]
+            return None
+        return value
+
+    async def set(self, name: str, value: Any, ex: Optional[int] = None) -> bool:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        self._data[name] = (time.time() + ex if ex else None, value)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        return sum(self._data.pop(name, None) is not None for name in names)
+
+    def lock(self, name: str, timeout: Optional[float] = None, blocking_timeout: Optional[float] = None):
+        # only one process uses the stand-in, a lock of the process is enough
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+
+def redis_from_url(url: str, purpose: str) -> Any:
+    try:
+        import redis.asyncio as redis
+    except ImportError as e:
+        raise ImportError(f"The redis {purpose} requires the `redis` package: pip install redis") from e
+    return redis.from_url(url)
+
+
+class RedisCache(LLMCache):
+    """
+    A cache shared by all instances of the service, stored in Redis (or any server speaking its protocol).
+    Size is bounded by the server's `maxmemory` policy, entries expire after `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        ttl: Optional[int] = 7 * 24 * 3600,
+        prefix: str = "pii-service:llm:",
+        url: Optional[str] = None,
+    ):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.url = url
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisCache":
+        return cls(redis_from_url(url, "cache backend"), url=url, **kwargs)
+
+    def reconnect(self) -> None:
+        if self.url:
+            self.client = redis_from_url(self.url, "cache backend")
+
+    async def _get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    async def _set(self, key: str, value: str) -> None:
+        await self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    async def _delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+
+class TieredCache(LLMCache):
+    """
+    Chains caches from fastest to slowest, e.g. an in-memory LRU in front of a disk or Redis cache.
+    A hit in a slower tier is copied into the faster ones.
+    """
+
+    def __init__(self, tiers: List[LLMCache]):
+        super().__init__()
+        self.tiers = tiers
+
+    async def _get(self, key: str) -> Optional[str]:
+        for i, tier in enumerate(self.tiers):
+            value = await tier.get(key)
+            if value is not None:
+                for faster_tier in self.tiers[:i]:
+                    await faster_tier.set(key, value)
+                return value
+        return None
+
+    async def _set(self, key: str, value: str) -> None:
+        for tier in self.tiers:
+            await tier.set(key, value)
+
+    async def _delete(self, key: str) -> None:
+        for tier in self.tiers:
+            await tier.delete(key)
+
+    def reconnect(self) -> None:
+        for tier in self.tiers:
+            tier.reconnect()
+
+    def metrics(self) -> Dict[str, Any]:
+        self.stats.evictions = sum(tier.stats.evictions for tier in self.tiers)
+        return {**super().metrics(), "tiers": [tier.metrics() for tier in self.tiers]}
+
+
+def build_llm_cache(
+    backend: str,
+    max_entries: int = 1024,
+    directory: str = "cache/llm",
+    max_bytes: int = 100 * 1024 * 1024,
+    ttl: Optional[float] = None,
+    redis_url: Optional[str] = None,
+) -> Optional[LLMCache]:
+    """
+    Build the LLM cache selected by name: "memory", "disk", "memory+disk", "redis", "memory+redis" or "none".
+    The "redis" backends use the local stand-in when no `redis_url` is given.
+    """
+    tiers = []
+    for name in backend.split("+"):
+        if name == "none":
+            return None
+        elif name == "memory":
+            tiers.append(InMemoryLRUCache(max_entries=max_entries, ttl=ttl))
+        elif name == "disk":
+            tiers.append(DiskCache(directory=directory, max_bytes=max_bytes, ttl=ttl))
+        elif name == "redis":
+            redis_ttl = int(ttl) if ttl else None
+            if redis_url:
+                tiers.append(RedisCache.from_url(redis_url, ttl=redis_ttl))
+            else:
+                tiers.append(RedisCache(InMemoryRedis(), ttl=redis_ttl))
+        else:
+            raise ValueError(f"Unknown LLM cache backend: {name}")
+    return tiers[0] if len(tiers) == 1 else TieredCache(tiers)
@@ -0,0 +1,138 @@
+import math
+import threading
+from typing import Dict, List, Optional
+
+
+class ChunkSizeController:
+    """
+    Picks the chunk size of a request from the latency and unparsable-output rate observed for a model.
+
+    Bigger chunks pay the prompt prefix fewer times but take longer and fail to parse more often, smaller chunks
+    run more in parallel but each call has a fixed cost. The controller fits the latency of an attempt as
+    `intercept + slope * chunk_tokens` (weighted least squares with exponentially decaying weights, so it follows
+    the provider's latency over time) and keeps the unparsable rate per size bucket. For a text of T tokens and a
+    fan-out of F chunks running at a time, the expected completion time with n chunks is
+
+        ceil(n / F) * latency(T / n) / (1 - unparsable_rate(T / n))
+
+    since every unparsable output costs one more attempt. The size with the lowest expected time within
+    [min_chunk_tokens, max_chunk_tokens] is chosen, the biggest one on ties as it costs fewer tokens.
+
+    Until `min_observations` attempts of different sizes are observed the controller has no opinion and `choose`
+    returns None.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        min_chunk_tokens: int = 1000,
+        max_chunk_tokens: int = 4000,
+        step_tokens: int = 250,
+        decay: float = 0.02,
+        min_observations: int = 20,
+        failure_bucket_tokens: int = 500,
+    ):
+        """
+        args:
+            model: the model the observations are for, for reporting
+            min_chunk_tokens, max_chunk_tokens: the bounds of the chosen sizes
+            step_tokens: the granularity of the candidate sizes
+            decay: the weight of a new observation, older ones weigh (1 - decay) times less at each observation
+            min_observations: the number of observations before the controller chooses sizes
+            failure_bucket_tokens: the width of the size buckets of the unparsable rates
+        """
+        self.model = model
+        self.min_chunk_tokens = min_chunk_tokens
+        self.max_chunk_tokens = max(max_chunk_tokens, min_chunk_tokens)
+        self.step_tokens = step_tokens
+        self.decay = decay
+        self.min_observations = min_observations
+        self.failure_bucket_tokens = failure_bucket_tokens
+        self.observations = 0
+        # decayed sums of the weights, x, y, x * x and x * y of the latency fit
+        self._sums = [0.0] * 5
+        # size bucket -> decayed sums of the weights and of the unparsable outputs
+        self._failures: Dict[int, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, chunk_tokens: int, seconds: float, unparsable: bool = False) -> None:
+        """Record an attempt at anonymizing a chunk of `chunk_tokens` tokens."""
+        x, y = float(chunk_tokens), seconds
+        with self._lock:
+            self.observations += 1
+            self._sums = [
+                (1 - self.decay) * total + value for total, value in zip(self._sums, (1.0, x, y, x * x, x * y))
+            ]
+            bucket = chunk_tokens // self.failure_bucket_tokens
+            weight, failures = self._failures.get(bucket, (0.0, 0.0))
+            self._failures[bucket] = [(1 - self.decay) * weight + 1, (1 - self.decay) * failures + unparsable]
+
+    def _fit(self) -> Optional[tuple]:
+        weight, sum_x, sum_y, sum_xx, sum_xy = self._sums
+        if self.observations < self.min_observations or weight == 0:
+            return None
+        variance = sum_xx / weight - (sum_x / weight) ** 2
+        # all the chunks had about the same size, the effect of the size can't be told apart from the fixed cost
+        if variance < (self.step_tokens / 2) ** 2:
+            return None
+        slope = max(0.0, (weight * sum_xy - sum_x * sum_y) / (weight * sum_xx - sum_x**2))
+        intercept = max(0.0, (sum_y - slope * sum_x) / weight)
+        return intercept, slope
+
+    def latency(self, chunk_tokens: float) -> Optional[float]:
+        """The expected seconds of an attempt at a chunk of `chunk_tokens` tokens, None before enough observations."""
+        fit = self._fit()
+        if fit is None:
+            return None
+        intercept, slope = fit
+        return intercept + slope * chunk_tokens
+
+    def _failure_rates(self) -> Dict[int, float]:
+        return {bucket: failures / weight for bucket, (weight, failures) in self._failures.items()}
+
+    def unparsable_rate(self, chunk_tokens: float) -> float:
+        bucket = int(chunk_tokens) // self.failure_bucket_tokens
+        rates = self._failure_rates()
+        if bucket in rates:
+            return rates[bucket]
+        # bigger chunks don't fail less often: an unobserved size gets the highest rate of the smaller sizes
+        return max((rate for observed, rate in rates.items() if observed < bucket), default=0.0)
+
+    def expected_seconds(self, text_tokens: int, chunk_tokens: int, fanout: int) -> Optional[float]:
+        num_chunks = max(1, math.ceil(text_tokens / chunk_tokens))
+        size = text_tokens / num_chunks
+        latency = self.latency(size)
+        if latency is None:
+            return None
+        # capped so that a size that always fails is very slow rather than infinite
+        attempts = 1 / max(0.05, 1 - self.unparsable_rate(size))
+        return math.ceil(num_chunks / fanout) * latency * attempts
+
+    def choose(self, text_tokens: int, fanout: int) -> Optional[int]:
+        """
+        The chunk size minimizing the expected completion time of a text of `text_tokens` tokens with `fanout`
+        chunks running at a time, or None before enough observations.
+        """
+        if self._fit() is None:
+            return None
+        best_size, best_seconds = None, math.inf
+        # from the biggest size down, so that a smaller size must be faster to win
+        size = self.max_chunk_tokens
+        while size >= self.min_chunk_tokens:
+            seconds = self.expected_seconds(text_tokens, size, fanout)
+            if seconds < best_seconds * 0.97:
+                best_size, best_seconds = size, seconds
+            size -= self.step_tokens
+        return best_size
+
+    def metrics(self) -> dict:
+        fit = self._fit()
+        return {
+            "model": self.model,
+            "observations": self.observations,
+            "latency_intercept_seconds": fit[0] if fit else None,
+            "latency_seconds_per_token": fit[1] if fit else None,
+            "unparsable_rates": {
+                bucket * self.failure_bucket_tokens: rate for bucket, rate in sorted(self._failure_rates().items())
+            },
+        }
@@ -0,0 +1,237 @@
+"""
+Anonymize files in bulk with the service's pipelines, without the HTTP server.
+
+Inputs can be:
+- JSONL files with one {"id": ..., "text": ...} object per line (the id defaults to <path>:<line number>)
+- text files, each file being one text
+- serialized EventLog protobufs, each file being one conversation
+
+Results are appended to the output JSONL file as they are ready, one
+{"id", "anonymizedText", "replacementDict", "degraded"} object per input, in completion order. The output file
+is also the checkpoint: running the same command again after a crash skips the inputs already in it.
+Failed inputs are written to <output>.errors.jsonl and retried on the next run.
+
+To run from the root of the repo:
+    python -m pseudoanonymize.cli sessions.jsonl --output anonymized.jsonl --workers 16
+    python -m pseudoanonymize.cli logs/*.pb --output anonymized.jsonl --eventlog-dir anonymized_logs
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional, Set, TextIO
+
+from pseudoanonymize import common
+from pseudoanonymize.pipeline import PiplelineAnon
+from pseudoanonymize.scheduler import ChunkScheduler
+
+FORMATS_BY_EXTENSION = {".jsonl": "jsonl", ".ndjson": "jsonl", ".txt": "text", ".md": "text", ".pb": "eventlog"}
+
+
+@dataclass
+class Record:
+    id: str
+    text: str
+    # the EventLogIndex of the parsed EventLog for eventlog inputs, to write the anonymized protobuf
+    event_log_index: Optional[object] = None
+
+
+@dataclass
+class RunStats:
+    records: int = 0
+    skipped: int = 0
+    errors: int = 0
+    chars: int = 0
+    degraded: int = 0
+
+
+def _input_format(path: str, input_format: str) -> str:
+    if input_format != "auto":
+        return input_format
+    return FORMATS_BY_EXTENSION.get(os.path.splitext(path)[1].lower(), "text")
+
+
+def read_records(paths: list[str], input_format: str = "auto") -> Iterator[Record]:
+    """Read the inputs lazily, one record at a time."""
+    for path in paths:
+        file_format = _input_format(path, input_format)
+        if file_format == "jsonl":
+            with open(path, encoding="utf-8") as file:
+                for line_number, line in enumerate(file, start=1):
+                    if line.strip():
+                        data = json.loads(line)
+                        yield Record(id=str(data.get("id") or f"{path}:{line_number}"), text=data["text"])
+        elif file_format == "text":
+            with open(path, encoding="utf-8") as file:
+                yield Record(id=path, text=file.read())
+        elif file_format == "eventlog":
+            # the protobufs are only needed for event logs
+            from ashley_protos.care.ashley.contracts.internal.v1 import EventLog
+
+            from pseudoanonymize.ashley_protos_utils import EventLogIndex
+
+            with open(path, "rb") as file:
+                index = EventLogIndex(EventLog.FromString(file.read()))
+            yield Record(id=path, text=index.conversation, event_log_index=index)
+        else:
+            raise ValueError(f"Unknown input format: {file_format}")
+
+
+def load_checkpoint(output_path: str) -> Set[str]:
+    """
+    The ids of the records already in the output file. A line cut short by a crash is dropped from the file.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    valid_size = 0
+    with open(output_path, "rb") as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid_size += len(line)
+    with open(output_path, "r+b") as file:
+        file.truncate(valid_size)
+    return done
+
+
+def write_line(file: TextIO, data: dict) -> None:
+    file.write(json.dumps(data, ensure_ascii=False) + "\n")
+    file.flush()
+
+
+class BulkAnonymizer:
+    def __init__(
+        self,
+        pipeline: PiplelineAnon,
+        workers: int = 8,
+        max_tokens: Optional[int] = None,
+        retries: int = 5,
+        eventlog_dir: Optional[str] = None,
+    ):
+        self.pipeline = pipeline
+        self.workers = workers
+        self.max_tokens = max_tokens
+        self.retries = retries
+        self.eventlog_dir = eventlog_dir
+        # the chunks of a record can use all the workers when the other records are done
+        self.scheduler = ChunkScheduler(max_in_flight=workers, max_fanout_per_request=workers)
+        self.stats = RunStats()
+
+    async def _process(self, record: Record, output: TextIO, errors: TextIO) -> None:
+        try:
+            write_event_log = record.event_log_index is not None and self.eventlog_dir
+            prediction = await self.pipeline.predict_chunked(
+                record.text,
+                max_tokens=self.max_tokens,
+                retries=self.retries,
+                scheduler=self.scheduler,
+                index=record.event_log_index if write_event_log else None,
+            )
+            if write_event_log:
+                self._write_event_log(record)
+        except Exception as e:
+            self.stats.errors += 1
+            write_line(errors, {"id": record.id, "error": f"{e.__class__.__name__}: {e}"})
+            return
+        self.stats.records += 1
+        self.stats.chars += len(record.text)
+        self.stats.degraded += prediction["degraded"]
+        write_line(
+            output,
+            {
+                "id": record.id,
+                "anonymizedText": prediction["anonymized_text"],
+                "replacementDict": prediction["replacement_dict"],
+                "degraded": prediction["degraded"],
+            },
+        )
+
+    def _write_event_log(self, record: Record) -> None:
+        # the anonymized chunks were patched into the messages by `predict_chunked`
+        anonymized_event_log = record.event_log_index.apply()
+        os.makedirs(self.eventlog_dir, exist_ok=True)
+        with open(os.path.join(self.eventlog_dir, os.path.basename(record.id)), "wb") as file:
+            file.write(anonymized_event_log.SerializeToString())
+
+    async def run(self, records: Iterator[Record], done: Set[str], output: TextIO, errors: TextIO) -> None:
+        # at most `workers` records are read and in progress at a time, so memory doesn't grow with the input
+        slots = asyncio.Semaphore(self.workers)
+        tasks = set()
+        for record in records:
+            if record.id in done:
+                self.stats.skipped += 1
+                continue
+            await slots.acquire()
+            task = asyncio.create_task(self._process(record, output, errors))
+            tasks.add(task)
+            task.add_done_callback(lambda task: (tasks.discard(task), slots.release()))
+        await asyncio.gather(*tasks)
+
+    def report(self, elapsed: float) -> str:
+        usage = common.llm_usage
+        return (
+            f"{self.stats.records} records ({self.stats.skipped} skipped, {self.stats.errors} errors, "
+            f"{self.stats.degraded} degraded) in {elapsed:.1f}s: {self.stats.records / elapsed:.2f} records/s, "
+            f"{self.stats.chars / elapsed:.0f} chars/s | LLM: {usage.calls} calls ({usage.cached_calls} cached), "
+            f"{usage.prompt_tokens} prompt tokens ({usage.cached_prompt_tokens} cached), "
+            f"{usage.completion_tokens} completion tokens, {usage.tokens_per_char():.2f} tokens/char"
+        )
+
+
+async def _report_periodically(anonymizer: BulkAnonymizer, start: float, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(anonymizer.report(time.perf_counter() - start), file=sys.stderr)
+
+
+async def run(args: argparse.Namespace) -> BulkAnonymizer:
+    from pseudoanonymize.config import get_pipeline
+
+    anonymizer = BulkAnonymizer(
+        get_pipeline(args.option),
+        workers=args.workers,
+        max_tokens=args.max_tokens,
+        retries=args.retries,
+        eventlog_dir=args.eventlog_dir,
+    )
+    done = set() if args.restart else load_checkpoint(args.output)
+    mode = "w" if args.restart else "a"
+    start = time.perf_counter()
+    reporter = asyncio.create_task(_report_periodically(anonymizer, start, args.report_every))
+    try:
+        with open(args.output, mode, encoding="utf-8") as output, open(
+            args.output + ".errors.jsonl", mode, encoding="utf-8"
+        ) as errors:
+            await anonymizer.run(read_records(args.inputs, args.format), done, output, errors)
+    finally:
+        reporter.cancel()
+        print(anonymizer.report(time.perf_counter() - start), file=sys.stderr)
+    return anonymizer
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="JSONL, text or serialized EventLog files")
+    parser.add_argument("--output", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--format", choices=["auto", "jsonl", "text", "eventlog"], default="auto")
+    parser.add_argument("--option", default="GPT-4o", help="pipeline option, see get_pipeline")
+    parser.add_argument("--workers", type=int, default=8, help="maximum number of concurrent LLM calls")
+    parser.add_argument("--max-tokens", type=int, help="token budget of a chunk, sized by the pipeline by default")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--eventlog-dir", help="where to write the anonymized EventLogs of eventlog inputs")
+    parser.add_argument("--restart", action="store_true", help="ignore the results of previous runs")
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between progress reports")
+    args = parser.parse_args(argv)
+
+    anonymizer = asyncio.run(run(args))
+    return 1 if anonymizer.stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,41 +1,128 @@
-from joblib import Memory
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
 
-cachedir = "cache"
-memory = Memory(cachedir, verbose=0)
+from openai import AsyncOpenAI
 
+from pseudoanonymize import metrics
+from pseudoanonymize.cache import InMemoryLRUCache, LLMCache, prompt_fingerprint
+from pseudoanonymize.singleflight import SingleFlight
 
-def make_chat_completion(
-    client,
+llm_cache: Optional[LLMCache] = InMemoryLRUCache()
+# Set while retrying an unparsable output, so the call samples a new response instead of reading the cached one.
+# The new response still replaces the cached one.
+bypass_llm_cache: ContextVar[bool] = ContextVar("bypass_llm_cache", default=False)
+# Identical chat completions in flight at the same time are sent once, see SingleFlight.
+llm_flights = SingleFlight("llm_call")
+
+
+@dataclass
+class LLMUsage:
+    """Counters of the chat completions made through `make_chat_completion` in the process."""
+
+    calls: int = 0
+    cached_calls: int = 0
+    prompt_tokens: int = 0
+    # prompt tokens read from the provider's prompt cache, i.e. the static prefix of the prompts
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def tokens_per_char(self) -> float:
+        """Prompt and completion tokens per character anonymized by the pipelines."""
+        chars = metrics.anonymized_chars.value()
+        return (self.prompt_tokens + self.completion_tokens) / chars if chars else 0.0
+
+
+llm_usage = LLMUsage()
+
+
+def set_llm_cache(cache: Optional[LLMCache]) -> None:
+    """
+    Set the cache used for LLM responses, or disable caching with None.
+    """
+    global llm_cache
+    llm_cache = cache
+
+
+async def make_chat_completion(
+    client: AsyncOpenAI,
     model: str,
     system_prompt: str,
     user_msg: str,
     temperature: float = 0.1,
     context_length: int = 4096,
     json_format: bool = False,
-):
-    @memory.cache
-    def call_client(
-        model: str,
-        system_prompt: str,
-        user_msg: str,
-        temperature: float = 0.1,
-        context_length: int = 4096,
-        json_format: bool = False,
-    ):
-        openai_kwargs = dict(
-            model=model,
-            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_msg}],
-            temperature=temperature,
-            max_tokens=context_length,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        if json_format:
-            openai_kwargs["response_format"] = {"type": "json_object"}
-        response = client.chat.completions.create(**openai_kwargs)
-        return response.choices[0].message.content
-
-    # Call the cached function. The internal function call_client was needed because we cannot cache client because it's an object.
-    # The caching is done based on the parameter level.
-    return call_client(model, system_prompt, user_msg, temperature, context_length, json_format)
+) -> str:
+    # The client is not part of the cache key because it's an object; caching is done on the parameter level.
+    cache = llm_cache
+    cache_key = prompt_fingerprint(model, system_prompt, user_msg, temperature, context_length, json_format)
+    if cache is not None and not bypass_llm_cache.get():
+        cached_response = await cache.get(cache_key)
+        if cached_response is not None:
+            llm_usage.cached_calls += 1
+            return cached_response
+
+    # a retry bypassing the cache wants a new response, it is only shared with the other retries
+    flight_key = cache_key + (":bypass" if bypass_llm_cache.get() else "")
+    return await llm_flights.do(
+        flight_key,
+        lambda: _send_chat_completion(
+            client, cache, cache_key, model, system_prompt, user_msg, temperature, context_length, json_format
+        ),
+    )
+
+
+async def _send_chat_completion(
+    client: AsyncOpenAI,
+    cache: Optional[LLMCache],
+    cache_key: str,
+    model: str,
+    system_prompt: str,
+    user_msg: str,
+    temperature: float,
+    context_length: int,
+    json_format: bool,
+) -> str:
+    openai_kwargs = dict(
+        model=model,
+        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_msg}],
+        temperature=temperature,
+        max_tokens=context_length,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+    )
+    if json_format:
+        openai_kwargs["response_format"] = {"type": "json_object"}
+    with metrics.stage_timer("llm_call"):
+        response = await client.chat.completions.create(**openai_kwargs)
+    content = response.choices[0].message.content
+    llm_usage.calls += 1
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        llm_usage.prompt_tokens += usage.prompt_tokens
+        llm_usage.completion_tokens += usage.completion_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        llm_usage.cached_prompt_tokens += getattr(details, "cached_tokens", None) or 0
+
+    if cache is not None and content is not None:
+        await cache.set(cache_key, content)
+    return content
+
+
+def _collect_llm_metrics():
+    yield "pii_llm_calls_total", "counter", "Chat completions sent to the LLM", llm_usage.calls
+    yield "pii_llm_cached_calls_total", "counter", "Chat completions answered by the LLM cache", llm_usage.cached_calls
+    yield "pii_llm_prompt_tokens_total", "counter", "Prompt tokens billed by the LLM", llm_usage.prompt_tokens
+    yield "pii_llm_cached_prompt_tokens_total", "counter", "Prompt tokens read from the provider's prompt cache", (
+        llm_usage.cached_prompt_tokens
+    )
+    yield "pii_llm_completion_tokens_total", "counter", "Completion tokens billed by the LLM", llm_usage.completion_tokens
+    yield "pii_llm_tokens_per_char", "gauge", "LLM tokens per anonymized character", llm_usage.tokens_per_char()
+    if llm_cache is not None:
+        yield "pii_llm_cache_hits_total", "counter", "Hits of the LLM cache", llm_cache.stats.hits
+        yield "pii_llm_cache_misses_total", "counter", "Misses of the LLM cache", llm_cache.stats.misses
+        yield "pii_llm_cache_evictions_total", "counter", "Evictions from the LLM cache", llm_cache.stats.evictions
+
+
+metrics.registry.add_collector(_collect_llm_metrics)
@@ -1,43 +1,241 @@
+import json
 import os
+from typing import Callable, Dict, Iterator
 
-import dspy
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from pseudoanonymize.anonymization import Anonymizer
+from pseudoanonymize import common
+from pseudoanonymize.base import BaseProcessor
+from pseudoanonymize.cache import build_llm_cache
+from pseudoanonymize.chunk_sizing import ChunkSizeController
+from pseudoanonymize.common import set_llm_cache
 from pseudoanonymize.deanonymization import Deanonymizer
 from pseudoanonymize.direct_json_anonymization import JSON_FEW_SHOT_PROMPT, JSON_SYSTEM_PROMPT, JsonDirectAnonymizer
-from pseudoanonymize.dspy_anonmization import DspyAnon
+from pseudoanonymize.logging_config import setup_logging
 from pseudoanonymize.pipeline import PiplelineAnon
-from pseudoanonymize.regex_anonymization import RegexAnon
+from pseudoanonymize.regex_anonymization import DEFAULT_DETECTORS, PatternRegistry, RegexAnon
+from pseudoanonymize.retry import RetryPolicy
+from pseudoanonymize.scheduler import ChunkScheduler
+from pseudoanonymize.shaping import RequestShaper, static_prefix
+from pseudoanonymize.state import build_state_store
+from pseudoanonymize.transport import HttpSettings, build_async_http_client, build_sync_http_client
+from pseudoanonymize.utils import get_encoding
 
 load_dotenv()
+# JSON logs on stdout, written by a background thread. LOG_SAMPLE_RATE keeps a fraction of the requests' logs
+# below WARNING, and conversation content is redacted from the logs unless LOG_REDACT_PII is "false".
+setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    sample_rate=float(os.getenv("LOG_SAMPLE_RATE", "1")),
+    redact_pii=os.getenv("LOG_REDACT_PII", "true").lower() != "false",
+)
 openai_api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_api_key)
-deanonymizer = Deanonymizer(client=client)
+# HTTP transport of the LLM calls, shared by the anonymizers and DSPy, see HttpSettings. OPENAI_BASE_URL points the
+# clients at another server, e.g. scripts/fake_openai_server.py.
+http_settings = HttpSettings(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "1000")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "100")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60")),
+    http2=os.getenv("HTTP2", "false").lower() == "true",
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5")),
+    read_timeout=float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "600")),
+    pool_timeout=float(os.getenv("HTTP_POOL_TIMEOUT_SECONDS", "600")),
+    base_url=os.getenv("OPENAI_BASE_URL") or None,
+)
 
 
-def get_pipeline(option: str) -> PiplelineAnon:
-    print("v2")
-    turbo = dspy.OpenAI(model='gpt-4o', max_tokens=4096, api_key=openai_api_key)
+def _openai_client() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=openai_api_key,
+        base_url=http_settings.base_url,
+        timeout=http_settings.timeout,
+        http_client=build_async_http_client(http_settings),
+    )
+
+
+client = _openai_client()
+# "local" generates the fake values of /deanonymize with Faker, "llm" asks the LLM for them.
+deanonymizer = Deanonymizer(client=client, mode=os.getenv("DEANONYMIZER_MODE", "local"))
+
+# LLM response cache, see build_llm_cache for the available backends.
+llm_cache_ttl = os.getenv("LLM_CACHE_TTL_SECONDS")
+set_llm_cache(
+    build_llm_cache(
+        os.getenv("LLM_CACHE_BACKEND", "memory"),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+        directory=os.getenv("LLM_CACHE_DIR", "cache/llm"),
+        max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(100 * 1024 * 1024))),
+        ttl=float(llm_cache_ttl) if llm_cache_ttl else None,
+        redis_url=os.getenv("REDIS_URL"),
+    )
+)
+
+# Identical LLM calls and requests in flight at the same time are run once, see SingleFlight.
+single_flight = os.getenv("SINGLE_FLIGHT", "true").lower() != "false"
+common.llm_flights.enabled = single_flight
+
+# Anonymized messages and placeholders of the conversations, for incremental calls of /anonymize_event_log.
+conversation_state_ttl = os.getenv("CONVERSATION_STATE_TTL_SECONDS", str(7 * 24 * 3600))
+state_store = build_state_store(
+    os.getenv("CONVERSATION_STATE_BACKEND", "memory"),
+    max_conversations=int(os.getenv("CONVERSATION_STATE_MAX_CONVERSATIONS", "256")),
+    ttl=float(conversation_state_ttl) if conversation_state_ttl else None,
+    redis_url=os.getenv("REDIS_URL"),
+)
+
+# Limits for the LLM calls fanned out from chunked requests, shared by the whole process.
+llm_max_in_flight = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+llm_max_fanout_per_request = int(os.getenv("LLM_MAX_FANOUT_PER_REQUEST", "4"))
+# Chunks anonymized ahead of the one being sent by the streaming endpoints, bounding their memory use.
+stream_window = int(os.getenv("STREAM_WINDOW", str(2 * llm_max_fanout_per_request)))
+
+
+def get_scheduler() -> ChunkScheduler:
+    return ChunkScheduler(max_in_flight=llm_max_in_flight, max_fanout_per_request=llm_max_fanout_per_request)
+
+
+# Retry policy of the pipelines. RETRY_ESCALATE_TO names the pipeline option used after RETRY_ESCALATE_AFTER
+# failed attempts, e.g. GPT-3.5-FT for GPT-4o, and RETRY_DEADLINE_SECONDS bounds the time spent per prediction.
+retry_deadline = os.getenv("RETRY_DEADLINE_SECONDS")
+retry_escalate_to = os.getenv("RETRY_ESCALATE_TO")
+retry_escalate_after = int(os.getenv("RETRY_ESCALATE_AFTER", "2"))
+# Anonymizers of a pipeline slower than this are skipped, falling back to the output of the others.
+stage_timeout = os.getenv("PIPELINE_STAGE_TIMEOUT_SECONDS")
+
+# Detectors of the regex anonymizer: a comma separated list of DEFAULT_DETECTORS names, plus extra detectors
+# given as a JSON object mapping names to patterns.
+regex_detectors = os.getenv("REGEX_DETECTORS", ",".join(DEFAULT_DETECTORS)).split(",")
+regex_extra_patterns = json.loads(os.getenv("REGEX_EXTRA_PATTERNS", "{}"))
+regex_registry = PatternRegistry.from_names(regex_detectors, regex_extra_patterns)
+
+
+def _dspy_anonymizer() -> BaseProcessor:
+    # DSPy takes seconds to import, so it is only loaded when its pipeline is used
+    import dspy
+    import openai
+
+    from pseudoanonymize.dspy_anonmization import DspyAnon
+
+    # DSPy calls the module-level OpenAI client, which is synchronous
+    openai.http_client = build_sync_http_client(http_settings)
+    openai.timeout = http_settings.timeout
+    turbo = dspy.OpenAI(model='gpt-4o', max_tokens=4096, api_key=openai_api_key, api_base=http_settings.base_url)
     dspy.settings.configure(lm=turbo)
+    return DspyAnon()
 
-    anonymizer = Anonymizer(client=client)
 
+def _direct_anonymizer_gpt4o() -> BaseProcessor:
     model_gpt4o = "gpt-4o"
     prompt_gpt4o = JSON_SYSTEM_PROMPT + JSON_FEW_SHOT_PROMPT
-    direct_anonymizer_gpt4o = JsonDirectAnonymizer(client=client, model=model_gpt4o, system_prompt=prompt_gpt4o)
+    return JsonDirectAnonymizer(client=client, model=model_gpt4o, system_prompt=prompt_gpt4o)
 
+
+def _direct_anonymizer_gpt35ft() -> BaseProcessor:
     model_gpt35ft = "ft:gpt-3.5-turbo-0125:slingshot-daniel:pii-dist-processed:9jcKs3kP"
     prompt_gpt35ft = JSON_SYSTEM_PROMPT
-    direct_anonymizer_gpt35ft = JsonDirectAnonymizer(client=client, model=model_gpt35ft, system_prompt=prompt_gpt35ft)
+    return JsonDirectAnonymizer(client=client, model=model_gpt35ft, system_prompt=prompt_gpt35ft)
+
+
+# The LLM anonymizer of each pipeline option, each one followed by the regex anonymizer.
+PIPELINE_ANONYMIZERS: Dict[str, Callable[[], BaseProcessor]] = {
+    "DSPyCOT": _dspy_anonymizer,
+    "GPT-4o": _direct_anonymizer_gpt4o,
+    "GPT-3.5-FT": _direct_anonymizer_gpt35ft,
+}
+
+# Request shaping, see RequestShaper: chunks are sized so that the static prompt prefix is at most
+# PROMPT_PREFIX_RATIO times the chunk, within [CHUNK_MIN_TOKENS, CHUNK_MAX_TOKENS]. Inputs of at most
+# SMALL_INPUT_TOKENS tokens go to the SMALL_INPUT_OPTION pipeline, whose prompt has no few-shot examples.
+# REQUEST_SHAPING=false keeps the fixed chunk sizes of the endpoints.
+request_shaping = os.getenv("REQUEST_SHAPING", "true").lower() != "false"
+prompt_prefix_ratio = float(os.getenv("PROMPT_PREFIX_RATIO", "1.0"))
+chunk_min_tokens = int(os.getenv("CHUNK_MIN_TOKENS", "1000"))
+chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "4000"))
+small_input_tokens = int(os.getenv("SMALL_INPUT_TOKENS", "0"))
+small_input_option = os.getenv("SMALL_INPUT_OPTION", "GPT-3.5-FT")
+# Once enough calls are observed, CHUNK_SIZE_ADAPTIVE picks the chunk size of each request from the latency and
+# unparsable-output rate of the model, within the same bounds (see ChunkSizeController). CHUNK_TOKENS_PIN fixes
+# the chunk size instead, e.g. for benchmarks.
+chunk_size_adaptive = os.getenv("CHUNK_SIZE_ADAPTIVE", "true").lower() != "false"
+chunk_tokens_pin = os.getenv("CHUNK_TOKENS_PIN")
+
+_pipelines: Dict[str, PiplelineAnon] = {}
+
+
+def _build_pipeline(option: str) -> PiplelineAnon:
+    timeout = float(stage_timeout) if stage_timeout else None
+    return PiplelineAnon([PIPELINE_ANONYMIZERS[option](), RegexAnon(regex_registry)], stage_timeout=timeout)
+
+
+def get_pipeline(option: str) -> PiplelineAnon:
+    """
+    Return the pipeline of an option, building it on first use. Only the anonymizers of the option (and of the
+    RETRY_ESCALATE_TO and SMALL_INPUT_OPTION options) are built, so unused options cost nothing at startup.
+    """
+    if option not in _pipelines:
+        pipeline = _build_pipeline(option)
+        escalate_to = None
+        if retry_escalate_to and retry_escalate_to != option:
+            escalate_to = _build_pipeline(retry_escalate_to)
+        pipeline.retry_policy = RetryPolicy(
+            deadline=float(retry_deadline) if retry_deadline else None,
+            escalate_to=escalate_to,
+            escalate_after=retry_escalate_after,
+        )
+        _pipelines[option] = pipeline
+        if request_shaping:
+            pipeline.shaper = RequestShaper(
+                prefix=static_prefix(pipeline.processors),
+                prefix_ratio=prompt_prefix_ratio,
+                min_chunk_tokens=chunk_min_tokens,
+                max_chunk_tokens=chunk_max_tokens,
+                small_input_tokens=small_input_tokens,
+                controller=(
+                    ChunkSizeController(pipeline.model_name, chunk_min_tokens, chunk_max_tokens)
+                    if chunk_size_adaptive
+                    else None
+                ),
+                pinned_chunk_tokens=int(chunk_tokens_pin) if chunk_tokens_pin else None,
+            )
+            if small_input_tokens and small_input_option != option:
+                pipeline.small_input_pipeline = get_pipeline(small_input_option)
+    return _pipelines[option]
+
+
+# Warm-up at startup: "none", "blocking" (before the app reports ready) or "background".
+warm_up_mode = os.getenv("WARM_UP", "none")
+
+
+def warm_up(option: str = "GPT-4o") -> None:
+    """
+    Build the pipeline of an option and load the tokenizer, so that the first request doesn't pay for them.
+    """
+    get_pipeline(option)
+    get_encoding()
+
 
-    dspy_anonymizer = DspyAnon()
+def _built_pipelines() -> Iterator[PiplelineAnon]:
+    for pipeline in _pipelines.values():
+        yield pipeline
+        if pipeline.retry_policy.escalate_to is not None:
+            yield pipeline.retry_policy.escalate_to
 
-    pipeline_options = {
-        "DSPyCOT": PiplelineAnon([dspy_anonymizer, RegexAnon()]),
-        "GPT-4o": PiplelineAnon([direct_anonymizer_gpt4o, RegexAnon()]),
-        "GPT-3.5-FT": PiplelineAnon([direct_anonymizer_gpt35ft, RegexAnon()]),
-    }
 
-    return pipeline_options[option]
+def setup_worker() -> None:
+    """
+    Set up a worker process forked from a process that already imported the app, e.g. the gunicorn master with
+    `preload_app` (see gunicorn.conf.py). The pipelines, prompts and tokenizer built before the fork are shared
+    with the other workers, but connections aren't, so the OpenAI client and the Redis connections of the LLM
+    cache and of the conversation states are created again in the worker.
+    """
+    global client
+    client = _openai_client()
+    deanonymizer.client = client
+    for pipeline in _built_pipelines():
+        for processor in pipeline.processors:
+            if getattr(processor, "client", None) is not None:
+                processor.client = client
+    if common.llm_cache is not None:
+        common.llm_cache.reconnect()
+    state_store.reconnect()
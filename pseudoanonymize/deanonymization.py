@@ -1,10 +1,12 @@
-from typing import Any, Dict, List
+import hashlib
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
 from faker import Faker
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from pseudoanonymize.base import BaseProcessor
 from pseudoanonymize.common import make_chat_completion
+from pseudoanonymize.registry import placeholder_category
 
 fake = Faker()
 
@@ -62,17 +64,131 @@ Expected output:
 """
 
 
+# Faker has no medical provider
+DRUGS = ("Atorvastatin", "Lisinopril", "Metformin", "Sertraline", "Omeprazole", "Amoxicillin", "Ibuprofen")
+CONDITIONS = ("asthma", "migraine", "hypertension", "eczema", "arthritis", "anemia", "insomnia")
+
+
+def _date(fake: Faker) -> str:
+    return fake.date(pattern="%B %d, %Y")
+
+
+def _term(fake: Faker) -> str:
+    return fake.word().capitalize()
+
+
+# Faker generator of each placeholder category. Categories are matched exactly first, then by the first
+# keyword made of whole words of the category (e.g. MOTHER_FIRST_NAME matches FIRST_NAME but ZIP_CODE doesn't
+# match IP), so specific keywords come first. NAME comes last, for the names of people: the names of things
+# (DRUG_NAME, PRODUCT_NAME...) match their own keyword first.
+SURROGATE_GENERATORS: Dict[str, Callable[[Faker], str]] = {
+    "EMAIL": lambda fake: fake.email(),
+    "PHONE": lambda fake: fake.phone_number(),
+    "FAX": lambda fake: fake.phone_number(),
+    "SSN": lambda fake: fake.ssn(),
+    "CREDIT_CARD": lambda fake: fake.credit_card_number(),
+    "ACCOUNT": lambda fake: fake.bban(),
+    "URL": lambda fake: fake.url(),
+    "IPV4": lambda fake: fake.ipv4(),
+    "IPV6": lambda fake: fake.ipv6(),
+    "IP": lambda fake: fake.ipv4(),
+    "ZIP": lambda fake: fake.postcode(),
+    "MRN": lambda fake: fake.bothify("MRN-########"),
+    "LICENSE": lambda fake: fake.bothify("??#######").upper(),
+    "FIRST_NAME": lambda fake: fake.first_name(),
+    "LAST_NAME": lambda fake: fake.last_name(),
+    "STREET": lambda fake: fake.street_address(),
+    "ADDRESS": lambda fake: fake.street_address(),
+    "CITY": lambda fake: fake.city(),
+    "TOWN": lambda fake: fake.city(),
+    "LOCATION": lambda fake: fake.city(),
+    "PLACE": lambda fake: fake.city(),
+    "NEIGHBORHOOD": lambda fake: fake.city(),
+    "STATE": lambda fake: fake.state(),
+    "COUNTRY": lambda fake: fake.country(),
+    "BIRTH": lambda fake: fake.date_of_birth().strftime("%B %d, %Y"),
+    "DATE": _date,
+    "AGE": lambda fake: str(fake.random_int(18, 89)),
+    "HOSPITAL": lambda fake: f"{fake.last_name()} Hospital",
+    "HOTEL": lambda fake: f"{fake.last_name()} Hotel",
+    "SCHOOL": lambda fake: f"{fake.last_name()} School",
+    "UNIVERSITY": lambda fake: f"University of {fake.city()}",
+    "COMPANY": lambda fake: fake.company(),
+    "ORGANIZATION": lambda fake: fake.company(),
+    "JOB": lambda fake: fake.job(),
+    "BOOK": lambda fake: fake.catch_phrase().title(),
+    "BAND": lambda fake: f"The {fake.word().capitalize()}s",
+    "DRUG": lambda fake: fake.random_element(DRUGS),
+    "MEDICATION": lambda fake: fake.random_element(DRUGS),
+    "MEDICINE": lambda fake: fake.random_element(DRUGS),
+    "DISEASE": lambda fake: fake.random_element(CONDITIONS),
+    "CONDITION": lambda fake: fake.random_element(CONDITIONS),
+    "DIAGNOSIS": lambda fake: fake.random_element(CONDITIONS),
+    "ILLNESS": lambda fake: fake.random_element(CONDITIONS),
+    "PRODUCT": _term,
+    "BRAND": _term,
+    "PROJECT": _term,
+    "TEAM": _term,
+    "EVENT": _term,
+    "USERNAME": lambda fake: fake.user_name(),
+    "PERSON": lambda fake: fake.first_name(),
+    "PATIENT": lambda fake: fake.first_name(),
+    "NAME": lambda fake: fake.first_name(),
+}
+
+
+class SurrogateGenerator:
+    """
+    Generates fake values for placeholders locally, without an LLM call.
+
+    Every placeholder is mapped to a Faker generator by its category and seeded with the conversation seed and the
+    placeholder itself, so the same placeholder always gets the same surrogate within a conversation, no matter in
+    which order or in which request it is seen.
+    """
+
+    def __init__(self, generators: Optional[Dict[str, Callable[[Faker], str]]] = None, faker: Faker = fake):
+        self.generators = generators if generators is not None else SURROGATE_GENERATORS
+        self.faker = faker
+
+    def _generator(self, category: str) -> Callable[[Faker], str]:
+        if category in self.generators:
+            return self.generators[category]
+        words = f"_{category}_"
+        for keyword, generator in self.generators.items():
+            if f"_{keyword}_" in words:
+                return generator
+        # unknown categories, e.g. UNIQUE_ACHIEVEMENT, get a neutral made-up term
+        return lambda fake: fake.word().capitalize()
+
+    def surrogate(self, placeholder: str, seed: str = "") -> str:
+        digest = hashlib.blake2b(f"{seed}:{placeholder}".encode("utf-8"), digest_size=8).digest()
+        self.faker.seed_instance(int.from_bytes(digest, "big"))
+        return self._generator(placeholder_category(placeholder))(self.faker)
+
+    def generate(self, placeholders: Iterable[str], seed: str = "") -> Dict[str, str]:
+        return {placeholder: self.surrogate(placeholder, seed) for placeholder in placeholders}
+
+
 class Deanonymizer(BaseProcessor):
-    def __init__(self, client: OpenAI):
+    """
+    Replaces the placeholders of an anonymized text with fake values.
+
+    In "local" mode the fake values come from the SurrogateGenerator, seeded with input_["conversation_id"] (or the
+    text if there is none). In "llm" mode they are generated by the LLM.
+    """
+
+    def __init__(self, client: AsyncOpenAI, mode: str = "local"):
         super().__init__(client)
         self.system_prompt = prompt
         self.context_length = 4096
         self.model = "gpt-4o"
         self.temperature = 0.1
+        self.mode = mode
+        self.surrogates = SurrogateGenerator()
 
-    def _deanon_text_llm_output(self, text: str, replacement_keys: List[str]) -> str:
+    async def _deanon_text_llm_output(self, text: str, replacement_keys: List[str]) -> str:
         user_msg = f"""input text:\n```\n{text}\n```\npii placeholders:\n```\n{replacement_keys}\n'''"""
-        return make_chat_completion(
+        return await make_chat_completion(
             self.client,
             self.model,
             system_prompt=self.system_prompt,
@@ -80,13 +196,16 @@ class Deanonymizer(BaseProcessor):
             context_length=self.context_length,
         )
 
-    def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
+    async def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
         text = input_["text"]
         anon_replacement_dict = input_["replacement_dict"]
         anon_replacement_keys = list(set(anon_replacement_dict.values()))
 
-        combined_output = self._deanon_text_llm_output(text, anon_replacement_keys)
-
-        replacement_dict = self._extract_and_parse_replacement_dict(combined_output)
+        if self.mode == "local":
+            seed = input_.get("conversation_id") or hashlib.sha256(text.encode("utf-8")).hexdigest()
+            replacement_dict = self.surrogates.generate(anon_replacement_keys, seed=seed)
+        else:
+            combined_output = await self._deanon_text_llm_output(text, anon_replacement_keys)
+            replacement_dict = self._extract_and_parse_replacement_dict(combined_output)
         deanonymized_text = self._parse_replacements(text, replacement_dict)
         return {"deanonymized_text": deanonymized_text}
@@ -1,6 +1,7 @@
 import json
 from typing import Any, Dict
 
+from pseudoanonymize import metrics
 from pseudoanonymize.base import BaseProcessor
 from pseudoanonymize.common import make_chat_completion
 from pseudoanonymize.exceptions import UnparsableLLMOutputException
@@ -209,8 +210,8 @@ class JsonDirectAnonymizer(BaseProcessor):
         self.model = model
         self.temperature = 0
 
-    def _identify_and_anonymize_pii(self, text: str) -> str:
-        return make_chat_completion(
+    async def _identify_and_anonymize_pii(self, text: str) -> str:
+        return await make_chat_completion(
             self.client,
             self.model,
             system_prompt=self.system_prompt,
@@ -230,9 +231,9 @@ class JsonDirectAnonymizer(BaseProcessor):
                 raise UnparsableLLMOutputException(e)
         return reversed_dict
 
-    def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
+    async def predict(self, input_: Dict[str, Any]) -> Dict[str, Any]:
         text = input_["text"]
-        raw_json_output = make_chat_completion(
+        raw_json_output = await make_chat_completion(
             self.client,
             self.model,
             system_prompt=self.system_prompt,
@@ -242,15 +243,16 @@ class JsonDirectAnonymizer(BaseProcessor):
         )
 
         # TOOD: add unit test to logic below.
-        try:
-            start_index = raw_json_output.find('{')
-            end_index = raw_json_output.rfind('}') + 1
-            json_part = raw_json_output[start_index:end_index]
-            replacement_dict = json.loads(json_part)
-        except Exception as e:
-            raise UnparsableLLMOutputException(e)
-        replacement_dict = self._reverse_dict(replacement_dict)
-        replacement_dict = flatten_replacement_dict(replacement_dict)
-        replacement_dict = {str(k): str(v) for k, v in replacement_dict.items()}
+        with metrics.stage_timer("parse"):
+            try:
+                start_index = raw_json_output.find('{')
+                end_index = raw_json_output.rfind('}') + 1
+                json_part = raw_json_output[start_index:end_index]
+                replacement_dict = json.loads(json_part)
+            except Exception as e:
+                raise UnparsableLLMOutputException(e)
+            replacement_dict = self._reverse_dict(replacement_dict)
+            replacement_dict = flatten_replacement_dict(replacement_dict)
+            replacement_dict = {str(k): str(v) for k, v in replacement_dict.items()}
         anonymized_text = self._parse_replacements(text, replacement_dict)
         return {"anonymized_text": anonymized_text, "replacement_dict": replacement_dict, "raw_output": raw_json_output}
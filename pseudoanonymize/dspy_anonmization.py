@@ -1,8 +1,14 @@
+import asyncio
+import logging
+
 import dspy
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from pseudoanonymize.base import BaseProcessor
 from pseudoanonymize.exceptions import UnparsableLLMOutputException
+from pseudoanonymize.replacement import get_replacement_matcher
+
+logger = logging.getLogger(__name__)
 
 
 class AnonSig(dspy.Signature):
@@ -102,7 +108,7 @@ class CoTAnon(dspy.Module):
         try:
             parse_att = eval(parse_att)
         except ValueError as e:
-            print(f"Error: {e}")
+            logger.error("Failed to parse the replacement dict: %s", e, extra={"model_output": str_dict})
             raise UnparsableLLMOutputException
         return parse_att
 
@@ -115,21 +121,19 @@ class CoTAnon(dspy.Module):
                 for key_instance in key:
                     cleaned_dict[key_instance] = replacement
 
-        sorted_keys = sorted(cleaned_dict.keys(), key=len, reverse=True)
-        for key in sorted_keys:
-            text = text.replace(key, str(cleaned_dict[key]))
-        return text
+        return get_replacement_matcher(cleaned_dict).replace(text)
 
 
 # %%
 class DspyAnon(BaseProcessor):
-    def __init__(self, client: OpenAI = None):
+    def __init__(self, client: AsyncOpenAI = None):
         self.model = CoTAnon()
         self.model.load("models/dspy_optimized_cot.json")
 
-    def predict(self, input_: dspy.Dict[str, dspy.Any]) -> dspy.Dict[str, dspy.Any]:
+    async def predict(self, input_: dspy.Dict[str, dspy.Any]) -> dspy.Dict[str, dspy.Any]:
         text = input_["text"]
-        prediction = self.model(text)
+        # DSPy only ships a synchronous client, so run it off the event loop.
+        prediction = await asyncio.to_thread(self.model, text)
         return {
             "replacement_dict": prediction.replacement_dictionary_all_potential,
             "anon_text": prediction.anon_text_safe,
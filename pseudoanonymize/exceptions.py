@@ -4,3 +4,11 @@ class UnparsableLLMOutputException(Exception):
 
 class MaxRetriesExceededException(Exception):
     pass
+
+
+class DeadlineExceededException(MaxRetriesExceededException):
+    pass
+
+
+class StageTimeoutException(Exception):
+    pass
@@ -0,0 +1,137 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import zlib
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+# Id of the request being handled, added to every log record. Set by the request middleware of the app;
+# tasks started while handling a request inherit it.
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Extra fields that can hold conversation content, logged only when PII redaction is off.
+SENSITIVE_FIELDS = {"text", "model_output", "replacement_dict"}
+
+# Attributes of every LogRecord, the other attributes are the `extra` fields of the logging call.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING. Records of a request are kept or dropped together, based on
+    a hash of the request id, so the logs of a sampled request are complete.
+    """
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.sample_rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        current_request_id = request_id.get()
+        if current_request_id is None:
+            return random.random() < self.sample_rate
+        return zlib.crc32(current_request_id.encode("utf-8")) / 2**32 < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the request id and the `extra` fields of the logging call,
+    e.g. `logger.info("chunk anonymized", extra={"duration_ms": 812})`.
+
+    With `redact_pii`, the message is anonymized with the regex anonymizer and the SENSITIVE_FIELDS are dropped.
+    """
+
+    def __init__(self, redact_pii: bool = True):
+        super().__init__()
+        self.redact_pii = redact_pii
+        self._regex_anonymizer = None
+
+    def _redact(self, message: str) -> str:
+        if self._regex_anonymizer is None:
+            from pseudoanonymize.regex_anonymization import RegexAnon
+
+            self._regex_anonymizer = RegexAnon()
+        return self._regex_anonymizer.anonymize(message)["anon_text_safe"]
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        entry: Dict[str, Any] = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{record.msecs:03.0f}Z",
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": self._redact(message) if self.redact_pii else message,
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key in _RECORD_ATTRIBUTES or key == "request_id":
+                continue
+            if self.redact_pii and key in SENSITIVE_FIELDS:
+                entry[key] = "[REDACTED]"
+            else:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _RequestQueueHandler(QueueHandler):
+    """Enqueues records for the listener thread, with the request id of the calling context."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id.get()
+        # formatting, redaction and I/O happen in the listener thread
+        return record
+
+
+def setup_logging(level: str = "INFO", sample_rate: float = 1.0, redact_pii: bool = True) -> None:
+    """
+    Send the logs of the process to stdout as JSON lines, through a queue: the logging calls only enqueue the
+    records and a background thread formats and writes them, so requests never wait on log I/O.
+    Only the first call configures logging, the next ones do nothing.
+
+    args:
+        level: the minimum level of the records
+        sample_rate: fraction of the records below WARNING that are kept, see SamplingFilter
+        redact_pii: remove conversation content from the logs, see JsonFormatter
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter(redact_pii=redact_pii))
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = _RequestQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_stop_listener)
+    # the thread writing the logs doesn't exist in a forked worker, e.g. with gunicorn's preload_app
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener = QueueListener(_listener.queue, *_listener.handlers)
+        _listener.start()
@@ -0,0 +1,86 @@
+"""
+The mapping between messages and the conversation made of them, without the protobufs, see `MessageIndex`.
+"""
+import bisect
+from typing import Iterable, Iterator, List, Tuple
+
+from pseudoanonymize import metrics
+
+
+class MessageIndex:
+    """
+    Where messages are in the conversation made of them, to anonymize the conversation and patch the anonymized
+    text back into the messages in place, without copying the protobuf they belong to.
+
+    The conversation has one line per non-empty message, with the whitespace of the message collapsed to single
+    spaces, so that every chunk of `chunk_by_line` (and of `chunk_by_word` for a message too long for one chunk)
+    is a substring of the conversation. A chunk is mapped to its messages by its offset in the conversation
+    rather than by counting the lines of the previous chunks, so a chunk whose lines don't match its messages
+    fails on its own instead of shifting every later message.
+
+    Example:
+    ```python
+    index = EventLogIndex(event_log)
+    chunks = chunk_by_line(index.conversation, 4000)
+    for span, chunk in zip(index.spans(chunks), chunks):
+        index.patch(span, anonymize(chunk))
+    index.apply()  # event_log now has the anonymized messages
+    ```
+    """
+
+    def __init__(self, messages: Iterable):
+        """
+        args:
+            messages: the messages with a `content`, e.g. protobufs, in the order of the conversation
+        """
+        # the non-empty messages and their start in the conversation, in order
+        self.messages = []
+        self.offsets: List[int] = []
+        lines = []
+        offset = 0
+        with metrics.stage_timer("protobuf_extract"):
+            for message in messages:
+                line = " ".join(message.content.split()) if message.content else ""
+                if not line:
+                    continue
+                self.messages.append(message)
+                self.offsets.append(offset)
+                lines.append(line)
+                offset += len(line) + 1
+        self.conversation = "\n".join(lines)
+        # anonymized pieces of each message, more than one if the message was split across chunks
+        self._pieces: List[List[str]] = [[] for _ in lines]
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def spans(self, chunks: Iterable[str]) -> List[Tuple[int, int]]:
+        """The (first, end) indices of the messages of each chunk, the chunks being in the order of the text."""
+        return list(self.iter_spans(chunks))
+
+    def iter_spans(self, chunks: Iterable[str]) -> Iterator[Tuple[int, int]]:
+        """Same as `spans`, one chunk at a time as they are consumed, e.g. while streaming."""
+        cursor = 0
+        for i, chunk in enumerate(chunks):
+            start = self.conversation.find(chunk, cursor)
+            if start < 0:
+                raise ValueError(f"Chunk {i} is not part of the conversation")
+            cursor = start + len(chunk)
+            yield bisect.bisect_right(self.offsets, start) - 1, bisect.bisect_left(self.offsets, cursor)
+
+    def patch(self, span: Tuple[int, int], anonymized_chunk: str) -> None:
+        """Record the anonymized text of the chunk with the messages `span`, one line per message."""
+        first, end = span
+        lines = anonymized_chunk.split("\n")
+        if len(lines) != end - first:
+            # The number of lines before and after anonymization should be the same
+            raise ValueError(f"Messages {first} to {end - 1} have {len(lines)} lines after anonymization")
+        for pieces, line in zip(self._pieces[first:end], lines):
+            pieces.append(line)
+
+    @metrics.timed("protobuf_update")
+    def apply_messages(self) -> None:
+        """Set the content of the patched messages, in place."""
+        for message, pieces in zip(self.messages, self._pieces):
+            if pieces:
+                message.content = " ".join(pieces)
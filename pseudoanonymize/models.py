@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 import humps
 from pydantic import BaseModel
@@ -26,6 +26,18 @@ class DeanonymizeRequest(CamelModel):
 class AnonymizeResponse(CamelModel):
     anonymized_text: str
     replacement_dict: Dict[str, str]
+    # True if a slow anonymizer was skipped, e.g. only the regex anonymizer was applied.
+    degraded: bool = False
+
+
+class AnonymizeBatchRequest(CamelModel):
+    texts: List[str]
+    retries: int = 5
+
+
+class AnonymizeBatchResponse(CamelModel):
+    # in the order of the request texts
+    results: List[AnonymizeResponse]
 
 
 class DeanonymizeResponse(CamelModel):
@@ -36,3 +48,26 @@ class PseudoanonymizeResponse(CamelModel):
     anonymized_text: str
     replacement_dict: Dict[str, str]
     deanonymized_text: str
+    degraded: bool = False
+
+
+class AnonymizeChunkEvent(CamelModel):
+    """A line of the NDJSON streaming endpoints, sent as soon as the chunk is anonymized."""
+
+    index: int
+    # index of the first line of the transcript in the chunk
+    first_line: int
+    anonymized_text: str
+    # entries of the replacement dict not sent in the previous events
+    replacement_dict_delta: Dict[str, str]
+    degraded: bool = False
+
+
+class AnonymizeStreamEnd(CamelModel):
+    """The last line of the NDJSON streaming endpoints."""
+
+    done: bool = True
+    chunks: int
+    degraded: bool = False
+    # set if the stream was interrupted, the events already sent are valid
+    error: str | None = None
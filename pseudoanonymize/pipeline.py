@@ -1,10 +1,32 @@
+import asyncio
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from pseudoanonymize import metrics
 from pseudoanonymize.base import BaseProcessor
+from pseudoanonymize.exceptions import StageTimeoutException, UnparsableLLMOutputException
+from pseudoanonymize.message_index import MessageIndex
+from pseudoanonymize.registry import EntityRegistry
+from pseudoanonymize.replacement import get_replacement_matcher
+from pseudoanonymize.scheduler import ChunkScheduler
+from pseudoanonymize.shaping import RequestShaper
+from pseudoanonymize.utils import chunk_by_line, chunk_by_word, count_openai_tokens, flatten_replacement_dict
+
+
+def _mentions(line: str, entity: str) -> bool:
+    """Whether the entity is in the line as a whole, e.g. "Al" isn't mentioned in "Albany"."""
+    return re.search(rf"(?<!\w){re.escape(entity)}(?!\w)", line) is not None
 
 
 class PiplelineAnon(BaseProcessor):
     """
     A pipeline that takes a list of anonymizers and chains them together.
 
+    Every anonymizer reads the original text, so they run concurrently and their replacement dicts are merged
+    in the order of `processors`. If `stage_timeout` is set, an anonymizer that takes longer is dropped and the
+    output is flagged as degraded, e.g. falling back to the regex anonymizer when the LLM is slow.
+
     Example:
     ```python
     from pseudoanonymize import PiplelineAnon
@@ -12,26 +34,59 @@ class PiplelineAnon(BaseProcessor):
     from pseudoanonymize.regex_anonymization import RegexAnon
     from pseudoanonymize.pipeline import PiplelineAnon
     model = PiplelineAnon([DspyAnon(), RegexAnon()])
-    output = model.predict(inp)
+    output = await model.predict(inp)
     """
 
-    def __init__(self, processors: list[BaseProcessor]):
+    def __init__(self, processors: list[BaseProcessor], stage_timeout: Optional[float] = None):
+        super().__init__(client=None)
         self.processors = processors
+        self.stage_timeout = stage_timeout
+        # sizes the chunks of `predict_chunked` and `predict_batch` and picks the pipeline of small inputs, see `plan`
+        self.shaper: Optional[RequestShaper] = None
+        self.small_input_pipeline: Optional["PiplelineAnon"] = None
 
-    def predict(self, input_, keep_ash=True):
-        output_dicts = []
+    @property
+    def model_name(self) -> str:
+        """The model of the LLM anonymizer of the pipeline, or the name of its first anonymizer."""
         for processor in self.processors:
-            output = processor.predict(input_)
+            if isinstance(getattr(processor, "model", None), str):
+                return processor.model
+        return self.processors[0].__class__.__name__ if self.processors else "none"
+
+    async def _run_stage(self, processor: BaseProcessor, input_) -> Optional[dict]:
+        """Run one anonymizer, returning None if it exceeds the stage timeout."""
+        try:
+            return await asyncio.wait_for(processor.predict(input_), self.stage_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def predict(self, input_, keep_ash=True):
+        start = time.perf_counter()
+        try:
+            outputs = await asyncio.gather(*(self._run_stage(processor, input_) for processor in self.processors))
+        except UnparsableLLMOutputException:
+            self._observe(input_["text"], time.perf_counter() - start, unparsable=True)
+            raise
+        self._observe(input_["text"], time.perf_counter() - start)
+
+        output_dicts = []
+        timed_out_stages = []
+        for processor, output in zip(self.processors, outputs):
+            if output is None:
+                timed_out_stages.append(processor.__class__.__name__)
+                continue
             replacement_dict = output["replacement_dict"]
             output_dicts.append(replacement_dict)
+        if timed_out_stages:
+            self.logger.warning("Pipeline stages timed out", extra={"timed_out_stages": timed_out_stages})
+        if not output_dicts:
+            raise StageTimeoutException(f"All pipeline stages exceeded the timeout of {self.stage_timeout}s")
 
         final_replace_dict = {}
         for replace_dict in output_dicts:
             final_replace_dict.update(replace_dict)
 
         # Don't anonymize keys that contain "ash" if keep_ash is True
-
-        print(final_replace_dict.keys())
         if keep_ash:
             keys = list(final_replace_dict.keys())
             for key in keys:
@@ -39,6 +94,181 @@ class PiplelineAnon(BaseProcessor):
                     del final_replace_dict[key]
 
         anonymized_text = self._parse_replacements(input_["text"], final_replace_dict)
+        metrics.anonymized_chars.inc(len(input_["text"]))
+        self.logger.debug(
+            "Chunk anonymized",
+            extra={
+                "chars": len(input_["text"]),
+                "replacements": len(final_replace_dict),
+                "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            },
+        )
         # return anonymized_text, output_dicts
         # return anonymized_text, final_replace_dict
-        return {"anonymized_text": anonymized_text, "replacement_dict": final_replace_dict}
+        return {
+            "anonymized_text": anonymized_text,
+            "replacement_dict": final_replace_dict,
+            "degraded": bool(timed_out_stages),
+            "timed_out_stages": timed_out_stages,
+        }
+
+    async def predict_chunk(self, chunk: str, registry: EntityRegistry, retries: Optional[int] = None) -> dict:
+        """
+        Anonymize a chunk of a longer text with the placeholders of the text's registry, so that an entity keeps
+        the same placeholder in every chunk whichever chunk finishes first.
+        """
+        prediction = await self.retry_prediction({"text": chunk}, retries)
+        replacement_dict = flatten_replacement_dict(prediction["replacement_dict"])
+        prediction["anonymized_text"], prediction["replacement_dict"] = registry.canonicalize(chunk, replacement_dict)
+        return prediction
+
+    def _observe(self, text: str, seconds: float, unparsable: bool = False) -> None:
+        """Report an attempt to the chunk size controller of the pipeline, if it has one."""
+        controller = self.shaper.controller if self.shaper is not None else None
+        if controller is not None:
+            controller.observe(count_openai_tokens(text), seconds, unparsable)
+
+    def plan(
+        self, text: str, max_tokens: Optional[int] = None, fanout: Optional[int] = None
+    ) -> Tuple["PiplelineAnon", List[str]]:
+        """
+        The pipeline anonymizing a text and the chunks of the text, by line.
+
+        Without a shaper, the text is split into chunks of `max_tokens` (2000 by default). With a shaper, small texts
+        go to `small_input_pipeline` and the chunks are sized and balanced by the shaper, up to `max_tokens` if given
+        and no smaller because of the prefix ratio. `fanout` is the number of chunks of the request running at a
+        time, see `RequestShaper.chunk_tokens`.
+        """
+        if self.shaper is None:
+            return self, chunk_by_line(text, max_tokens or 2000)
+        text_tokens = count_openai_tokens(text)
+        pipeline = self
+        if self.small_input_pipeline is not None and self.shaper.is_small(text_tokens):
+            pipeline = self.small_input_pipeline
+        chunk_tokens = self.shaper.chunk_tokens(text_tokens, fanout, max_tokens)
+        metrics.chunk_tokens.observe(chunk_tokens, model=self.model_name)
+        return pipeline, chunk_by_line(text, min(chunk_tokens, max_tokens) if max_tokens else chunk_tokens)
+
+    async def predict_chunked(
+        self,
+        text: str,
+        max_tokens: Optional[int] = None,
+        retries: Optional[int] = None,
+        scheduler: Optional[ChunkScheduler] = None,
+        index: Optional[MessageIndex] = None,
+    ) -> dict:
+        """
+        Anonymize a long text chunk by chunk, running the chunks concurrently (under the scheduler if given).
+        The chunks and the pipeline running them are chosen by `plan`.
+
+        If `index` is given, `text` is its conversation and every anonymized chunk is patched into the messages
+        of its span: a message split across chunks has one line per chunk in the anonymized text.
+        """
+        registry = EntityRegistry()
+        fanout = scheduler.max_fanout_per_request if scheduler is not None else None
+        pipeline, chunks = self.plan(text, max_tokens, fanout)
+        if scheduler is not None:
+            predictions = await scheduler.map(lambda chunk: pipeline.predict_chunk(chunk, registry, retries), chunks)
+        else:
+            predictions = await asyncio.gather(*(pipeline.predict_chunk(chunk, registry, retries) for chunk in chunks))
+        if index is not None and len(index):
+            for span, prediction in zip(index.spans(chunks), predictions):
+                index.patch(span, prediction["anonymized_text"])
+        return {
+            "anonymized_text": "\n".join(prediction["anonymized_text"] for prediction in predictions),
+            "replacement_dict": registry.replacement_dict,
+            "degraded": any(prediction["degraded"] for prediction in predictions),
+        }
+
+    async def predict_batch(
+        self,
+        texts: List[str],
+        max_tokens: Optional[int] = None,
+        retries: Optional[int] = None,
+        scheduler: Optional[ChunkScheduler] = None,
+    ) -> List[dict]:
+        """
+        Anonymize many texts with as few LLM calls as possible, e.g. archived conversations.
+
+        The lines of all the texts are deduplicated (boilerplate lines repeat across conversations) and packed into
+        shared chunks of up to `max_tokens` tokens. Each text is then anonymized with the replacements found in
+        the chunks holding its lines, renumbered per text so its placeholders start at 1 like a single prediction.
+
+        args:
+            texts: the texts to anonymize
+            max_tokens: the token budget of a chunk sent to the anonymizers, defaults to the shaper's target chunk
+                size, or 2000 without a shaper
+            retries: the number of retries of a chunk, see `retry_prediction`
+            scheduler: runs the chunks under its limits if given, otherwise they all run at once
+        """
+        if max_tokens is None:
+            max_tokens = self.shaper.target_chunk_tokens if self.shaper is not None else 2000
+        batch_chunks: List[str] = []
+        # line -> indices of the chunks holding it, more than one if the line alone is over the budget
+        line_chunks: Dict[str, List[int]] = {}
+        lines: List[str] = []
+        lines_tokens = 0
+
+        def close_chunk():
+            nonlocal lines, lines_tokens
+            if lines:
+                batch_chunks.append("\n".join(lines))
+            lines, lines_tokens = [], 0
+
+        for text in texts:
+            for line in text.split("\n"):
+                line = line.strip()
+                if not line or line in line_chunks:
+                    continue
+                # summing the counts of the lines is an upper bound of the count of the joined chunk
+                tokens = count_openai_tokens(line + "\n")
+                if tokens > max_tokens:
+                    close_chunk()
+                    pieces = chunk_by_word(line, max_tokens)
+                    line_chunks[line] = list(range(len(batch_chunks), len(batch_chunks) + len(pieces)))
+                    batch_chunks.extend(pieces)
+                    continue
+                if lines_tokens + tokens > max_tokens:
+                    close_chunk()
+                line_chunks[line] = [len(batch_chunks)]
+                lines.append(line)
+                lines_tokens += tokens
+        close_chunk()
+
+        async def anonymize_chunk(chunk: str) -> dict:
+            return await self.retry_prediction({"text": chunk}, retries)
+
+        if scheduler is not None:
+            predictions = await scheduler.map(anonymize_chunk, batch_chunks)
+        else:
+            predictions = await asyncio.gather(*(anonymize_chunk(chunk) for chunk in batch_chunks))
+        chunk_dicts = [flatten_replacement_dict(prediction["replacement_dict"]) for prediction in predictions]
+
+        outputs = []
+        for text in texts:
+            # chunk index -> the lines of the text in the chunk
+            text_lines: Dict[int, List[str]] = {}
+            for line in text.split("\n"):
+                line = line.strip()
+                for index in line_chunks.get(line, []) if line else []:
+                    text_lines.setdefault(index, []).append(line)
+            chunk_indices = sorted(text_lines)
+            registry = EntityRegistry()
+            replacement_dict = {}
+            for index in chunk_indices:
+                # a chunk mixes the lines of several texts, a text only keeps the entities found in its own lines
+                chunk_dict = {
+                    key: value
+                    for key, value in chunk_dicts[index].items()
+                    if key and any(_mentions(line, key) for line in text_lines[index])
+                }
+                # placeholders of different chunks are unrelated, so the chunks are registered one at a time
+                replacement_dict.update(registry.register(chunk_dict))
+            outputs.append(
+                {
+                    "anonymized_text": get_replacement_matcher(replacement_dict).replace(text),
+                    "replacement_dict": replacement_dict,
+                    "degraded": any(predictions[index]["degraded"] for index in chunk_indices),
+                }
+            )
+        return outputs
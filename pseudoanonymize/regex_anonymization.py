@@ -1,28 +1,153 @@
 import re
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
 
 from pseudoanonymize.base import BaseProcessor
 
 
+def luhn_checksum_is_valid(number: str) -> bool:
+    digits = [int(char) for char in number if char.isdigit()]
+    checksum = 0
+    for i, digit in enumerate(reversed(digits)):
+        if i % 2 == 1:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        checksum += digit
+    return checksum % 10 == 0
+
+
+@dataclass(frozen=True)
+class PatternDetector:
+    name: str
+    pattern: str
+    # optional check run on every match, e.g. the Luhn checksum of a credit card number
+    validator: Optional[Callable[[str], bool]] = None
+
+
+# Detectors are tried in this order at every position, so more specific patterns come first.
+DEFAULT_DETECTORS: Dict[str, PatternDetector] = {
+    detector.name: detector
+    for detector in [
+        PatternDetector("email", r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b"),
+        PatternDetector("url", r"\b(?:https?://|www\.)[^\s<>\"']+[^\s<>\"'.,;:!?)\]]"),
+        PatternDetector("ipv6", r"\b(?:[0-9A-Fa-f]{1,4}:){7}[0-9A-Fa-f]{1,4}\b"),
+        PatternDetector(
+            "ipv4",
+            r"\b(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\b",
+        ),
+        PatternDetector("credit_card", r"\b(?:\d[ -]?){12,18}\d\b", validator=luhn_checksum_is_valid),
+        PatternDetector("ssn", r"\b(?!000|666|9\d\d)\d{3}-(?!00)\d{2}-(?!0000)\d{4}\b"),
+        PatternDetector("phone", r"(?:\(\d{3}\)|\b\d{3})[-\s]?\d{3}[-\s]?\d{4}\b"),
+        PatternDetector("mrn", r"\bMRN[:#\s-]*\d{5,10}\b"),
+        PatternDetector(
+            "date",
+            r"\b(?:\d{1,2}[/-]\d{1,2}[/-](?:\d{4}|\d{2})|\d{4}-\d{2}-\d{2}"
+            r"|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.? \d{1,2}(?:st|nd|rd|th)?,? \d{4})\b",
+        ),
+        # a bare 5 digit number is too ambiguous, so ZIP codes need the +4 part or to follow a state or "zip"
+        PatternDetector(
+            "zip",
+            r"\b(?=\d{5})(?:\d{5}-\d{4}|(?:(?<=\b[A-Z]{2} )|(?<=\b[Zz]ip )|(?<=\bZIP )|(?<=\b[Zz]ip code )|(?<=\bZIP code ))\d{5})\b",
+        ),
+    ]
+}
+
+
+@dataclass(frozen=True)
+class Detection:
+    start: int
+    end: int
+    label: str
+    text: str
+
+
+class PatternRegistry:
+    """
+    Compiles detectors into a single alternation of named groups, so a text is scanned once with `finditer`
+    whatever the number of detectors. Detections are returned as spans of the text.
+    Matches can only start at the beginning of a word (or on a non-word character such as "(").
+
+    Example:
+    ```python
+    registry = PatternRegistry.from_names(["email", "phone"], extra_patterns={"employee_id": r"\bEMP-\d{6}\b"})
+    registry.detect("Reach EMP-123456 at 555-123-4567")
+    ```
+    """
+
+    def __init__(self, detectors: Iterable[PatternDetector]):
+        self.detectors = {detector.name: detector for detector in detectors}
+        self.pattern = self._compile(self.detectors.values())
+        # names of the detectors left out -> the pattern of the other detectors, see `detect`
+        self._fallback_patterns: Dict[FrozenSet[str], Optional[re.Pattern]] = {}
+
+    @staticmethod
+    def _compile(detectors: Iterable[PatternDetector]) -> re.Pattern:
+        alternation = "|".join(f"(?P<{detector.name}>{detector.pattern})" for detector in detectors)
+        # `re` tries every alternative at every position, so skip positions inside a word up front
+        return re.compile(rf"(?<!\w)(?:{alternation})")
+
+    def _without(self, excluded: FrozenSet[str]) -> Optional[re.Pattern]:
+        if excluded not in self._fallback_patterns:
+            detectors = [detector for name, detector in self.detectors.items() if name not in excluded]
+            self._fallback_patterns[excluded] = self._compile(detectors) if detectors else None
+        return self._fallback_patterns[excluded]
+
+    def _is_valid(self, match: re.Match) -> bool:
+        validator = self.detectors[match.lastgroup].validator
+        return validator is None or validator(match.group())
+
+    @classmethod
+    def from_names(cls, names: Iterable[str], extra_patterns: Optional[Dict[str, str]] = None) -> "PatternRegistry":
+        """
+        Build a registry from the names of default detectors, followed by extra detectors given as name -> pattern.
+        """
+        detectors = [DEFAULT_DETECTORS[name] for name in names]
+        detectors += [PatternDetector(name, pattern) for name, pattern in (extra_patterns or {}).items()]
+        return cls(detectors)
+
+    def detect(self, text: str) -> List[Detection]:
+        detections = []
+        position = 0
+        while (match := self.pattern.search(text, position)) is not None:
+            start = match.start()
+            excluded = frozenset()
+            while match is not None and not self._is_valid(match):
+                # the other detectors can still match here, e.g. a phone number followed by digits is a run of
+                # digits failing the Luhn check of the credit cards
+                excluded |= {match.lastgroup}
+                pattern = self._without(excluded)
+                match = pattern.match(text, start) if pattern is not None else None
+            if match is None:
+                # nothing valid starts here, but a detection can start inside the rejected match
+                position = start + 1
+                continue
+            detections.append(Detection(match.start(), match.end(), match.lastgroup, match.group()))
+            position = match.end()
+        return detections
+
+
 class RegexAnon(BaseProcessor):
-    def __init__(self):
-        # Initialize regex patterns for anonymization
-        self.patterns = {
-            "email": r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b",
-            "phone": r"\b\(?\d{3}\)?[-\s]?\d{3}[-\s]?\d{4}\b",
-            "ipv4": r"\b(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\b",
-            "ipv6": r"\b(?:[0-9A-Fa-f]{1,4}:){7}[0-9A-Fa-f]{1,4}\b",
-        }
+    def __init__(self, registry: Optional[PatternRegistry] = None):
+        self.registry = registry or PatternRegistry(DEFAULT_DETECTORS.values())
 
-    def predict(self, input_: dict) -> dict:
-        text = input_["text"]
-        anon_text_safe = text
+    def anonymize(self, text: str) -> dict:
+        detections = self.registry.detect(text)
+        parts = []
+        end = 0
         replacement_dictionary_all_potential = {}
+        for detection in detections:
+            placeholder = f"<{detection.label}>"
+            parts.append(text[end : detection.start])
+            parts.append(placeholder)
+            end = detection.end
+            replacement_dictionary_all_potential[detection.text] = placeholder
+        parts.append(text[end:])
+        return {
+            "anon_text_safe": "".join(parts),
+            "replacement_dict": replacement_dictionary_all_potential,
+            "detections": detections,
+        }
 
-        for key, pattern in self.patterns.items():
-            matches = re.findall(pattern, text)
-            for match in matches:
-                placeholder = f"<{key}>"
-                anon_text_safe = anon_text_safe.replace(match, placeholder)
-                replacement_dictionary_all_potential[match] = placeholder
-
-        return {"anon_text_safe": anon_text_safe, "replacement_dict": replacement_dictionary_all_potential}
+    async def predict(self, input_: dict) -> dict:
+        return self.anonymize(input_["text"])
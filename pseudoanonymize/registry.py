@@ -0,0 +1,173 @@
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from pseudoanonymize.replacement import get_replacement_matcher
+
+
+def placeholder_category(placeholder: str) -> str:
+    """
+    The category of a placeholder, e.g. FIRST_NAME for "[FIRST_NAME_1]", NAME for "[NAME1]" and EMAIL for "<email>".
+    """
+    category = placeholder.strip().strip("[]<>").upper()
+    return re.sub(r"[\s_]*\d+$", "", category).replace(" ", "_")
+
+
+def normalize_mention(mention: str) -> str:
+    """Case and whitespace insensitive form of a mention, used to recognize the same entity across chunks."""
+    return " ".join(mention.casefold().split()).strip(".,;:!?\"'()")
+
+
+def _edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions and adjacent transpositions
+    ("Jhon" -> "John") each cost 1. Returns max_distance + 1 as soon as the distance is known to exceed it.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def _is_inner_edit(a: str, b: str) -> bool:
+    """
+    Whether the mentions differ by one swap of adjacent letters, or one letter inserted or deleted, away from the
+    last letter, where names differ from their variants (e.g. "Daniel" and "Daniela", "Christian" and "Christina").
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return i + 2 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2 :] == b[i + 2 :]
+    return len(b) == len(a) + 1 and i < len(a) and a[i:] == b[i + 1 :]
+
+
+def is_typo_of(a: str, b: str) -> bool:
+    """
+    Whether two normalized mentions are likely spellings of the same entity. A single substitution turns many
+    names into other names (e.g. "Mark" and "Mary", "Christina" and "Christine"), so below 10 letters mentions are
+    only matched on swapped letters and, from 6 letters, on a missing or extra letter that isn't the last one.
+    """
+    length = min(len(a), len(b))
+    if a == b:
+        return True
+    if length < 4 or a[0] != b[0]:
+        return False
+    if length < 6:
+        return sorted(a) == sorted(b) and _edit_distance(a, b, 1) == 1
+    if length < 10:
+        return _is_inner_edit(a, b)
+    return _edit_distance(a, b, 2) <= 2
+
+
+class EntityRegistry:
+    """
+    The placeholders of a conversation, shared by the workers anonymizing its chunks.
+
+    Every chunk is anonymized on its own, so the same entity can get different placeholders in different chunks.
+    `canonicalize` registers the replacement dict of a chunk: mentions already known (ignoring case, and typos
+    within a category) keep their placeholder, new entities get the next id of their category, and the chunk is
+    re-anonymized with the canonical placeholders. Placeholders never change once handed out, so chunks can
+    finish in any order.
+
+    Placeholders without an id, like the "<email>" of the regex anonymizer, are kept as they are.
+
+    Example:
+    ```python
+    registry = EntityRegistry()
+    registry.canonicalize("Hi Alex", {"Alex": "[NAME_1]"})  # ("Hi [NAME_1]", {"Alex": "[NAME_1]"})
+    registry.canonicalize("Bo and alex", {"Bo": "[NAME_1]", "alex": "[NAME_2]"})
+    # ("[NAME_2] and [NAME_1]", {"Bo": "[NAME_2]", "alex": "[NAME_1]"})
+    ```
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # mention as it appears in the text -> canonical placeholder
+        self._mentions: Dict[str, str] = {}
+        # normalized mention -> canonical placeholder
+        self._entities: Dict[str, str] = {}
+        # category -> normalized mentions of the category, for typo matching
+        self._by_category: Dict[str, List[str]] = {}
+        # category -> last id handed out
+        self._counters: Dict[str, int] = {}
+
+    @property
+    def replacement_dict(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._mentions)
+
+    def _find(self, normalized: str, category: str) -> Optional[str]:
+        if normalized in self._entities:
+            return self._entities[normalized]
+        for known in self._by_category.get(category, []):
+            if is_typo_of(normalized, known):
+                return self._entities[known]
+        return None
+
+    def _allocate(self, placeholder: str, category: str) -> str:
+        if not re.search(r"\d+\W*$", placeholder):
+            return placeholder
+        self._counters[category] = self._counters.get(category, 0) + 1
+        return f"[{category}_{self._counters[category]}]"
+
+    def _add(self, mention: str, normalized: str, category: str, canonical: str) -> None:
+        self._mentions[mention] = canonical
+        if normalized not in self._entities:
+            self._entities[normalized] = canonical
+            self._by_category.setdefault(category, []).append(normalized)
+
+    def register(self, replacement_dict: Dict[str, str]) -> Dict[str, str]:
+        """
+        Register the replacement dict of a chunk, returning it with canonical placeholders.
+        """
+        groups: Dict[str, List[str]] = {}
+        for mention, placeholder in replacement_dict.items():
+            if mention:
+                groups.setdefault(placeholder, []).append(mention)
+
+        canonical_dict = {}
+        with self._lock:
+            for placeholder, mentions in groups.items():
+                category = placeholder_category(placeholder)
+                normalized = [normalize_mention(mention) for mention in mentions]
+                # the mentions a chunk gives the same placeholder are the same entity
+                known = (self._find(norm, category) for norm in normalized)
+                canonical = next((found for found in known if found), None) or self._allocate(placeholder, category)
+                for mention, norm in zip(mentions, normalized):
+                    self._add(mention, norm, category, canonical)
+                    canonical_dict[mention] = canonical
+        return canonical_dict
+
+    def canonicalize(self, text: str, replacement_dict: Dict[str, str]) -> Tuple[str, Dict[str, str]]:
+        """
+        Register the replacement dict of a chunk and anonymize the original text of the chunk with the canonical
+        placeholders.
+        """
+        canonical_dict = self.register(replacement_dict)
+        return get_replacement_matcher(canonical_dict).replace(text), canonical_dict
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"mentions": dict(self._mentions), "counters": dict(self._counters)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EntityRegistry":
+        registry = cls()
+        registry._counters = dict(data.get("counters", {}))
+        for mention, canonical in data.get("mentions", {}).items():
+            registry._add(mention, normalize_mention(mention), placeholder_category(canonical), canonical)
+        return registry
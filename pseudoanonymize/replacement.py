@@ -0,0 +1,96 @@
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Tuple
+
+
+def _build_trie(keys: Iterable[str]) -> dict:
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[""] = True  # marks the end of a key
+    return trie
+
+
+def _follow_chain(node: dict) -> Tuple[str, dict]:
+    """The characters of the nodes with a single child that don't end a key, and the node they lead to."""
+    chars = []
+    while len(node) == 1 and "" not in node:
+        ((char, node),) = node.items()
+        chars.append(char)
+    return "".join(chars), node
+
+
+def _trie_to_pattern(trie: dict) -> str:
+    """
+    Convert a trie into a regex that matches the longest key starting at a given position.
+    Deeper branches are tried before stopping at a shorter key, so the first match found is the longest.
+
+    The nodes are visited with a stack rather than recursively, and runs of nodes with a single child are
+    escaped at once, so a key of thousands of characters (e.g. a paragraph returned as an entity) neither hits
+    the recursion limit nor takes quadratic time.
+    """
+    # the pattern of every visited node, by id, children before their parent
+    patterns: Dict[int, str] = {}
+    stack = [(trie, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((_follow_chain(child)[1], False) for char, child in node.items() if char)
+            continue
+        branches = []
+        for char, child in sorted(node.items()):
+            if char:
+                chain, end = _follow_chain(child)
+                branches.append(re.escape(char + chain) + patterns[id(end)])
+        if not branches:
+            pattern = ""
+        elif len(branches) == 1 and "" not in node:
+            pattern = branches[0]
+        else:
+            pattern = "(?:" + "|".join(branches) + ")"
+            pattern = pattern + "?" if "" in node else pattern
+        patterns[id(node)] = pattern
+    return patterns[id(trie)]
+
+
+class ReplacementMatcher:
+    """
+    Replaces every key of a replacement dict with its value in a single scan of the text.
+
+    The keys are compiled into one trie-shaped regex (the Aho-Corasick idea, executed by the C regex
+    engine), so matching is leftmost-longest: at each position the longest key wins, and text that
+    was already replaced is never matched again (e.g. a key that is a substring of "[NAME_1]").
+
+    Example:
+    ```python
+    matcher = ReplacementMatcher({"Alex": "[NAME_1]", "Alex Smith": "[NAME_2]"})
+    matcher.replace("Alex Smith and Alex")  # "[NAME_2] and [NAME_1]"
+    ```
+    """
+
+    def __init__(self, replacement_dict: Dict[str, str]):
+        # empty keys would match between every character, so they are ignored
+        self.replacement_dict = {str(key): str(value) for key, value in replacement_dict.items() if key}
+        self.pattern = (
+            re.compile(_trie_to_pattern(_build_trie(self.replacement_dict))) if self.replacement_dict else None
+        )
+
+    def replace(self, text: str) -> str:
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(lambda match: self.replacement_dict[match.group(0)], text)
+
+
+@lru_cache(maxsize=256)
+def _cached_matcher(items: FrozenSet[Tuple[str, str]]) -> ReplacementMatcher:
+    return ReplacementMatcher(dict(items))
+
+
+def get_replacement_matcher(replacement_dict: Dict[str, str]) -> ReplacementMatcher:
+    """
+    Return a compiled matcher for the replacement dict, compiling it only once per distinct dict.
+    """
+    return _cached_matcher(frozenset((str(key), str(value)) for key, value in replacement_dict.items()))
@@ -0,0 +1,47 @@
+import random
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, Tuple, Type
+
+import openai
+
+if TYPE_CHECKING:
+    from pseudoanonymize.base import BaseProcessor
+
+# Errors worth retrying after a pause: rate limits, 5xx responses, timeouts and dropped connections.
+RETRYABLE_API_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How `BaseProcessor.retry_prediction` retries a failed prediction.
+
+    - An unparsable LLM output is retried immediately with the LLM response cache bypassed, so the
+      retry samples a new answer instead of replaying the cached bad one.
+    - Rate-limit, 5xx and connection errors are retried after an exponential backoff with full jitter.
+    - After `escalate_after` failed attempts, the remaining attempts use `escalate_to` instead,
+      e.g. the pipeline of a different model.
+    - `deadline` bounds the total time spent, in seconds, including backoff.
+    """
+
+    max_retries: int = 5
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    deadline: Optional[float] = None
+    escalate_to: Optional["BaseProcessor"] = None
+    escalate_after: int = 2
+    retryable_errors: Tuple[Type[Exception], ...] = RETRYABLE_API_ERRORS
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait after the given (1-based) failed attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
+@dataclass
+class AttemptRecord:
+    attempt: int
+    processor: str
+    outcome: str  # "success", "unparsable", "api_error" or "deadline_exceeded"
+    duration_seconds: float
+    bypassed_cache: bool
+    error: Optional[str] = None
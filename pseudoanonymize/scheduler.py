@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Iterable, List, Optional
+
+
+@dataclass
+class SchedulerStats:
+    jobs_submitted: int = 0
+    jobs_completed: int = 0
+    jobs_failed: int = 0
+    wait_seconds_sum: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+@dataclass
+class _Job:
+    fn: Callable[[Any], Awaitable[Any]]
+    item: Any
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class _RequestQueue:
+    def __init__(self, max_fanout: int):
+        self.max_fanout = max_fanout
+        self.pending: Deque[_Job] = deque()
+        self.running: set = set()
+
+    @property
+    def eligible(self) -> bool:
+        return bool(self.pending) and len(self.running) < self.max_fanout
+
+
+class ChunkScheduler:
+    """
+    A process-wide scheduler for the LLM calls fanned out from chunked requests.
+
+    Every request gets its own queue of jobs. Jobs are started round-robin across the request
+    queues, so a huge transcript cannot starve small ones, while keeping at most `max_in_flight`
+    jobs running in the process and at most `max_fanout_per_request` jobs running per request.
+
+    Example:
+    ```python
+    scheduler = ChunkScheduler(max_in_flight=16, max_fanout_per_request=4)
+    predictions = await scheduler.map(lambda chunk: pipeline.retry_prediction({"text": chunk}), chunks)
+    ```
+    """
+
+    def __init__(self, max_in_flight: int = 16, max_fanout_per_request: int = 4):
+        self.max_in_flight = max_in_flight
+        self.max_fanout_per_request = max_fanout_per_request
+        self.stats = SchedulerStats()
+        self._queues: Deque[_RequestQueue] = deque()
+        self._in_flight = 0
+
+    async def map(
+        self, fn: Callable[[Any], Awaitable[Any]], items: Iterable[Any], max_fanout: Optional[int] = None
+    ) -> List[Any]:
+        """
+        Run `fn` on every item under the scheduler's limits and return the results in item order.
+        If one job fails, the remaining jobs of the request are cancelled and the error is raised.
+
+        args:
+            fn: an async function called with a single item
+            items: the items to process, e.g. the chunks of a transcript
+            max_fanout: overrides the per-request fan-out limit, capped by `max_fanout_per_request`
+        """
+        fanout = min(max_fanout or self.max_fanout_per_request, self.max_fanout_per_request)
+        queue = _RequestQueue(fanout)
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item in items:
+            job = _Job(fn, item, loop.create_future())
+            queue.pending.append(job)
+            futures.append(job.future)
+        self.stats.jobs_submitted += len(futures)
+
+        self._queues.append(queue)
+        try:
+            self._dispatch()
+            return await asyncio.gather(*futures)
+        finally:
+            self._close(queue, futures)
+
+    async def imap(
+        self,
+        fn: Callable[[Any], Awaitable[Any]],
+        items: Iterable[Any],
+        max_fanout: Optional[int] = None,
+        window: Optional[int] = None,
+    ) -> AsyncIterator[Any]:
+        """
+        Like `map`, but yields the results in item order as soon as they are ready, for streaming responses.
+
+        Items are pulled lazily and at most `window` of them are submitted ahead of the last yielded result,
+        so a slow consumer holds back the work and the memory used stays bounded whatever the number of items.
+
+        args:
+            fn: an async function called with a single item
+            items: the items to process, can be a generator
+            max_fanout: overrides the per-request fan-out limit, capped by `max_fanout_per_request`
+            window: the number of items processed ahead of the consumer, defaults to twice the fan-out
+        """
+        fanout = min(max_fanout or self.max_fanout_per_request, self.max_fanout_per_request)
+        window = window or 2 * fanout
+        queue = _RequestQueue(fanout)
+        loop = asyncio.get_running_loop()
+        items = iter(items)
+        futures: Deque[asyncio.Future] = deque()
+
+        self._queues.append(queue)
+        try:
+            while True:
+                for item in itertools.islice(items, window - len(futures)):
+                    job = _Job(fn, item, loop.create_future())
+                    queue.pending.append(job)
+                    futures.append(job.future)
+                    self.stats.jobs_submitted += 1
+                if not futures:
+                    return
+                self._dispatch()
+                yield await futures.popleft()
+        finally:
+            self._close(queue, futures)
+
+    def metrics(self) -> dict:
+        completed = self.stats.jobs_completed + self.stats.jobs_failed
+        return {
+            "queue_depth": sum(len(queue.pending) for queue in self._queues),
+            "in_flight": self._in_flight,
+            "active_requests": len(self._queues),
+            "jobs_submitted": self.stats.jobs_submitted,
+            "jobs_completed": self.stats.jobs_completed,
+            "jobs_failed": self.stats.jobs_failed,
+            "wait_seconds_sum": self.stats.wait_seconds_sum,
+            "wait_seconds_avg": self.stats.wait_seconds_sum / completed if completed else 0.0,
+            "wait_seconds_max": self.stats.wait_seconds_max,
+        }
+
+    def _close(self, queue: _RequestQueue, futures: Iterable[asyncio.Future]) -> None:
+        """Remove a request from the scheduler, cancelling its jobs that are still pending or running."""
+        self._queues.remove(queue)
+        queue.pending.clear()
+        for task in queue.running:
+            task.cancel()
+        for future in futures:
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                # mark exceptions as retrieved, only the first one is raised
+                future.exception()
+
+    def _dispatch(self) -> None:
+        """Start jobs round-robin across the request queues until the global limit is reached."""
+        idle_queues = 0
+        while self._in_flight < self.max_in_flight and self._queues and idle_queues < len(self._queues):
+            queue = self._queues[0]
+            self._queues.rotate(-1)
+            if not queue.eligible:
+                idle_queues += 1
+                continue
+            idle_queues = 0
+            self._start(queue, queue.pending.popleft())
+
+    def _start(self, queue: _RequestQueue, job: _Job) -> None:
+        wait_seconds = time.perf_counter() - job.enqueued_at
+        self.stats.wait_seconds_sum += wait_seconds
+        self.stats.wait_seconds_max = max(self.stats.wait_seconds_max, wait_seconds)
+        self._in_flight += 1
+        task = asyncio.ensure_future(self._run(job))
+        queue.running.add(task)
+        task.add_done_callback(lambda task: self._finish(queue, task))
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            result = await job.fn(job.item)
+        except Exception as e:
+            self.stats.jobs_failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.stats.jobs_completed += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def _finish(self, queue: _RequestQueue, task: asyncio.Task) -> None:
+        self._in_flight -= 1
+        queue.running.discard(task)
+        self._dispatch()
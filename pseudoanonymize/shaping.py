@@ -0,0 +1,82 @@
+import math
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Iterable, Optional
+
+from pseudoanonymize.chunk_sizing import ChunkSizeController
+from pseudoanonymize.utils import count_openai_tokens
+
+
+def static_prefix(processors: Iterable[object]) -> str:
+    """
+    The text sent before the input in the LLM calls of the processors: their system prompts, which are the same
+    for every call so that the provider's prompt caching can reuse them.
+    """
+    return "".join(getattr(processor, "system_prompt", "") for processor in processors)
+
+
+@dataclass
+class RequestShaper:
+    """
+    Sizes the chunks of a text from the cost of the static prompt prefix of the pipeline.
+
+    Every chunk pays for the prefix (the system prompt and few-shot examples), so chunks are made big enough that
+    the prefix is at most `prefix_ratio` times the tokens of the chunk, within [min_chunk_tokens, max_chunk_tokens].
+    A text is then split into the fewest chunks of about that size and the chunks are balanced, instead of
+    leaving a small last chunk that pays the whole prefix for a few lines.
+
+    Texts of at most `small_input_tokens` tokens are better sent to a pipeline with a shorter prompt, e.g. the
+    fine-tuned model that doesn't need the few-shot examples, see `PiplelineAnon.plan`.
+
+    Example: with the 2179 tokens of the GPT-4o prompt and a ratio of 1, a text of 2500 tokens is sent as two chunks
+    of ~1250 tokens rather than chunks of 2000 and 500 tokens.
+
+    With a `controller`, the chunk size of a request is the one the controller expects to finish first given the
+    fan-out of the request, once it has observed enough calls (see ChunkSizeController). `pinned_chunk_tokens`
+    overrides both, e.g. to compare sizes in a benchmark.
+    """
+
+    prefix: str = field(repr=False)
+    prefix_ratio: float = 1.0
+    min_chunk_tokens: int = 1000
+    max_chunk_tokens: int = 4000
+    small_input_tokens: int = 0
+    controller: Optional[ChunkSizeController] = None
+    pinned_chunk_tokens: Optional[int] = None
+
+    @cached_property
+    def prefix_tokens(self) -> int:
+        # counted on first use, so building a pipeline doesn't load the tokenizer
+        return count_openai_tokens(self.prefix)
+
+    @property
+    def target_chunk_tokens(self) -> int:
+        """The chunk size for the prefix ratio, before balancing, e.g. to pack many texts, see `predict_batch`."""
+        if self.prefix_ratio <= 0:
+            return self.max_chunk_tokens
+        target = math.ceil(self.prefix_tokens / self.prefix_ratio)
+        return max(self.min_chunk_tokens, min(self.max_chunk_tokens, target))
+
+    def chunk_tokens(self, text_tokens: int, fanout: Optional[int] = None, max_tokens: Optional[int] = None) -> int:
+        """
+        The token budget of the chunks of a text of `text_tokens` tokens, with `fanout` chunks of the request
+        running at a time (the controller is only used when it's known).
+
+        `max_tokens` is the chunk size of the caller, e.g. 4000 for event logs: the prefix ratio only makes chunks
+        bigger, up to it, so a request isn't sent in more chunks than with the caller's size.
+        """
+        if self.pinned_chunk_tokens:
+            return self.pinned_chunk_tokens
+        target = None
+        if self.controller is not None and fanout:
+            target = self.controller.choose(text_tokens, fanout)
+        if target is None:
+            target = max(self.target_chunk_tokens, max_tokens or 0)
+        if text_tokens <= target:
+            return target
+        num_chunks = math.ceil(text_tokens / target)
+        # lines aren't split, the headroom keeps the greedy chunker from spilling a few lines into one more chunk
+        return min(self.max_chunk_tokens, math.ceil(text_tokens / num_chunks * 1.1))
+
+    def is_small(self, text_tokens: int) -> bool:
+        return text_tokens <= self.small_input_tokens
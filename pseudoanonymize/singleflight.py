@@ -0,0 +1,83 @@
+"""
+Coalescing of concurrent identical calls: while a call with a key is in flight, the next calls with the same key
+wait for its result instead of starting their own, e.g. a client retrying a request that is still being
+anonymized, or the same chat completion sent by two requests. The LLM cache only helps once a call has finished.
+
+Example:
+```python
+flights = SingleFlight("llm_call")
+content = await flights.do(cache_key, lambda: client.chat.completions.create(**kwargs))
+```
+"""
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from pseudoanonymize import metrics
+
+T = TypeVar("T")
+
+
+def request_key(endpoint: str, option: str, body: bytes) -> str:
+    """The key of a request to an endpoint: requests with the same body anonymized by the same pipeline are equal."""
+    return f"{endpoint}:{option}:{hashlib.sha256(body).hexdigest()}"
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    The calls in flight by key. The call runs in its own task, so a caller that is cancelled (e.g. its client
+    disconnected) doesn't cancel it for the other callers; the result or the exception is given to every caller.
+    When its last caller is cancelled the call is cancelled too, so timeouts and the limits of the scheduler still
+    stop the LLM calls.
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        """
+        args:
+            name: the layer of the calls, for the `pii_coalesced_calls_total` metric
+            enabled: when False every call runs on its own
+        """
+        self.name = name
+        self.enabled = enabled
+        self._calls: Dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        if not self.enabled:
+            return await fn()
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._calls[key] = _Flight(asyncio.ensure_future(fn()))
+            flight.task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            metrics.coalesced_calls.inc(layer=self.name)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # nobody else waits for the call, the next identical call starts a new one
+                if self._calls.get(key) is flight:
+                    del self._calls[key]
+                flight.task.cancel()
+                # the call is stopped when the caller's cancellation completes, like a call awaited directly
+                await asyncio.wait([flight.task])
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        flight = self._calls.get(key)
+        if flight is not None and flight.task is task:
+            del self._calls[key]
+        # the exception is raised in the callers, if they are all gone it would be logged as never retrieved
+        if not task.cancelled():
+            task.exception()
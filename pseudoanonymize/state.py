@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pseudoanonymize.cache import InMemoryRedis, redis_from_url
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ConversationState:
+    """
+    What the service remembers of a conversation between calls: the anonymized messages, keyed by the position of
+    their event in the event log, and the entity registry of the conversation (see `EntityRegistry.to_dict`).
+    """
+
+    # message key -> [hash of the original content, anonymized content]
+    messages: Dict[str, List[str]] = field(default_factory=dict)
+    registry: Dict[str, Any] = field(default_factory=dict)
+
+    def anonymized(self, key: str, content: str) -> Optional[str]:
+        """The anonymized content of a message, if it was anonymized before and hasn't changed since."""
+        entry = self.messages.get(key)
+        if entry is None or entry[0] != content_hash(content):
+            return None
+        return entry[1]
+
+    def update(self, messages: Iterable[Tuple[str, str, str]]) -> None:
+        """
+        Replace the stored messages with the given (key, content, anonymized content), dropping the messages that
+        are no longer in the conversation.
+        """
+        self.messages = {key: [content_hash(content), anonymized] for key, content, anonymized in messages}
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> "ConversationState":
+        return cls(**json.loads(data))
+
+
+class ConversationStateStore(ABC):
+    """
+    Interface of the stores keeping `ConversationState`s between calls.
+    """
+
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        """
+        A lock serializing the calls of a conversation within the process, so that two calls don't anonymize the
+        same new messages and overwrite each other's state.
+        """
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[conversation_id] = lock
+        return lock
+
+    def reconnect(self) -> None:
+        """Drop the connections inherited from the parent process, in a forked worker."""
+
+    @abstractmethod
+    async def get(self, conversation_id: str) -> Optional[ConversationState]:
+        pass
+
+    @abstractmethod
+    async def set(self, conversation_id: str, state: ConversationState) -> None:
+        pass
+
+    @abstractmethod
+    async def delete(self, conversation_id: str) -> None:
+        pass
+
+
+class InMemoryStateStore(ConversationStateStore):
+    """
+    Keeps the states in the process, evicting the least recently used conversation once `max_conversations`
+    is reached.
+    """
+
+    def __init__(self, max_conversations: int = 256, ttl: Optional[float] = None):
+        super().__init__()
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._states: "OrderedDict[str, Tuple[Optional[float], str]]" = OrderedDict()
+
+    async def get(self, conversation_id: str) -> Optional[ConversationState]:
+        entry = self._states.get(conversation_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._states[conversation_id]
+            return None
+        self._states.move_to_end(conversation_id)
+        # states are stored serialized, so callers can't modify the stored state in place
+        return ConversationState.from_json(data)
+
+    async def set(self, conversation_id: str, state: ConversationState) -> None:
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self._states[conversation_id] = (expires_at, state.to_json())
+        self._states.move_to_end(conversation_id)
+        while len(self._states) > self.max_conversations:
+            self._states.popitem(last=False)
+
+    async def delete(self, conversation_id: str) -> None:
+        self._states.pop(conversation_id, None)
+
+
+class RedisStateStore(ConversationStateStore):
+    """
+    Keeps the states in Redis, shared by all instances of the service. States expire after `ttl` seconds
+    without a call.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        ttl: Optional[int] = 7 * 24 * 3600,
+        prefix: str = "pii-service:conversation:",
+        url: Optional[str] = None,
+        lock_timeout: float = 300,
+    ):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.url = url
+        self.lock_timeout = lock_timeout
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisStateStore":
+        return cls(redis_from_url(url, "state store"), url=url, **kwargs)
+
+    def reconnect(self) -> None:
+        if self.url:
+            self.client = redis_from_url(self.url, "state store")
+
+    def lock(self, conversation_id: str):
+        """
+        A lock in Redis, so that the calls of a conversation are serialized across the workers and instances
+        sharing the store. It expires after `lock_timeout` seconds in case its holder dies.
+        """
+        return self.client.lock(self.prefix + "lock:" + conversation_id, timeout=self.lock_timeout)
+
+    async def get(self, conversation_id: str) -> Optional[ConversationState]:
+        data = await self.client.get(self.prefix + conversation_id)
+        if data is None:
+            return None
+        return ConversationState.from_json(data.decode("utf-8") if isinstance(data, bytes) else data)
+
+    async def set(self, conversation_id: str, state: ConversationState) -> None:
+        await self.client.set(self.prefix + conversation_id, state.to_json(), ex=self.ttl)
+
+    async def delete(self, conversation_id: str) -> None:
+        await self.client.delete(self.prefix + conversation_id)
+
+
+def build_state_store(
+    backend: str, max_conversations: int = 256, ttl: Optional[float] = None, redis_url: Optional[str] = None
+) -> ConversationStateStore:
+    """
+    Build the conversation state store selected by name: "memory" or "redis".
+    The "redis" backend uses the local stand-in when no `redis_url` is given.
+    """
+    if backend == "memory":
+        return InMemoryStateStore(max_conversations=max_conversations, ttl=ttl)
+    elif backend == "redis":
+        redis_ttl = int(ttl) if ttl else None
+        if redis_url:
+            return RedisStateStore.from_url(redis_url, ttl=redis_ttl)
+        return RedisStateStore(InMemoryRedis(), ttl=redis_ttl)
+    raise ValueError(f"Unknown conversation state backend: {backend}")
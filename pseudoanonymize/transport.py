@@ -0,0 +1,132 @@
+"""
+The HTTP clients of the LLM calls, with the same connection pool, keep-alive and timeout settings for the async
+OpenAI client of the anonymizers and the synchronous client of DSPy.
+
+When the pool has fewer connections than the LLM calls in flight (see LLM_MAX_IN_FLIGHT), calls wait for a
+connection, and every connection closed by the keep-alive expiry costs a new TLS handshake on the next call.
+"""
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
+
+import httpx
+
+from pseudoanonymize import metrics
+
+pool_timeouts = metrics.counter("pii_http_pool_timeouts_total", "LLM calls that timed out waiting for a connection")
+
+
+@dataclass
+class HttpSettings:
+    """
+    The defaults are the ones of the OpenAI client, except for the keep-alive expiry: httpx closes connections
+    after 5 idle seconds, shorter than the gaps between the calls of a quiet instance.
+
+    args:
+        max_connections: the size of the connection pool, at least the LLM calls in flight
+        max_keepalive_connections: the idle connections kept open for the next calls
+        keepalive_expiry: seconds an idle connection is kept open
+        http2: multiplex the calls over fewer connections, requires the `h2` package
+        connect_timeout: seconds to open a connection, including the TLS handshake
+        read_timeout: seconds without a byte of the response, long for the LLM to write big chunks
+        pool_timeout: seconds to wait for a connection of the pool
+        base_url: the API the clients talk to, e.g. a local stand-in, defaults to OpenAI
+    """
+
+    max_connections: int = 1000
+    max_keepalive_connections: int = 100
+    keepalive_expiry: float = 60.0
+    http2: bool = False
+    connect_timeout: float = 5.0
+    read_timeout: float = 600.0
+    pool_timeout: float = 600.0
+    base_url: Optional[str] = None
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            self.read_timeout, connect=self.connect_timeout, read=self.read_timeout, pool=self.pool_timeout
+        )
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """An async transport counting its requests, to report the use of its connection pool."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.in_flight = 0
+        self.request_seconds = 0.0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            pool_timeouts.inc()
+            raise
+        finally:
+            self.in_flight -= 1
+            self.request_seconds += time.perf_counter() - start
+
+    def pool_stats(self) -> Tuple[int, int]:
+        """The open connections of the pool and how many of them are idle."""
+        connections = list(self._pool.connections)
+        return len(connections), sum(connection.is_idle() for connection in connections)
+
+
+# the transport of the last async client built, the one of the OpenAI client of the process
+_transport: Optional[InstrumentedTransport] = None
+
+
+def _collect_pool_metrics() -> Iterator[Tuple[str, str, str, float]]:
+    if _transport is None:
+        return
+    open_connections, idle_connections = _transport.pool_stats()
+    yield "pii_http_connections_open", "gauge", "Open connections of the LLM client", open_connections
+    yield "pii_http_connections_idle", "gauge", "Idle connections kept alive by the LLM client", idle_connections
+    yield "pii_http_requests_in_flight", "gauge", "LLM HTTP requests waiting for a response", _transport.in_flight
+    yield "pii_http_requests_total", "counter", "LLM HTTP requests sent", _transport.requests
+    yield "pii_http_request_seconds_total", "counter", "Time to the response headers of the LLM HTTP requests", (
+        _transport.request_seconds
+    )
+
+
+metrics.registry.add_collector(_collect_pool_metrics)
+
+
+def _check_http2(settings: HttpSettings) -> None:
+    if settings.http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError as e:
+            raise ImportError("HTTP/2 requires the `h2` package: pip install httpx[http2]") from e
+
+
+def build_async_http_client(settings: HttpSettings) -> httpx.AsyncClient:
+    """The client of the AsyncOpenAI client, with its pool use reported in the metrics."""
+    global _transport
+    _check_http2(settings)
+    _transport = InstrumentedTransport(limits=settings.limits, http2=settings.http2)
+    return httpx.AsyncClient(transport=_transport, timeout=settings.timeout)
+
+
+def build_sync_http_client(settings: HttpSettings) -> httpx.Client:
+    """The client of the synchronous OpenAI client used by DSPy."""
+    _check_http2(settings)
+    return httpx.Client(limits=settings.limits, timeout=settings.timeout, http2=settings.http2)
+
+
+def pool_metrics() -> dict:
+    """The use of the connection pool of the LLM client, for `/http_metrics`."""
+    return {name: value for name, _, _, value in _collect_pool_metrics()}
@@ -1,14 +1,29 @@
 import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator
 
-import tiktoken
+from pseudoanonymize import metrics
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = "gpt-3.5-turbo") -> "tiktoken.Encoding":
+    """
+    Return the tokenizer of a model. Looking it up is expensive, so it is done once per model, on first use
+    (or at startup with `config.warm_up`).
+    """
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model_name)
 
 
 def count_openai_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
     """
     Calculate the number of tokens a model will use for a given text.
     """
-    encoding = tiktoken.encoding_for_model(model_name)
-    tokens = encoding.encode(text)
+    tokens = get_encoding(model_name).encode(text)
     return len(tokens)
 
 
@@ -23,61 +38,134 @@ def flatten_replacement_dict(replacement_dict):
     return flat_dict
 
 
-def get_chunks(
-    text: str, max_tokens: int, splitter, connector: str, token_count_based_on: str = "gpt-3.5-turbo"
-) -> list[str]:
+def _overlap_tail(segments: list[str], segment_tokens: list[int], overlap_tokens: int) -> tuple[list[str], int]:
+    """
+    Return the trailing segments of a chunk that fit in `overlap_tokens`, and their token count.
     """
-    Splits the input text into chunks where each chunk does not exceed the specified maximum token limit,
+    tail_size = 0
+    tail_tokens = 0
+    for tokens in reversed(segment_tokens):
+        if tail_tokens + tokens > overlap_tokens:
+            break
+        tail_size += 1
+        tail_tokens += tokens
+    return segments[len(segments) - tail_size :], tail_tokens
+
+
+def iter_chunks(
+    text: str,
+    max_tokens: int,
+    splitter,
+    connector: str,
+    token_count_based_on: str = "gpt-3.5-turbo",
+    overlap_tokens: int = 0,
+) -> Iterator[str]:
+    """
+    Lazily splits the input text into chunks where each chunk does not exceed the specified maximum token limit,
     using the provided splitter function to determine how to split the text.
 
+    Each segment is tokenized once and the token counts are summed as the chunk grows. Summing is an upper bound
+    on the count of the joined text (tokens can only merge across a connector), so the chunk is only re-tokenized
+    when the sum crosses max_tokens, which keeps the decisions identical to tokenizing the whole chunk every time.
+
     args:
         text: the input text to split
         max_tokens: the maximum number of tokens allowed in each chunk
         splitter: a function that takes a string and returns a list of segments
         connector: a string to add between segments when joining them
         token_count_based_on: the model to use for counting tokens
+        overlap_tokens: if set, each chunk starts with the trailing segments of the previous chunk that fit in
+            this many tokens, so entities at chunk edges keep their context. Overlapping chunks can't be joined
+            back into the original text.
     """
-    chunks = []
-    current_chunk = ""
+    encoding = get_encoding(token_count_based_on)
+    segments = []  # segments of the current chunk
+    segment_tokens = []  # token count of each segment, including its connector
+    chunk_tokens = 0
     for segment in splitter(text.strip()):
-        token_count = count_openai_tokens(current_chunk + connector + segment, model_name=token_count_based_on)
-        if token_count > max_tokens:
-            chunks.append(current_chunk.strip())
-
-            if count_openai_tokens(segment, model_name=token_count_based_on) > max_tokens:
-                # if the segment itself is too long, split it into smaller chunks
-                # TODO: handle rare case where a even after splitting by words the segment contains more tokens than max_tokens
-                # this can only happen if a single word is longer than max_tokens
-                chunks.extend(chunk_by_word(segment, max_tokens))
-            else:
-                # start a new chunk
-                current_chunk = segment
+        tokens = len(encoding.encode(connector + segment))
+        if chunk_tokens + tokens > max_tokens:
+            # the sum overestimates, check the exact count before closing the chunk
+            chunk_tokens = len(encoding.encode(connector.join(segments) + connector + segment))
         else:
+            chunk_tokens += tokens
+
+        if chunk_tokens <= max_tokens:
             # enough space to add the segment to the current chunk
-            current_chunk += (connector if current_chunk else "") + segment
+            segments.append(segment)
+            segment_tokens.append(tokens)
+            continue
+
+        chunk = connector.join(segments).strip()
+        if chunk:
+            yield chunk
+        overlap, chunk_tokens = _overlap_tail(segments, segment_tokens, overlap_tokens)
+        segments, segment_tokens = list(overlap), segment_tokens[len(segment_tokens) - len(overlap) :]
+
+        segment_only_tokens = len(encoding.encode(segment))
+        if segment_only_tokens > max_tokens:
+            # if the segment itself is too long, split it into smaller chunks
+            # TODO: handle rare case where a even after splitting by words the segment contains more tokens than max_tokens
+            # this can only happen if a single word is longer than max_tokens
+            yield from chunk_by_word(segment, max_tokens)
+            segments, segment_tokens, chunk_tokens = [], [], 0
+            continue
+
+        while segments and chunk_tokens + tokens > max_tokens:
+            # drop overlap from the front until the new segment fits
+            segments.pop(0)
+            chunk_tokens -= segment_tokens.pop(0)
+        # start a new chunk
+        segments.append(segment)
+        segment_tokens.append(tokens)
+        chunk_tokens = chunk_tokens + tokens if len(segments) > 1 else segment_only_tokens
+
+    chunk = connector.join(segments).strip()
+    if chunk:
+        yield chunk
 
-    if current_chunk:
-        chunks.append(current_chunk.strip())
 
-    return chunks
+def get_chunks(
+    text: str,
+    max_tokens: int,
+    splitter,
+    connector: str,
+    token_count_based_on: str = "gpt-3.5-turbo",
+    overlap_tokens: int = 0,
+) -> list[str]:
+    """
+    Same as `iter_chunks`, returning all the chunks at once.
+    """
+    return list(iter_chunks(text, max_tokens, splitter, connector, token_count_based_on, overlap_tokens))
 
 
-def chunk_by_word(text: str, max_tokens: int) -> list[str]:
+def chunk_by_word(text: str, max_tokens: int, overlap_tokens: int = 0) -> list[str]:
     def split_by_word(text: str) -> list[str]:
         return text.split()
 
-    return get_chunks(text, max_tokens, split_by_word, connector=' ')
+    return get_chunks(text, max_tokens, split_by_word, connector=' ', overlap_tokens=overlap_tokens)
 
 
-def chunk_by_terminal_punctuation(text: str, max_tokens: int) -> list[str]:
+def chunk_by_terminal_punctuation(text: str, max_tokens: int, overlap_tokens: int = 0) -> list[str]:
     def split_by_terminal_punctuation(text: str) -> list[str]:
         return re.split(r'(?<=[.!?])\s+', text)
 
-    return get_chunks(text, max_tokens, split_by_terminal_punctuation, connector='.')
+    return get_chunks(text, max_tokens, split_by_terminal_punctuation, connector='.', overlap_tokens=overlap_tokens)
+
 
+def _split_by_line(text: str) -> list[str]:
+    return text.split('\n')
 
-def chunk_by_line(text: str, max_tokens: int) -> list[str]:
-    def split_by_line(text: str) -> list[str]:
-        return text.split('\n')
 
-    return get_chunks(text, max_tokens, split_by_line, connector='\n')
+@metrics.timed("chunking")
+def chunk_by_line(text: str, max_tokens: int, overlap_tokens: int = 0) -> list[str]:
+    chunks = get_chunks(text, max_tokens, _split_by_line, connector='\n', overlap_tokens=overlap_tokens)
+    metrics.chunks.inc(len(chunks))
+    return chunks
+
+
+def iter_chunks_by_line(text: str, max_tokens: int, overlap_tokens: int = 0) -> Iterator[str]:
+    """
+    Same as `chunk_by_line`, producing the chunks one at a time as they are consumed.
+    """
+    return iter_chunks(text, max_tokens, _split_by_line, connector='\n', overlap_tokens=overlap_tokens)
@@ -0,0 +1,93 @@
+"""
+Benchmark of `PiplelineAnon.predict_batch` against anonymizing the same conversations one at a time,
+like the overnight archive job calling `/anonymize_v2` per conversation.
+
+Generates short synthetic sessions in which the assistant often repeats boilerplate lines, runs both
+approaches against a local fake OpenAI server and reports the LLM calls and prompt tokens received by
+the server. The LLM response cache is disabled so that both approaches pay for every call.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_batch --conversations 200 --latency 0.2
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from faker import Faker
+from openai import AsyncOpenAI
+
+from pseudoanonymize.common import set_llm_cache
+from pseudoanonymize.direct_json_anonymization import JsonDirectAnonymizer
+from pseudoanonymize.pipeline import PiplelineAnon
+from pseudoanonymize.regex_anonymization import RegexAnon
+from pseudoanonymize.scheduler import ChunkScheduler
+from pseudoanonymize.utils import chunk_by_line
+from scripts.fake_openai_server import FakeOpenAIServer
+
+BOILERPLATE = [
+    "assistant: How are you feeling today?",
+    "assistant: Thank you for sharing that with me.",
+    "assistant: That sounds really hard. What do you think made it feel that way?",
+    "assistant: Let's take a moment to breathe together.",
+    "assistant: Is there anything else on your mind?",
+    "assistant: I'm here for you. Take all the time you need.",
+]
+
+
+def make_conversation(fake: Faker) -> str:
+    lines = []
+    for _ in range(random.randint(4, 30)):
+        lines.append(f"user: {fake.sentence(nb_words=random.randint(5, 25))} {fake.first_name()} {fake.city()}")
+        if random.random() < 0.6:
+            lines.append(random.choice(BOILERPLATE))
+        else:
+            lines.append(f"assistant: {fake.sentence(nb_words=random.randint(5, 25))}")
+    return "\n".join(lines)
+
+
+async def one_at_a_time(pipeline: PiplelineAnon, scheduler: ChunkScheduler, texts: list[str]) -> list[dict]:
+    async def anonymize(text: str) -> list[dict]:
+        return await scheduler.map(lambda chunk: pipeline.retry_prediction({"text": chunk}), chunk_by_line(text, 2000))
+
+    return await asyncio.gather(*(anonymize(text) for text in texts))
+
+
+async def batched(pipeline: PiplelineAnon, scheduler: ChunkScheduler, texts: list[str]) -> list[dict]:
+    return await pipeline.predict_batch(texts, max_tokens=2000, scheduler=scheduler)
+
+
+def run(approach, texts: list[str], latency: float) -> tuple[float, FakeOpenAIServer]:
+    with FakeOpenAIServer(latency=latency) as server:
+        client = AsyncOpenAI(base_url=server.base_url, api_key="fake")
+        pipeline = PiplelineAnon([JsonDirectAnonymizer(client=client), RegexAnon()])
+        scheduler = ChunkScheduler()
+        start = time.perf_counter()
+        asyncio.run(approach(pipeline, scheduler, texts))
+        return time.perf_counter() - start, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    random.seed(0)
+    fake = Faker()
+    Faker.seed(0)
+    texts = [make_conversation(fake) for _ in range(args.conversations)]
+    set_llm_cache(None)
+
+    print(f"{args.conversations} conversations, {sum(len(text) for text in texts)} chars")
+    for name, approach in [("one at a time", one_at_a_time), ("predict_batch", batched)]:
+        elapsed, server = run(approach, texts, args.latency)
+        stats = server.stats
+        print(
+            f"{name:14s}: {stats.requests:5d} LLM calls, {stats.prompt_tokens:9d} prompt tokens "
+            f"({stats.prompt_tokens / args.conversations:7.0f} per conversation), {elapsed:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
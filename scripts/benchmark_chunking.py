@@ -0,0 +1,79 @@
+"""
+Benchmark of the token-aware chunker against the previous implementation, which re-tokenized
+the whole growing chunk for every line.
+
+Generates synthetic therapy session transcripts of a few hours (~150 spoken words per minute)
+and times `chunk_by_line` with the chunk sizes used by the endpoints.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_chunking --hours 1 2 4
+"""
+import argparse
+import random
+import time
+
+from faker import Faker
+
+from pseudoanonymize.utils import chunk_by_line, count_openai_tokens, get_encoding
+
+WORDS_PER_HOUR = 150 * 60
+
+
+def legacy_chunk_by_line(text: str, max_tokens: int) -> list[str]:
+    """The line chunker used before the linear-time implementation."""
+    chunks = []
+    current_chunk = ""
+    for segment in text.strip().split("\n"):
+        if count_openai_tokens(current_chunk + "\n" + segment) > max_tokens:
+            chunks.append(current_chunk.strip())
+            current_chunk = segment
+        else:
+            current_chunk += ("\n" if current_chunk else "") + segment
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+
+def make_session(hours: float, fake: Faker) -> str:
+    lines = []
+    words = 0
+    while words < hours * WORDS_PER_HOUR:
+        speaker = random.choice(["user", "assistant"])
+        sentences = [fake.sentence(nb_words=random.randint(4, 20)) for _ in range(random.randint(1, 5))]
+        line = f"{speaker}: " + " ".join(sentences)
+        lines.append(line)
+        words += len(line.split())
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--max-tokens", type=int, nargs="+", default=[2000, 4000])
+    args = parser.parse_args()
+
+    random.seed(0)
+    fake = Faker()
+    Faker.seed(0)
+    get_encoding()  # load the tokenizer outside of the timings
+
+    for hours in args.hours:
+        session = make_session(hours, fake)
+        for max_tokens in args.max_tokens:
+            start = time.perf_counter()
+            chunks = chunk_by_line(session, max_tokens)
+            new_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            legacy_chunks = legacy_chunk_by_line(session, max_tokens)
+            legacy_time = time.perf_counter() - start
+
+            assert chunks == legacy_chunks
+            print(
+                f"{hours:4.1f}h session ({len(session):8d} chars), max_tokens={max_tokens:5d}, {len(chunks):4d} chunks: "
+                f"legacy {legacy_time * 1000:9.1f} ms, new {new_time * 1000:7.1f} ms ({legacy_time / new_time:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Benchmark of the service endpoints against a local fake OpenAI server, to compare releases without an OpenAI key.
+
+The service runs in its own process with uvicorn, like in production, with the OpenAI client pointed at a
+`FakeOpenAIServer` answering in the JSON format of `JsonDirectAnonymizer` after a configurable latency and error
+rate. Every endpoint is called with synthetic transcripts of several sizes at several concurrency levels, and
+each scenario reports the p50/p95/p99 latency, the throughput, the errors and the peak RSS of the service
+(Linux only, reset between scenarios). The LLM cache is disabled so every request pays for its LLM calls.
+
+`/anonymize_event_log` and `/anonymize_ash_conversation` take protobufs, built from a sample of the real ones:
+a serialized EventLog (`--eventlog-sample`) and a serialized ReadConversationForUserResponse
+(`--conversation-sample`). The transcript lines are spread over the messages of the sample, so the structure
+of the protobuf is kept whatever the size. Without a sample the endpoint is skipped.
+
+The results are written as JSON with the parameters of the run, to compare runs over time.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_endpoints --sizes small,medium --concurrency 1,8 --output results/bench.json
+    python -m scripts.benchmark_endpoints --eventlog-sample event_log.pb --conversation-sample conversation.pb
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+from scripts.fake_openai_server import FakeOpenAIServer, _free_port
+
+FIRST_NAMES = ["Alex", "Maria", "John", "Priya", "Lucas", "Emma", "Omar", "Sofia", "Noah", "Chen"]
+CITIES = ["Springfield", "Lisbon", "Toronto", "Leeds", "Austin", "Lyon"]
+WORDS = (
+    "i have been feeling tired lately and work has been hard since my manager changed the schedule "
+    "we talked about sleep and exercise last week and it helped a little but the weekends are still difficult"
+).split()
+NAME_PATTERN = re.compile(r"\b(" + "|".join(FIRST_NAMES) + r")\b")
+
+# number of transcript lines of each size, a line is ~25 tokens
+SIZES = {"small": 10, "medium": 100, "large": 600}
+ENDPOINTS = ["/anonymize", "/anonymize_v2", "/pseudoanonymize", "/anonymize_event_log", "/anonymize_ash_conversation"]
+
+# builds the keyword arguments of the httpx request from the transcript lines and a unique request id
+PayloadBuilder = Callable[[List[str], str], dict]
+
+
+def make_lines(num_lines: int, rng: random.Random) -> List[str]:
+    lines = []
+    for _ in range(num_lines):
+        words = rng.sample(WORDS, rng.randint(8, 20))
+        words.insert(rng.randrange(len(words)), rng.choice(FIRST_NAMES))
+        if rng.random() < 0.3:
+            words.append(f"in {rng.choice(CITIES)}")
+        lines.append(f"{rng.choice(['user', 'assistant'])}: {' '.join(words)}")
+    return lines
+
+
+def fake_llm_response(body: dict) -> str:
+    """The replacement dict `JsonDirectAnonymizer` expects, with the first names found in the prompt."""
+    names = sorted(set(NAME_PATTERN.findall(body["messages"][-1]["content"])))
+    return json.dumps({f"FIRST_NAME_{i}": [name] for i, name in enumerate(names, start=1)})
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, round(q / 100 * (len(sorted_values) - 1)))]
+
+
+def _fill_messages(messages: List, lines: List[str]) -> None:
+    """Spread the lines over the messages, so the content of every message changes and no line is lost."""
+    if not messages:
+        raise ValueError("The protobuf sample has no messages")
+    for i, message in enumerate(messages):
+        message.content = " ".join(lines[i :: len(messages)]) or lines[i % len(lines)]
+
+
+def _event_log_messages(event_log) -> Iterator:
+    # same messages as `extract_messages`
+    for event in event_log.events:
+        for role in ("therapist", "user"):
+            if hasattr(event, f"{role}_message_completed"):
+                message = getattr(event, f"{role}_message_completed").message
+                if message.content:
+                    yield message
+
+
+def _conversation_messages(conversation) -> Iterator:
+    for session in conversation.sessions:
+        for entry in session.entries:
+            for message in (entry.user_message, entry.therapist_message):
+                if message.content:
+                    yield message
+
+
+def text_payload(lines: List[str], request_id: str) -> dict:
+    return {"json": {"id": request_id, "text": "\n".join(lines)}}
+
+
+def protobuf_payload(message_class, sample: bytes, messages: Callable[[object], Iterator]) -> PayloadBuilder:
+    def payload(lines: List[str], request_id: str) -> dict:
+        message = message_class.FromString(sample)
+        _fill_messages(list(messages(message)), lines)
+        return {"content": bytes(message.SerializeToString()), "headers": {"Content-Type": "application/protobuf"}}
+
+    return payload
+
+
+def payload_builders(args: argparse.Namespace) -> Dict[str, PayloadBuilder]:
+    builders = {"/anonymize": text_payload, "/anonymize_v2": text_payload, "/pseudoanonymize": text_payload}
+    if args.eventlog_sample:
+        from ashley_protos.care.ashley.contracts.internal.v1 import EventLog
+
+        with open(args.eventlog_sample, "rb") as file:
+            builders["/anonymize_event_log"] = protobuf_payload(EventLog, file.read(), _event_log_messages)
+    if args.conversation_sample:
+        from ashley_protos.care.ashley.contracts.internal.v1 import ReadConversationForUserResponse
+
+        with open(args.conversation_sample, "rb") as file:
+            builders["/anonymize_ash_conversation"] = protobuf_payload(
+                ReadConversationForUserResponse, file.read(), _conversation_messages
+            )
+    return builders
+
+
+class ServiceProcess:
+    """The service running with uvicorn in a child process, talking to the fake OpenAI server."""
+
+    def __init__(self, app: str, openai_base_url: str, env: Optional[Dict[str, str]] = None):
+        self.port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        command = [sys.executable, "-m", "uvicorn", app, "--port", str(self.port), "--log-level", "warning"]
+        self.process = subprocess.Popen(
+            command,
+            env={
+                **os.environ,
+                "OPENAI_API_KEY": "fake",
+                "OPENAI_BASE_URL": openai_base_url,
+                "LLM_CACHE_BACKEND": "none",
+                "WARM_UP": "blocking",
+                "LOG_LEVEL": "WARNING",
+                **(env or {}),
+            },
+            stdout=subprocess.DEVNULL,
+        )
+
+    def wait_ready(self, timeout: float = 60.0) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The service exited with code {self.process.returncode}")
+            try:
+                httpx.get(self.base_url + "/scheduler_metrics", timeout=1.0)
+                return
+            except httpx.TransportError:
+                time.sleep(0.1)
+        raise TimeoutError("The service did not start")
+
+    def reset_peak_rss(self) -> None:
+        try:
+            with open(f"/proc/{self.process.pid}/clear_refs", "w") as file:
+                file.write("5")
+        except OSError:
+            pass
+
+    def peak_rss_mb(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.process.pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+        return None
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+async def run_scenario(
+    base_url: str,
+    endpoint: str,
+    build_payload: PayloadBuilder,
+    lines: List[str],
+    concurrency: int,
+    requests: int,
+    timeout: float,
+) -> dict:
+    latencies = []
+    errors: Dict[str, int] = {}
+    # a unique run id per request keeps identical requests from being coalesced or cached
+    run_id = f"{time.time_ns():x}"
+    payloads = [
+        build_payload([f"{line} ({run_id}-{i})" for line in lines], f"bench-{run_id}-{i}") for i in range(requests)
+    ]
+    slots = asyncio.Semaphore(concurrency)
+
+    async def call(client: httpx.AsyncClient, payload: dict) -> None:
+        async with slots:
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, **payload)
+                outcome = "ok" if response.status_code == 200 else str(response.status_code)
+            except httpx.HTTPError as e:
+                outcome = e.__class__.__name__
+            if outcome == "ok":
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors[outcome] = errors.get(outcome, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(call(client, payload) for payload in payloads))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "succeeded": len(latencies),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "chars_per_second": len(latencies) * sum(len(line) + 1 for line in lines) / elapsed,
+        "latency_seconds": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--sizes", default="small,medium,large", help=f"among {', '.join(SIZES)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="concurrency levels, comma separated")
+    parser.add_argument("--requests", type=int, default=32, help="requests per scenario")
+    parser.add_argument("--latency", type=float, default=0.5, help="latency of the fake LLM, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of LLM calls answered with a 500")
+    parser.add_argument("--timeout", type=float, default=300.0, help="timeout of a request to the service")
+    parser.add_argument("--eventlog-sample", help="serialized EventLog used to build /anonymize_event_log requests")
+    parser.add_argument(
+        "--conversation-sample",
+        help="serialized ReadConversationForUserResponse used to build /anonymize_ash_conversation requests",
+    )
+    parser.add_argument("--app", default="main:app", help="the ASGI app to benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="results/benchmark_endpoints.json")
+    args = parser.parse_args()
+
+    builders = payload_builders(args)
+    endpoints = args.endpoints.split(",")
+    for endpoint in endpoints:
+        if endpoint not in builders:
+            print(f"skipping {endpoint}: no protobuf sample given", file=sys.stderr)
+    endpoints = [endpoint for endpoint in endpoints if endpoint in builders]
+    sizes = args.sizes.split(",")
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    rng = random.Random(args.seed)
+    transcripts = {size: make_lines(SIZES[size], rng) for size in sizes}
+
+    results = []
+    with FakeOpenAIServer(latency=args.latency, error_rate=args.error_rate, respond=fake_llm_response) as llm:
+        service = ServiceProcess(args.app, llm.base_url)
+        try:
+            service.wait_ready()
+            for endpoint in endpoints:
+                for size in sizes:
+                    for concurrency in concurrency_levels:
+                        llm_requests = llm.stats.requests
+                        service.reset_peak_rss()
+                        result = asyncio.run(
+                            run_scenario(
+                                service.base_url,
+                                endpoint,
+                                builders[endpoint],
+                                transcripts[size],
+                                concurrency,
+                                args.requests,
+                                args.timeout,
+                            )
+                        )
+                        result.update(
+                            endpoint=endpoint,
+                            size=size,
+                            lines=len(transcripts[size]),
+                            concurrency=concurrency,
+                            llm_calls=llm.stats.requests - llm_requests,
+                            peak_rss_mb=service.peak_rss_mb(),
+                        )
+                        results.append(result)
+                        latency = result["latency_seconds"]
+                        print(
+                            f"{endpoint:28s} {size:6s} c={concurrency:<3d} "
+                            f"p50 {_ms(latency['p50'])} p95 {_ms(latency['p95'])} p99 {_ms(latency['p99'])} "
+                            f"{result['throughput_rps']:7.2f} req/s  errors {sum(result['errors'].values()):3d}  "
+                            f"peak RSS {result['peak_rss_mb'] or 0:6.0f} MB"
+                        )
+        finally:
+            service.stop()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"results written to {args.output}")
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return f"{seconds * 1000:7.0f}ms" if seconds is not None else "      -  "
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark of the protobuf path of `/anonymize_event_log`: extracting the conversation from the event log and
+writing the anonymized messages back, with `EventLogIndex` and with the previous implementation, which built the
+conversation with string concatenation, copied the event log with a serialize/parse round trip and mapped the
+anonymized text back to the messages by splitting it on newlines.
+
+The event logs are made of the events of a sample event log repeated up to the number of events, with generated
+messages. The anonymization is the upper-casing of each chunk, the LLM calls and the chunking are not timed.
+
+To run this script from the root of the repo (the protobufs must be installed):
+    python -m scripts.benchmark_event_log --eventlog-sample event_log.pb --events 1000 10000 50000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from ashley_protos.care.ashley.contracts.internal.v1 import EventLog
+
+from pseudoanonymize.ashley_protos_utils import EventLogIndex, extract_messages
+from pseudoanonymize.utils import chunk_by_line
+from scripts.benchmark_endpoints import _event_log_messages, _fill_messages, make_lines
+
+
+def legacy_extract_conv_from_event_log(event_log: EventLog) -> str:
+    conv = ""
+    for event in event_log.events:
+        for role in ("therapist", "user"):
+            if hasattr(event, f"{role}_message_completed"):
+                content = getattr(event, f"{role}_message_completed").message.content
+                if content:
+                    conv += content.replace("\n", " ") + "\n"
+    return conv
+
+
+def legacy_update_message_contents(events: EventLog, anonymized_conversation: str) -> EventLog:
+    new_event = EventLog().FromString(events.SerializeToString())
+    anonymized_text_turns = anonymized_conversation.split("\n")
+    j = 0
+    for i, event in enumerate(events.events):
+        for role in ("therapist", "user"):
+            if hasattr(event, f"{role}_message_completed"):
+                if getattr(event, f"{role}_message_completed").message.content:
+                    getattr(new_event.events[i], f"{role}_message_completed").message.content = anonymized_text_turns[j]
+                    j += 1
+    return new_event
+
+
+def make_event_log(sample: bytes, num_events: int, rng: random.Random) -> EventLog:
+    sample_events = len(EventLog.FromString(sample).events)
+    # the repeated fields of concatenated protobufs are concatenated, every event is a distinct object
+    event_log = EventLog.FromString(sample * -(-num_events // sample_events))
+    event_log.events = event_log.events[:num_events]
+    messages = list(_event_log_messages(event_log))
+    _fill_messages(messages, make_lines(len(messages), rng))
+    return event_log
+
+
+def timed(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--eventlog-sample", required=True, help="a serialized EventLog with some messages")
+    parser.add_argument("--events", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    args = parser.parse_args()
+
+    with open(args.eventlog_sample, "rb") as file:
+        sample = file.read()
+    rng = random.Random(0)
+    for num_events in args.events:
+        data = bytes(make_event_log(sample, num_events, rng).SerializeToString())
+
+        event_log = EventLog.FromString(data)
+        conv = legacy_extract_conv_from_event_log(event_log)
+        anonymized = "\n".join(chunk.upper() for chunk in chunk_by_line(conv, args.max_tokens)) + "\n"
+
+        def legacy():
+            conv = legacy_extract_conv_from_event_log(event_log)
+            assert len(conv.split("\n")) == len(anonymized.split("\n"))
+            return legacy_update_message_contents(event_log, anonymized)
+
+        legacy_result, legacy_seconds, legacy_peak = timed(legacy)
+
+        event_log = EventLog.FromString(data)
+        chunks = chunk_by_line(EventLogIndex(event_log).conversation, args.max_tokens)
+
+        def indexed():
+            index = EventLogIndex(event_log)
+            for span, chunk in zip(index.spans(chunks), chunks):
+                index.patch(span, chunk.upper())
+            return index.apply()
+
+        result, seconds, peak = timed(indexed)
+        # the generated messages have no repeated whitespace, both paths produce the same messages
+        assert extract_messages(result) == extract_messages(legacy_result)
+        print(
+            f"{num_events} events, {len(conv)} chars, {len(chunks)} chunks: "
+            f"legacy {legacy_seconds * 1000:.1f} ms, peak {legacy_peak / 1e6:.1f} MB; "
+            f"index {seconds * 1000:.1f} ms, peak {peak / 1e6:.1f} MB ({legacy_seconds / seconds:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
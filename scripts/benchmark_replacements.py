@@ -0,0 +1,87 @@
+"""
+Benchmark of the single-pass replacement engine against the previous `text.replace` loop.
+
+Builds a synthetic transcript mentioning the keys of a large replacement dict and times both
+approaches. The compile time of the matcher is reported separately because it is paid only
+once per replacement dict.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_replacements --chars 100000 --keys 500
+"""
+import argparse
+import random
+import time
+
+from faker import Faker
+
+from pseudoanonymize.replacement import ReplacementMatcher
+
+
+def replace_loop(text: str, replacement_dict: dict) -> str:
+    """The replacement loop used before the single-pass matcher."""
+    for key in sorted(replacement_dict.keys(), key=len, reverse=True):
+        text = text.replace(key, str(replacement_dict[key]))
+    return text
+
+
+def make_replacement_dict(num_keys: int, fake: Faker) -> dict:
+    generators = [
+        ("FIRST_NAME", fake.first_name),
+        ("LAST_NAME", fake.last_name),
+        ("CITY", fake.city),
+        ("STREET", fake.street_name),
+        ("COMPANY", fake.company),
+    ]
+    replacement_dict = {}
+    while len(replacement_dict) < num_keys:
+        field_type, generate = generators[len(replacement_dict) % len(generators)]
+        replacement_dict.setdefault(generate(), f"[{field_type}_{len(replacement_dict) + 1}]")
+    return replacement_dict
+
+
+def make_transcript(num_chars: int, keys: list, fake: Faker) -> str:
+    lines = []
+    length = 0
+    while length < num_chars:
+        speaker = random.choice(["user", "assistant"])
+        line = f"{speaker}: {fake.sentence(nb_words=12)} {random.choice(keys)} {fake.sentence(nb_words=8)}"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:num_chars]
+
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=100_000)
+    parser.add_argument("--keys", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    fake = Faker()
+    Faker.seed(0)
+    replacement_dict = make_replacement_dict(args.keys, fake)
+    text = make_transcript(args.chars, list(replacement_dict), fake)
+
+    compile_time = timeit(lambda: ReplacementMatcher(replacement_dict), args.repeat)
+    matcher = ReplacementMatcher(replacement_dict)
+    loop_time = timeit(lambda: replace_loop(text, replacement_dict), args.repeat)
+    matcher_time = timeit(lambda: matcher.replace(text), args.repeat)
+
+    print(f"transcript: {len(text)} chars, replacement dict: {len(replacement_dict)} keys")
+    print(f"text.replace loop:       {loop_time * 1000:8.2f} ms")
+    print(f"matcher compile (once):  {compile_time * 1000:8.2f} ms")
+    print(f"matcher replace:         {matcher_time * 1000:8.2f} ms  ({loop_time / matcher_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark of the request shaping (see `RequestShaper`): LLM tokens per anonymized character and LLM calls for a
+mix of conversation sizes, with the fixed chunks, with shaped chunks, and with shaped chunks and the fine-tuned
+model's shorter prompt for small inputs. The conversations are anonymized as by /anonymize_v2 (2000-token chunks
+without shaping) and as by /anonymize_event_log, whose 4000-token chunks shaping mustn't split into more calls.
+
+Runs against a local fake OpenAI server, which estimates tokens as 4 characters each, with the LLM response
+cache disabled.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_shaping --conversations 100 --prefix-ratio 0.6 --small-input-tokens 500
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+from pseudoanonymize.common import set_llm_cache
+from pseudoanonymize.direct_json_anonymization import JSON_FEW_SHOT_PROMPT, JSON_SYSTEM_PROMPT, JsonDirectAnonymizer
+from pseudoanonymize.pipeline import PiplelineAnon
+from pseudoanonymize.regex_anonymization import RegexAnon
+from pseudoanonymize.scheduler import ChunkScheduler
+from pseudoanonymize.shaping import RequestShaper, static_prefix
+from scripts.benchmark_endpoints import fake_llm_response, make_lines
+from scripts.fake_openai_server import FakeOpenAIServer
+
+
+def build_pipeline(client: AsyncOpenAI, shaped: bool, prefix_ratio: float, small_input_tokens: int) -> PiplelineAnon:
+    pipeline = PiplelineAnon([JsonDirectAnonymizer(client=client), RegexAnon()])
+    if shaped:
+        pipeline.shaper = RequestShaper(
+            static_prefix(pipeline.processors), prefix_ratio=prefix_ratio, small_input_tokens=small_input_tokens
+        )
+    if small_input_tokens:
+        fine_tuned = JsonDirectAnonymizer(client=client, model="gpt-3.5-ft", system_prompt=JSON_SYSTEM_PROMPT)
+        pipeline.small_input_pipeline = PiplelineAnon([fine_tuned, RegexAnon()])
+    return pipeline
+
+
+async def anonymize_all(pipeline: PiplelineAnon, texts: list[str], max_tokens: Optional[int] = None) -> None:
+    scheduler = ChunkScheduler()
+    await asyncio.gather(
+        *(pipeline.predict_chunked(text, max_tokens=max_tokens, scheduler=scheduler) for text in texts)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--prefix-ratio", type=float, default=1.0, help="see RequestShaper")
+    parser.add_argument("--small-input-tokens", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    # mostly short conversations (a turn or two), some full sessions
+    texts = ["\n".join(make_lines(rng.choice([1, 2, 4, 10, 40, 120, 200]), rng)) for _ in range(args.conversations)]
+    chars = sum(len(text) for text in texts)
+    set_llm_cache(None)
+    print(
+        f"{args.conversations} conversations, {chars} chars, prefix of {len(JSON_SYSTEM_PROMPT + JSON_FEW_SHOT_PROMPT)} chars"
+    )
+
+    scenarios = [
+        ("fixed chunks", False, 0),
+        (f"shaped, ratio {args.prefix_ratio}", True, 0),
+        (f"shaped + FT up to {args.small_input_tokens}", True, args.small_input_tokens),
+    ]
+    for name, shaped, small_input_tokens in scenarios:
+        for endpoint, max_tokens in (("anonymize_v2", None), ("anonymize_event_log", 4000)):
+            with FakeOpenAIServer(latency=args.latency, respond=fake_llm_response) as server:
+                client = AsyncOpenAI(base_url=server.base_url, api_key="fake")
+                pipeline = build_pipeline(client, shaped, args.prefix_ratio, small_input_tokens)
+                start = time.perf_counter()
+                asyncio.run(anonymize_all(pipeline, texts, max_tokens))
+                elapsed = time.perf_counter() - start
+                stats = server.stats
+            tokens = stats.prompt_tokens + stats.completion_tokens
+            print(
+                f"{name:28s} {endpoint:20s}: {stats.requests:5d} LLM calls, {stats.prompt_tokens:8d} prompt tokens, "
+                f"{tokens / chars:5.2f} tokens/char, {elapsed:5.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark of the cold start of the service: the time from the first import to a pipeline ready to serve,
+and the time of the first chunked request with and without the tokenizer warm-up.
+
+Every measurement runs in a fresh Python process, so nothing is imported or cached beforehand.
+"eager" builds the pipelines of all options, like `get_pipeline` did before pipelines were built lazily.
+
+To run this script from the root of the repo:
+    python -m scripts.benchmark_startup --runs 5
+    python -m scripts.benchmark_startup --app  # import main instead of the config, needs ashley_protos
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    "lazy": "get_pipeline('GPT-4o')",
+    "eager": "[get_pipeline(option) for option in PIPELINE_ANONYMIZERS]",
+    "lazy + warm-up": "warm_up('GPT-4o')",
+}
+
+CODE = """
+import json, time
+start = time.perf_counter()
+{import_statement}
+from pseudoanonymize.config import PIPELINE_ANONYMIZERS, get_pipeline, warm_up
+{setup}
+ready = time.perf_counter()
+from pseudoanonymize.utils import chunk_by_line
+chunk_by_line("user: Hi, I'm Alex\\nassistant: Nice to meet you Alex", 2000)
+first_request = time.perf_counter()
+print(json.dumps({{"ready": ready - start, "first_request": first_request - ready}}))
+"""
+
+
+def measure(setup: str, import_statement: str) -> dict:
+    env = {"OPENAI_API_KEY": "fake", **os.environ}
+    code = CODE.format(setup=setup, import_statement=import_statement)
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--app", action="store_true", help="import the FastAPI app (main.py) first")
+    args = parser.parse_args()
+    import_statement = "import main" if args.app else "import pseudoanonymize.config"
+
+    for name, setup in SCENARIOS.items():
+        runs = [measure(setup, import_statement) for _ in range(args.runs)]
+        ready = statistics.median(run["ready"] for run in runs)
+        first_request = statistics.median(run["first_request"] for run in runs)
+        print(
+            f"{name:15s}: import to ready {ready * 1000:7.0f} ms, first chunked request {first_request * 1000:6.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+A local stand-in for the OpenAI chat completions API, used by the load tests and benchmarks.
+
+The server answers `POST /v1/chat/completions` after a configurable latency with a canned
+response, and keeps track of how many requests were in flight at the same time.
+
+Usage:
+```python
+from scripts.fake_openai_server import FakeOpenAIServer
+
+with FakeOpenAIServer(latency=0.5) as server:
+    client = AsyncOpenAI(base_url=server.base_url, api_key="fake")
+    ...
+    print(server.stats.max_in_flight)
+```
+"""
+import asyncio
+import random
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_RESPONSE = '{"FIRST_NAME_1": ["Alex"]}'
+
+
+@dataclass
+class ServerStats:
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIServer:
+    def __init__(
+        self,
+        latency: float = 0.5,
+        error_rate: float = 0.0,
+        response: str = DEFAULT_RESPONSE,
+        respond: Optional[Callable[[dict], str]] = None,
+        port: Optional[int] = None,
+    ):
+        """
+        args:
+            latency: seconds to wait before answering each request
+            error_rate: fraction of requests answered with a 500 error
+            response: the canned completion content returned for every request
+            respond: optional function taking the request body and returning the completion content,
+                takes precedence over `response`
+            port: port to listen on, a free port is picked if not given
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.response = response
+        self.respond = respond
+        self.port = port or _free_port()
+        self.stats = ServerStats()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(request: Request):
+            body = await request.json()
+            self.stats.requests += 1
+            self.stats.in_flight += 1
+            self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+            try:
+                await asyncio.sleep(self.latency)
+                if random.random() < self.error_rate:
+                    self.stats.errors += 1
+                    return JSONResponse(status_code=500, content={"error": {"message": "fake server error"}})
+
+                content = self.respond(body) if self.respond else self.response
+                prompt_tokens = sum(_estimate_tokens(m["content"]) for m in body["messages"])
+                completion_tokens = _estimate_tokens(content)
+                self.stats.prompt_tokens += prompt_tokens
+                self.stats.completion_tokens += completion_tokens
+                return {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            finally:
+                self.stats.in_flight -= 1
+
+        return app
+
+    def start(self) -> "FakeOpenAIServer":
+        config = uvicorn.Config(self.build_app(), host="127.0.0.1", port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+if __name__ == "__main__":
+    server = FakeOpenAIServer()
+    uvicorn.run(server.build_app(), host="127.0.0.1", port=8001)
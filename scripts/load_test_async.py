@@ -0,0 +1,59 @@
+"""
+Load test showing that concurrent anonymization requests overlap instead of queueing behind
+each other on the event loop.
+
+A local fake OpenAI server answers every request after a fixed latency. If the LLM calls are
+truly async, N concurrent predictions finish in roughly one latency, not N latencies.
+
+To run this script from the root of the repo:
+    python -m scripts.load_test_async --requests 50 --latency 0.5
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from openai import AsyncOpenAI
+
+from pseudoanonymize.direct_json_anonymization import JsonDirectAnonymizer
+from pseudoanonymize.pipeline import PiplelineAnon
+from pseudoanonymize.regex_anonymization import RegexAnon
+from scripts.fake_openai_server import FakeOpenAIServer
+
+
+async def run_load_test(base_url: str, num_requests: int) -> float:
+    client = AsyncOpenAI(base_url=base_url, api_key="fake")
+    pipeline = PiplelineAnon([JsonDirectAnonymizer(client=client), RegexAnon()])
+    # A unique run id keeps the LLM response cache from answering the requests.
+    run_id = uuid.uuid4().hex
+    texts = [f"user: Hi, I'm Alex ({run_id}-{i}), you can reach me at alex@example.com" for i in range(num_requests)]
+
+    start = time.perf_counter()
+    predictions = await asyncio.gather(*(pipeline.predict({"text": text}) for text in texts))
+    elapsed = time.perf_counter() - start
+
+    assert all("[FIRST_NAME_1]" in prediction["anonymized_text"] for prediction in predictions)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(latency=args.latency) as server:
+        elapsed = asyncio.run(run_load_test(server.base_url, args.requests))
+        stats = server.stats
+
+    print(f"requests:              {args.requests}")
+    print(f"fake LLM latency:      {args.latency:.2f}s")
+    print(f"wall time:             {elapsed:.2f}s")
+    print(f"serial wall time:      {args.requests * args.latency:.2f}s")
+    print(f"max in-flight at LLM:  {stats.max_in_flight}")
+    if stats.max_in_flight <= 1:
+        raise SystemExit("LLM calls did not overlap, the event loop is being blocked.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,759 @@
+import asyncio
+import json
+import logging
+import math
+import re
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pseudoanonymize import common, metrics, transport
+from pseudoanonymize.base import BaseProcessor
+from pseudoanonymize.cache import DiskCache, InMemoryLRUCache, InMemoryRedis, RedisCache, TieredCache
+from pseudoanonymize.chunk_sizing import ChunkSizeController
+from pseudoanonymize.cli import BulkAnonymizer, load_checkpoint, read_records
+from pseudoanonymize.common import make_chat_completion, set_llm_cache
+from pseudoanonymize.deanonymization import (
+    CONDITIONS,
+    DRUGS,
+    SURROGATE_GENERATORS,
+    Deanonymizer,
+    SurrogateGenerator,
+    placeholder_category,
+)
+from pseudoanonymize.direct_json_anonymization import JsonDirectAnonymizer
+from pseudoanonymize.exceptions import DeadlineExceededException
+from pseudoanonymize.logging_config import JsonFormatter, SamplingFilter, request_id
+from pseudoanonymize.message_index import MessageIndex
+from pseudoanonymize.pipeline import PiplelineAnon
+from pseudoanonymize.regex_anonymization import PatternRegistry, RegexAnon
+from pseudoanonymize.registry import EntityRegistry, is_typo_of
+from pseudoanonymize.replacement import ReplacementMatcher, get_replacement_matcher
+from pseudoanonymize.retry import RetryPolicy
+from pseudoanonymize.scheduler import ChunkScheduler
+from pseudoanonymize.shaping import RequestShaper
+from pseudoanonymize.singleflight import SingleFlight
+from pseudoanonymize.state import ConversationState, InMemoryStateStore, RedisStateStore
+from pseudoanonymize.transport import HttpSettings, build_async_http_client
+from pseudoanonymize.utils import chunk_by_line, count_openai_tokens
+
+
+class SlowProcessor(BaseProcessor):
+    def __init__(self, replacement_dict, delay=0.2):
+        self.replacement_dict = replacement_dict
+        self.delay = delay
+
+    async def predict(self, input_):
+        await asyncio.sleep(self.delay)
+        return {"replacement_dict": self.replacement_dict}
+
+
+class FakeChatClient:
+    """Stands in for AsyncOpenAI, answering chat completions with the given responses in order."""
+
+    def __init__(self, responses, delay=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        content = self.responses[min(self.calls, len(self.responses)) - 1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def use_llm_cache():
+    """Sets the process-wide LLM cache for a test, the previous cache is restored after it even if it fails."""
+    previous = common.llm_cache
+    try:
+        yield set_llm_cache
+    finally:
+        set_llm_cache(previous)
+
+
+def test_concurrent_pipeline_predictions_overlap():
+    pipeline = PiplelineAnon([SlowProcessor({"Bob": "[FIRST_NAME_1]"})])
+
+    async def run():
+        return await asyncio.gather(*(pipeline.predict({"text": f"Hi, I am Bob {i}"}) for i in range(10)))
+
+    start = time.perf_counter()
+    predictions = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    assert [p["anonymized_text"] for p in predictions] == [f"Hi, I am [FIRST_NAME_1] {i}" for i in range(10)]
+    assert elapsed < 1.0
+
+
+def test_pipeline_runs_stages_concurrently_and_drops_timed_out_stages():
+    fast = SlowProcessor({"Bob": "[FIRST_NAME_1]"}, delay=0.2)
+    also_fast = SlowProcessor({"bob@example.com": "<email>", "Bob": "[NAME_1]"}, delay=0.2)
+    slow = SlowProcessor({"Alice": "[FIRST_NAME_2]"}, delay=5)
+
+    start = time.perf_counter()
+    prediction = asyncio.run(PiplelineAnon([fast, also_fast]).predict({"text": "Bob <bob@example.com>"}))
+    assert time.perf_counter() - start < 0.35
+    # merged in the order of the processors
+    assert prediction["anonymized_text"] == "[NAME_1] <<email>>"
+    assert not prediction["degraded"]
+
+    pipeline = PiplelineAnon([slow, fast], stage_timeout=0.3)
+    prediction = asyncio.run(pipeline.predict({"text": "Bob and Alice"}))
+    assert prediction["anonymized_text"] == "[FIRST_NAME_1] and Alice"
+    assert prediction["degraded"] and prediction["timed_out_stages"] == ["SlowProcessor"]
+
+
+def test_scheduler_respects_limits_and_interleaves_requests():
+    scheduler = ChunkScheduler(max_in_flight=3, max_fanout_per_request=2)
+    running = {"big": 0, "small": 0}
+    max_running = {"big": 0, "small": 0}
+    finished = []
+
+    def job(request):
+        async def run(i):
+            running[request] += 1
+            max_running[request] = max(max_running[request], running[request])
+            assert sum(running.values()) <= 3
+            await asyncio.sleep(0.01)
+            running[request] -= 1
+            finished.append(request)
+            return i
+
+        return run
+
+    async def run():
+        return await asyncio.gather(
+            scheduler.map(job("big"), range(20)), scheduler.map(job("small"), range(2), max_fanout=4)
+        )
+
+    big, small = asyncio.run(run())
+
+    assert big == list(range(20)) and small == [0, 1]
+    assert max_running["big"] == 2 and max_running["small"] <= 2
+    # the small request is not queued behind all the chunks of the big one
+    assert finished.index("small") < 4
+    assert scheduler.metrics()["queue_depth"] == 0 and scheduler.metrics()["jobs_completed"] == 22
+
+
+def test_replacement_matcher_is_leftmost_longest():
+    matcher = ReplacementMatcher({"Alex": "[NAME_1]", "Alex Smith": "[NAME_2]", "Smith": "[LAST_NAME_1]"})
+    assert matcher.replace("Alex Smith met Alex and Mr Smith.") == "[NAME_2] met [NAME_1] and Mr [LAST_NAME_1]."
+
+
+def test_replacement_matcher_does_not_replace_inserted_placeholders():
+    matcher = ReplacementMatcher({"Nam": "[NAME_1]", "AME": "[CITY_1]", "": "[EMPTY_1]"})
+    assert matcher.replace("Nam lives in AME") == "[NAME_1] lives in [CITY_1]"
+
+
+def test_replacement_matcher_is_compiled_once_per_dict():
+    assert get_replacement_matcher({"Bob": "[NAME_1]"}) is get_replacement_matcher({"Bob": "[NAME_1]"})
+
+
+def test_replacement_matcher_handles_keys_of_thousands_of_characters():
+    paragraph = " ".join(f"sentence {i} about my week." for i in range(120))
+    assert len(paragraph) > 3000
+    matcher = get_replacement_matcher({paragraph: "[EVENT_1]", paragraph[:20]: "[EVENT_2]", "Bob": "[NAME_1]"})
+    assert matcher.replace(f"Bob: {paragraph} {paragraph[:25]}") == f"[NAME_1]: [EVENT_1] [EVENT_2]{paragraph[20:25]}"
+
+
+def test_chunk_by_line_respects_max_tokens_and_keeps_every_line():
+    lines = [f"user: Hi, I'm Alex and this is line number {i} of the session." for i in range(200)]
+    chunks = chunk_by_line("\n".join(lines), 100)
+
+    assert all(count_openai_tokens(chunk) <= 100 for chunk in chunks)
+    assert "\n".join(chunks).split("\n") == lines
+
+
+def test_chunk_by_line_overlap_repeats_the_end_of_the_previous_chunk():
+    lines = [f"line {i}: my name is Alex and I live in Springfield" for i in range(50)]
+    chunks = chunk_by_line("\n".join(lines), 60, overlap_tokens=20)
+
+    assert all(count_openai_tokens(chunk) <= 60 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.split("\n")[0] in previous.split("\n")
+
+
+def test_message_index_patches_messages_split_across_chunks_in_place():
+    long_message = " ".join(f"word{i}" for i in range(300))
+    messages = [
+        SimpleNamespace(content="Hi  Jane,\nhow are you?"),
+        SimpleNamespace(content=""),
+        SimpleNamespace(content=long_message),
+        SimpleNamespace(content="Bye Jane"),
+    ]
+    index = MessageIndex(messages)
+    assert len(index) == 3 and index.conversation == f"Hi Jane, how are you?\n{long_message}\nBye Jane"
+
+    # the long message is split by chunk_by_word, every piece of it maps to the message
+    chunks = chunk_by_line(index.conversation, 100)
+    assert len(chunks) > 3 and not any("\n" in chunk for chunk in chunks)
+    assert index.spans(chunks) == [(0, 1)] + [(1, 2)] * (len(chunks) - 2) + [(2, 3)]
+    for span, chunk in zip(index.spans(chunks), chunks):
+        index.patch(span, chunk.upper())
+    index.apply_messages()
+    assert [message.content for message in messages] == ["HI JANE, HOW ARE YOU?", "", long_message.upper(), "BYE JANE"]
+
+    # a chunk whose lines don't match its messages fails on its own
+    index = MessageIndex(messages)
+    chunk = index.conversation.split("\n", 1)[1]
+    (span,) = index.spans([chunk])
+    assert span == (1, 3)
+    with pytest.raises(ValueError):
+        index.patch(span, chunk.replace("\n", " "))
+    with pytest.raises(ValueError):
+        index.spans(["not in the conversation"])
+
+
+def test_tiered_cache_evicts_and_backfills_from_shared_tier():
+    memory = InMemoryLRUCache(max_entries=2)
+    shared = RedisCache(InMemoryRedis())
+    cache = TieredCache([memory, shared])
+
+    async def run():
+        for key in ["a", "b", "c"]:
+            await cache.set(key, key.upper())
+        assert await memory.get("a") is None  # evicted from the LRU tier
+        assert await cache.get("a") == "A"  # but still in the shared tier
+        assert await memory.get("a") == "A"  # and copied back into the LRU tier
+        assert await cache.get("missing") is None
+
+    asyncio.run(run())
+    assert memory.stats.evictions == 2
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+
+def test_disk_cache_keeps_its_index_consistent_under_concurrent_threads(tmp_path):
+    (tmp_path / f"{DiskCache.TMP_PREFIX}crashed").write_text("partial")
+    cache = DiskCache(str(tmp_path), max_bytes=2000)
+    assert not list(tmp_path.iterdir())
+    values = {f"key{i}": str(i) * (100 + 37 * i) for i in range(12)}
+
+    async def run():
+        calls = []
+        for attempt in range(20):
+            for key, value in values.items():
+                calls += [cache.set(key, value), cache.get(key)]
+                if attempt % 3 == 0:
+                    calls.append(cache.delete(key))
+        results = await asyncio.gather(*calls)
+        # an entry is read whole or not at all
+        assert all(value is None or value in values.values() for value in results)
+
+    asyncio.run(run())
+    files = {path.name: path.stat().st_size for path in tmp_path.iterdir()}
+    assert files == dict(cache._index)
+    assert cache._size == sum(files.values()) <= 2000
+
+
+def test_retry_after_unparsable_output_bypasses_the_cache(use_llm_cache):
+    use_llm_cache(InMemoryLRUCache())
+    client = FakeChatClient(["not json", '{"FIRST_NAME_1": ["Bob"]}'])
+    anonymizer = JsonDirectAnonymizer(client=client)
+
+    prediction = asyncio.run(anonymizer.retry_prediction({"text": "Hi, I am Bob"}, 3))
+
+    assert prediction["anonymized_text"] == "Hi, I am [FIRST_NAME_1]"
+    assert client.calls == 2
+    assert [(a["outcome"], a["bypassed_cache"]) for a in prediction["attempts"]] == [
+        ("unparsable", False),
+        ("success", True),
+    ]
+
+
+def test_retry_escalates_and_respects_deadline(use_llm_cache):
+    use_llm_cache(None)
+    fallback = JsonDirectAnonymizer(client=FakeChatClient(['{"FIRST_NAME_1": ["Bob"]}']))
+    anonymizer = JsonDirectAnonymizer(client=FakeChatClient(["not json"]))
+    policy = RetryPolicy(escalate_to=fallback, escalate_after=1)
+    prediction = asyncio.run(anonymizer.retry_prediction({"text": "Bob"}, policy=policy))
+    assert prediction["anonymized_text"] == "[FIRST_NAME_1]"
+
+    slow_anonymizer = JsonDirectAnonymizer(client=FakeChatClient(["{}"], delay=1))
+    with pytest.raises(DeadlineExceededException):
+        asyncio.run(slow_anonymizer.retry_prediction({"text": "Bob"}, policy=RetryPolicy(deadline=0.1)))
+
+
+def test_local_deanonymizer_is_stable_per_conversation_without_llm_calls():
+    client = FakeChatClient([])
+    deanonymizer = Deanonymizer(client=client)
+    replacement_dict = {"Bob": "[FIRST_NAME_1]", "bob@example.com": "<email>"}
+
+    def deanonymize(text, conversation_id):
+        input_ = {"text": text, "replacement_dict": replacement_dict, "conversation_id": conversation_id}
+        return asyncio.run(deanonymizer.predict(input_))["deanonymized_text"]
+
+    first = deanonymize("[FIRST_NAME_1] <email>", "conversation-1")
+    name, email = first.split(" ")
+    assert "[" not in name and "@" in email
+    assert deanonymize("Hi [FIRST_NAME_1]!", "conversation-1") == f"Hi {name}!"
+    assert deanonymize("[FIRST_NAME_1] <email>", "conversation-2") != first
+    assert client.calls == 0
+    assert [placeholder_category(p) for p in ["[FIRST_NAME_1]", "[NAME1]", "<email>"]] == [
+        "FIRST_NAME",
+        "NAME",
+        "EMAIL",
+    ]
+
+    # categories are matched by whole words, ZIP_CODE isn't an IP address nor ETHNICITY a city
+    surrogates = SurrogateGenerator()
+    generated = surrogates.generate(
+        ["[ZIP_CODE_1]", "[RELATIONSHIP_1]", "[PRINCIPAL_NAME_1]", "[ETHNICITY_1]", "[LANGUAGE_1]"], seed="s"
+    )
+    assert not any(re.fullmatch(r"\d+(\.\d+){3}", value) for value in generated.values())
+    assert surrogates._generator("ZIP_CODE") is SURROGATE_GENERATORS["ZIP"]
+    assert surrogates._generator("PRINCIPAL_NAME") is SURROGATE_GENERATORS["NAME"]
+    assert surrogates._generator("MOTHER_FIRST_NAME") is SURROGATE_GENERATORS["FIRST_NAME"]
+    for category in ["RELATIONSHIP", "ETHNICITY", "LANGUAGE"]:
+        assert surrogates._generator(category) not in SURROGATE_GENERATORS.values()
+
+    # the common categories get a surrogate of their type, NAME is only for the names of people
+    for category, keyword in [
+        ("LOCATION", "LOCATION"),
+        ("PLACE_OF_BIRTH", "PLACE"),
+        ("PERSON", "PERSON"),
+        ("DRUG_NAME", "DRUG"),
+        ("RARE_DISEASE", "DISEASE"),
+        ("MEDICAL_CONDITION", "CONDITION"),
+        ("PRODUCT_NAME", "PRODUCT"),
+    ]:
+        assert surrogates._generator(category) is SURROGATE_GENERATORS[keyword], category
+    generated = surrogates.generate(["[DRUG_NAME_1]", "[DISEASE_1]", "[LOCATION_1]"], seed="s")
+    assert generated["[DRUG_NAME_1]"] in DRUGS and generated["[DISEASE_1]"] in CONDITIONS
+
+
+def test_regex_detects_pii_in_one_pass_with_validated_cards_and_zip_context():
+    text = "Call (555) 123-4567 or mail jo@example.com, card 4111 1111 1111 1111, not 4111 1111 1111 1112. Boston MA 02115, walked 10000 steps"
+    result = RegexAnon().anonymize(text)
+    assert [(d.label, d.text) for d in result["detections"]] == [
+        ("phone", "(555) 123-4567"),
+        ("email", "jo@example.com"),
+        ("credit_card", "4111 1111 1111 1111"),
+        ("zip", "02115"),
+    ]
+    assert result["anon_text_safe"].startswith("Call <phone> or mail <email>, card <credit_card>, not 4111")
+
+    # a run of digits failing the Luhn check doesn't hide the phone number or SSN it starts with
+    assert RegexAnon().anonymize("ssn 123-45-6789 1234 done")["anon_text_safe"] == "ssn <ssn> 1234 done"
+    assert (
+        RegexAnon().anonymize("call me at 555-123-4567 123 times")["anon_text_safe"] == "call me at <phone> 123 times"
+    )
+
+    registry = PatternRegistry.from_names(["email"], extra_patterns={"employee_id": r"\bEMP-\d{6}\b"})
+    assert [d.label for d in registry.detect("EMP-123456 jo@example.com 555-123-4567")] == ["employee_id", "email"]
+
+
+def test_scheduler_imap_yields_in_order_and_bounds_work_ahead_of_the_consumer():
+    scheduler = ChunkScheduler(max_in_flight=8, max_fanout_per_request=4)
+    started = []
+
+    async def job(i):
+        started.append(i)
+        await asyncio.sleep(0.01 * (5 - i % 5))
+        return i
+
+    async def run():
+        results = []
+        results_stream = scheduler.imap(job, iter(range(20)), window=3)
+        async for result in results_stream:
+            # items are only pulled as results are consumed
+            assert len(started) <= len(results) + 3
+            results.append(result)
+            if len(results) == 10:
+                await results_stream.aclose()
+        return results
+
+    assert asyncio.run(run()) == list(range(10))
+    assert len(started) <= 13
+    assert scheduler.metrics()["active_requests"] == 0 and scheduler.metrics()["in_flight"] == 0
+
+
+def test_entity_registry_gives_an_entity_the_same_placeholder_in_every_chunk():
+    registry = EntityRegistry()
+    chunks = [
+        ("Alex called John", {"Alex": "[NAME_1]", "John": "[NAME_2]"}),
+        ("Then alex and Mary met Jhon", {"Mary": "[NAME_1]", "alex": "[NAME_2]", "Jhon": "[NAME_3]"}),
+        ("Mark saw ALEX", {"Mark": "[NAME_1]", "ALEX": "[NAME_2]"}),
+    ]
+
+    async def anonymize(text, replacement_dict, delay):
+        await asyncio.sleep(delay)
+        return registry.canonicalize(text, replacement_dict)
+
+    async def run():
+        # chunks finishing out of order
+        return await asyncio.gather(*(anonymize(*chunk, 0.01 * (3 - i)) for i, chunk in enumerate(chunks)))
+
+    texts = [text for text, _ in asyncio.run(run())]
+    alex = registry.replacement_dict["Alex"]
+    assert texts[0] == f"{alex} called {registry.replacement_dict['John']}"
+    assert registry.replacement_dict["alex"] == registry.replacement_dict["ALEX"] == alex
+    assert registry.replacement_dict["Jhon"] == registry.replacement_dict["John"]
+    assert len({registry.replacement_dict[name] for name in ["Alex", "John", "Mary", "Mark"]}) == 4
+    assert EntityRegistry.from_dict(registry.to_dict()).replacement_dict == registry.replacement_dict
+
+    # distinct people with close names keep their own placeholders
+    for a, b in [
+        ("christina", "christine"),
+        ("johnson", "johnsen"),
+        ("christian", "christina"),
+        ("daniel", "daniela"),
+        ("julian", "juliana"),
+        ("mark", "mary"),
+    ]:
+        assert not is_typo_of(a, b) and not is_typo_of(b, a), (a, b)
+    for a, b in [("jhon", "john"), ("johnson", "jonson"), ("michael", "micheal"), ("alexandria", "alexandira")]:
+        assert is_typo_of(a, b) and is_typo_of(b, a), (a, b)
+
+
+def test_conversation_state_only_reanonymizes_new_or_changed_messages():
+    state = ConversationState()
+    state.update([("0:user", "Hi I am Bob", "Hi I am [NAME_1]"), ("1:therapist", "Hello Bob", "Hello [NAME_1]")])
+    state.registry = {"mentions": {"Bob": "[NAME_1]"}, "counters": {"NAME": 1}}
+
+    async def roundtrip(store):
+        await store.set("conversation-1", state)
+        return await store.get("conversation-1"), await store.get("conversation-2")
+
+    for store in [InMemoryStateStore(), RedisStateStore(InMemoryRedis())]:
+        stored, missing = asyncio.run(roundtrip(store))
+        assert stored == state and missing is None
+        assert stored.anonymized("0:user", "Hi I am Bob") == "Hi I am [NAME_1]"
+        assert stored.anonymized("1:therapist", "Hello Bob, edited") is None
+        assert stored.anonymized("2:user", "Bye") is None
+        assert EntityRegistry.from_dict(stored.registry).register({"bob": "[NAME_7]"}) == {"bob": "[NAME_1]"}
+
+
+class NameDetector(BaseProcessor):
+    """Finds the given names, numbering them per input like the LLM does."""
+
+    def __init__(self, names):
+        self.names = names
+        self.inputs = []
+
+    async def predict(self, input_):
+        self.inputs.append(input_["text"])
+        found = [name for name in self.names if name in input_["text"]]
+        return {"replacement_dict": {name: f"[NAME_{i + 1}]" for i, name in enumerate(found)}}
+
+
+def test_predict_batch_dedups_and_packs_lines_and_splits_results_per_text():
+    detector = NameDetector(["Bob", "Alice", "Carol"])
+    pipeline = PiplelineAnon([detector])
+    boilerplate = "assistant: How are you feeling today?"
+    texts = [f"{boilerplate}\nuser: I'm Carol", f"{boilerplate}\nuser: Bob and Alice are here", boilerplate]
+
+    outputs = asyncio.run(pipeline.predict_batch(texts, max_tokens=20))
+
+    # the boilerplate line is sent once, and every line fits in the budget of a chunk
+    sent_lines = [line for chunk in detector.inputs for line in chunk.split("\n")]
+    assert sorted(sent_lines) == sorted({line for text in texts for line in text.split("\n")})
+    assert all(count_openai_tokens(chunk) <= 20 for chunk in detector.inputs) and len(detector.inputs) < len(sent_lines)
+    assert [output["anonymized_text"] for output in outputs] == [
+        f"{boilerplate}\nuser: I'm [NAME_1]",
+        f"{boilerplate}\nuser: [NAME_1] and [NAME_2] are here",
+        boilerplate,
+    ]
+    assert outputs[0]["replacement_dict"] == {"Carol": "[NAME_1]"} and outputs[2]["replacement_dict"] == {}
+
+
+def test_predict_batch_keeps_the_names_of_a_shared_chunk_in_the_text_they_come_from():
+    detector = NameDetector(["Al", "Bob"])
+    pipeline = PiplelineAnon([detector])
+    texts = ["Al said hi", "I also went to Albany", "Bob met Al"]
+
+    outputs = asyncio.run(pipeline.predict_batch(texts, max_tokens=100))
+
+    # one chunk holds the lines of all the texts
+    assert len(detector.inputs) == 1
+    assert outputs[0] == {
+        "anonymized_text": "[NAME_1] said hi",
+        "replacement_dict": {"Al": "[NAME_1]"},
+        "degraded": False,
+    }
+    assert outputs[1]["anonymized_text"] == "I also went to Albany" and outputs[1]["replacement_dict"] == {}
+    assert outputs[2]["anonymized_text"] == "[NAME_2] met [NAME_1]"
+
+
+def test_bulk_anonymizer_resumes_from_the_output_after_a_crash(tmp_path):
+    inputs = tmp_path / "sessions.jsonl"
+    inputs.write_text("\n".join(json.dumps({"id": f"s{i}", "text": f"Hi, I am Bob {i}"}) for i in range(5)))
+    (tmp_path / "note.txt").write_text("Alice was here")
+    output = tmp_path / "out.jsonl"
+    # two records written before the crash, the third one cut short
+    output.write_text('{"id": "s0", "anonymizedText": ""}\n{"id": "s1", "anonymizedText": ""}\n{"id": "s2", "anon')
+
+    done = load_checkpoint(str(output))
+    anonymizer = BulkAnonymizer(PiplelineAnon([NameDetector(["Bob", "Alice"])]), workers=2)
+
+    async def run():
+        with open(output, "a") as out, open(tmp_path / "errors.jsonl", "a") as errors:
+            await anonymizer.run(read_records([str(inputs), str(tmp_path / "note.txt")]), done, out, errors)
+
+    asyncio.run(run())
+
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [result["id"] for result in results[:2]] == ["s0", "s1"]
+    assert {result["id"] for result in results[2:]} == {"s2", "s3", "s4", str(tmp_path / "note.txt")}
+    assert {result["anonymizedText"] for result in results[2:]} >= {"Hi, I am [NAME_1] 4", "[NAME_1] was here"}
+    assert anonymizer.stats.skipped == 2 and anonymizer.stats.records == 4 and anonymizer.stats.errors == 0
+
+
+def test_json_logs_carry_the_request_id_and_redact_pii():
+    def make_record(level, message, extra=None):
+        record = logging.LogRecord("pseudoanonymize.test", level, __file__, 1, message, None, None)
+        record.__dict__.update(extra or {})
+        record.request_id = request_id.get()
+        return record
+
+    token = request_id.set("req-1")
+    try:
+        record = make_record(
+            logging.ERROR, "Unparsable output for jane.doe@example.com", {"model_output": "Jane", "duration_ms": 3}
+        )
+    finally:
+        request_id.reset(token)
+    entry = json.loads(JsonFormatter(redact_pii=True).format(record))
+    assert entry["request_id"] == "req-1"
+    assert entry["severity"] == "ERROR" and entry["duration_ms"] == 3
+    assert "jane.doe@example.com" not in entry["message"]
+    assert entry["model_output"] == "[REDACTED]"
+    assert json.loads(JsonFormatter(redact_pii=False).format(record))["model_output"] == "Jane"
+
+    # the records of a request are sampled together, warnings and errors are always kept
+    sampling = SamplingFilter(0.5)
+    kept = []
+    for i in range(200):
+        token = request_id.set(f"req-{i}")
+        decisions = {sampling.filter(make_record(logging.INFO, "step")) for _ in range(3)}
+        assert len(decisions) == 1 and sampling.filter(make_record(logging.WARNING, "slow"))
+        kept.append(decisions.pop())
+        request_id.reset(token)
+    assert 50 < sum(kept) < 150
+
+
+def test_metrics_record_stage_latency_and_retries_in_the_prometheus_format(use_llm_cache):
+    histogram = metrics.Histogram("test_duration_seconds", "Test durations", labels=("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, stage="parse")
+    assert histogram.samples() == [
+        'test_duration_seconds_bucket{stage="parse",le="0.1"} 1',
+        'test_duration_seconds_bucket{stage="parse",le="1"} 2',
+        'test_duration_seconds_bucket{stage="parse",le="+Inf"} 3',
+        'test_duration_seconds_sum{stage="parse"} 5.55',
+        'test_duration_seconds_count{stage="parse"} 3',
+    ]
+    with pytest.raises(ValueError):
+        histogram.observe(1.0, endpoint="/anonymize")
+
+    replacements = metrics.stage_duration.count(stage="replacement")
+    chunks = metrics.chunks.value()
+    chunk_by_line("user: Hi Jane\nassistant: Hello", 2000)
+    assert metrics.chunks.value() == chunks + 1
+
+    client = FakeChatClient(["not json", '{"NAME_1": "Jane"}'])
+    use_llm_cache(None)
+    retries = metrics.retries.value(processor="JsonDirectAnonymizer")
+    asyncio.run(JsonDirectAnonymizer(client=client).retry_prediction({"text": "Hi Jane"}, max_retries=2))
+    assert metrics.retries.value(processor="JsonDirectAnonymizer") == retries + 1
+    assert metrics.stage_duration.count(stage="replacement") == replacements + 1
+    rendered = metrics.registry.render()
+    assert 'pii_prediction_attempts_total{outcome="unparsable",processor="JsonDirectAnonymizer"}' not in rendered
+    assert 'pii_prediction_attempts_total{processor="JsonDirectAnonymizer",outcome="unparsable"}' in rendered
+    assert "# TYPE pii_llm_prompt_tokens_total counter" in rendered
+
+
+def test_request_shaper_balances_chunks_and_sends_small_inputs_to_the_small_pipeline():
+    shaper = RequestShaper("word " * 300, prefix_ratio=0.5, min_chunk_tokens=100, max_chunk_tokens=1000)
+    assert shaper.target_chunk_tokens == 2 * shaper.prefix_tokens
+    text = "\n".join(f"user: this is line {i} of the session" for i in range(120))
+    pipeline = PiplelineAnon([NameDetector(["Jane"])])
+    pipeline.shaper = shaper
+    pipeline.small_input_pipeline = PiplelineAnon([NameDetector(["Jane"])])
+
+    chosen, chunks = pipeline.plan(text)
+    # the fixed size would leave a small last chunk paying the whole prefix
+    fixed_sizes = [count_openai_tokens(chunk) for chunk in chunk_by_line(text, shaper.target_chunk_tokens)]
+    sizes = [count_openai_tokens(chunk) for chunk in chunks]
+    assert chosen is pipeline and len(chunks) == len(fixed_sizes) == 3
+    assert min(fixed_sizes) < 0.25 * max(fixed_sizes)
+    assert min(sizes) > 0.7 * max(sizes) and max(sizes) < max(fixed_sizes)
+    assert "\n".join(chunks) == text
+    # the chunk size of the caller isn't made smaller by the prefix ratio, only balanced
+    assert len(pipeline.plan(text, 1000)[1]) == len(chunk_by_line(text, 1000)) < len(chunks)
+
+    assert pipeline.plan("user: Hi, I'm Jane")[0] is pipeline
+    shaper.small_input_tokens = 50
+    assert pipeline.plan("user: Hi, I'm Jane")[0] is pipeline.small_input_pipeline
+    prediction = asyncio.run(pipeline.predict_chunked("user: Hi, I'm Jane"))
+    assert prediction["anonymized_text"] == "user: Hi, I'm [NAME_1]"
+    assert pipeline.small_input_pipeline.processors[0].inputs == ["user: Hi, I'm Jane"]
+    assert pipeline.processors[0].inputs == []
+
+
+def test_chunk_size_controller_trades_parallelism_against_fixed_cost_and_failures():
+    def controller_for(intercept, seconds_per_token, unparsable_above=None):
+        controller = ChunkSizeController("gpt-4o", min_chunk_tokens=500, max_chunk_tokens=4000, min_observations=20)
+        for i in range(200):
+            tokens = 500 + (i * 137) % 3500
+            unparsable = unparsable_above is not None and tokens >= unparsable_above and i % 2 == 0
+            controller.observe(tokens, intercept + seconds_per_token * tokens, unparsable)
+        return controller
+
+    def num_chunks(controller, text_tokens=8000, fanout=4):
+        return math.ceil(text_tokens / controller.choose(text_tokens, fanout))
+
+    assert ChunkSizeController("gpt-4o").choose(8000, fanout=4) is None
+    # latency proportional to the chunk: as many chunks as the fan-out allows
+    assert num_chunks(controller_for(0.0, 0.002)) == 4
+    assert num_chunks(controller_for(0.0, 0.002), fanout=2) == 2
+    # a high fixed cost per call: as few chunks as possible
+    assert num_chunks(controller_for(20.0, 0.0001)) == 2
+    # big chunks that fail to parse half the time are avoided
+    assert num_chunks(controller_for(20.0, 0.0001, unparsable_above=2500)) == 4
+
+    shaper = RequestShaper("word " * 300, controller=controller_for(0.0, 0.002), min_chunk_tokens=500)
+    assert shaper.chunk_tokens(8000) == 550  # the chunks of the prefix target, balanced
+    assert shaper.chunk_tokens(8000, fanout=4) == 2200  # 4 balanced chunks with the headroom
+    shaper.pinned_chunk_tokens = 1234
+    assert shaper.chunk_tokens(8000, fanout=4) == 1234
+
+
+def test_workers_sharing_a_redis_store_serialize_the_calls_of_a_conversation():
+    # two workers, each with its own store, talking to the same server
+    server = InMemoryRedis()
+    workers = [RedisStateStore(server), RedisStateStore(server)]
+    events = []
+
+    async def call(store, name):
+        async with store.lock("conversation"):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(call(workers[0], "a"), call(workers[1], "b"))
+
+    asyncio.run(main())
+    assert events == ["a start", "a end", "b start", "b end"]
+
+    # without a url there is nothing to reconnect to
+    workers[0].reconnect()
+    assert workers[0].client is server
+
+
+def test_llm_client_reuses_the_pooled_connections_and_reports_them():
+    from openai import AsyncOpenAI
+
+    from scripts.fake_openai_server import FakeOpenAIServer
+
+    with FakeOpenAIServer(latency=0.05) as server:
+        settings = HttpSettings(max_connections=2, base_url=server.base_url)
+        client = AsyncOpenAI(
+            api_key="fake",
+            base_url=settings.base_url,
+            timeout=settings.timeout,
+            http_client=build_async_http_client(settings),
+        )
+
+        async def main():
+            calls = [
+                client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+                for _ in range(6)
+            ]
+            await asyncio.gather(*calls)
+            stats, rendered = transport.pool_metrics(), metrics.registry.render()
+            await client.close()
+            return stats, rendered
+
+        stats, rendered = asyncio.run(main())
+
+    assert server.stats.requests == 6 and server.stats.max_in_flight <= 2
+    assert stats["pii_http_requests_total"] == 6 and stats["pii_http_requests_in_flight"] == 0
+    # the connections are kept alive for the next calls
+    assert stats["pii_http_connections_open"] == stats["pii_http_connections_idle"] == 2
+    assert "pii_http_connections_idle 2" in rendered
+
+
+def test_identical_llm_calls_in_flight_are_sent_once_and_survive_a_cancelled_caller(use_llm_cache):
+    use_llm_cache(None)
+
+    class EchoClient(FakeChatClient):
+        async def create(self, messages, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(self.delay)
+            content = json.dumps({"FIRST_NAME_1": [messages[-1]["content"].split()[0]]})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    client = EchoClient([], delay=0.05)
+
+    def call(text):
+        return make_chat_completion(client, "gpt-4o", "system", text, json_format=True)
+
+    async def main():
+        first = asyncio.create_task(call("Anna called"))
+        await asyncio.sleep(0)
+        others = asyncio.gather(call("Anna called"), call("Anna called"), call("Bob called"))
+        await asyncio.sleep(0)
+        # the caller that started the call goes away, the others still get its result
+        first.cancel()
+        return await others, len(common.llm_flights)
+
+    coalesced = metrics.coalesced_calls.value(layer="llm_call")
+    (anna, anna_again, bob), in_flight = asyncio.run(main())
+
+    assert anna == anna_again == '{"FIRST_NAME_1": ["Anna"]}' and bob == '{"FIRST_NAME_1": ["Bob"]}'
+    assert client.calls == 2 and in_flight == 0
+    assert metrics.coalesced_calls.value(layer="llm_call") - coalesced == 2
+    assert not SingleFlight("request", enabled=False)._calls
+
+
+def test_a_coalesced_llm_call_is_cancelled_with_its_last_caller(use_llm_cache):
+    use_llm_cache(None)
+
+    class SlowClient(FakeChatClient):
+        in_flight = 0
+
+        async def create(self, messages, **kwargs):
+            self.calls += 1
+            self.in_flight += 1
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self.in_flight -= 1
+            content = json.dumps({"FIRST_NAME_1": [messages[-1]["content"].split()[0]]})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    client = SlowClient([], delay=10)
+
+    def call(text):
+        return make_chat_completion(client, "gpt-4o", "system", text, json_format=True)
+
+    async def timed_out(text):
+        try:
+            await asyncio.wait_for(call(text), 0.01)
+        except asyncio.TimeoutError:
+            pass
+
+    async def main():
+        scheduler = ChunkScheduler(max_in_flight=2)
+        for attempt in range(5):
+            await scheduler.map(timed_out, [f"Anna {attempt}", f"Bob {attempt}"])
+        # the timeouts stop the calls, nobody else waits for them
+        still_running = client.in_flight
+        # a caller cancelled while another waits for the same call leaves it running for the other one
+        client.delay = 0.05
+        first = asyncio.create_task(call("Carl called"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(call("Carl called"))
+        await asyncio.sleep(0)
+        first.cancel()
+        return still_running, await second, len(common.llm_flights)
+
+    still_running, carl, in_flight = asyncio.run(main())
+
+    assert client.calls == 11 and still_running == 0 and in_flight == 0
+    assert carl == '{"FIRST_NAME_1": ["Carl"]}'